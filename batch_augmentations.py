@@ -0,0 +1,301 @@
+# coding: utf-8
+__author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
+
+import math
+import torch
+from torch.utils.data import default_collate, get_worker_info
+
+# Stem augmentations applied by BatchAugmentations. They are skipped in MSSDataset.augm_data when batch mode is on
+BATCH_AUGMENTATIONS = [
+    'channel_shuffle',
+    'random_inverse',
+    'random_polarity',
+    'seven_band_parametric_eq',
+    'tanh_distortion',
+    'gaussian_noise',
+]
+
+# Bands of seven band parametric EQ (the same as in audiomentations):
+# (filter type, min center frequency, max center frequency, min Q, max Q)
+EQ_BANDS = [
+    ('low_shelf', 42.0, 95.0, 0.1, 0.999),
+    ('peaking', 91.0, 204.0, 0.5, 5.0),
+    ('peaking', 196.0, 441.0, 0.5, 5.0),
+    ('peaking', 421.0, 948.0, 0.5, 5.0),
+    ('peaking', 909.0, 2045.0, 0.5, 5.0),
+    ('peaking', 1957.0, 4404.0, 0.5, 5.0),
+    ('high_shelf', 4216.0, 9486.0, 0.1, 0.999),
+]
+
+# Zeros added before FFT filtering, so filter tail isn't wrapped to the start of chunk
+EQ_PAD = 4096
+
+# Number of samples used to estimate percentile of absolute values in tanh distortion
+TANH_PERCENTILE_SAMPLES = 65536
+
+
+def fast_fft_size(n):
+    # Smallest even number >= n without prime factors except 2, 3 and 5 (FFT is much faster for such sizes)
+    best = 2 ** math.ceil(math.log2(n))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            size = p35 * 2 ** max(math.ceil(math.log2(n / p35)), 1)
+            best = min(best, size)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def hz_to_mel(f):
+    return 2595.0 * math.log10(1.0 + f / 700.0)
+
+
+def mel_to_hz(m):
+    return 700.0 * (10 ** (m / 2595.0) - 1.0)
+
+
+def biquad_coefficients(kind, w, gain_db, q):
+    """
+    Coefficients of biquad filters from Audio EQ Cookbook for batch of parameters.
+    :return: b, a with shape (n, 3)
+    """
+    gain = 10 ** (gain_db / 40)
+    alpha = torch.sin(w) / 2 / q
+    cos = torch.cos(w)
+    if kind == 'peaking':
+        b = [1 + alpha * gain, -2 * cos, 1 - alpha * gain]
+        a = [1 + alpha / gain, -2 * cos, 1 - alpha / gain]
+    elif kind == 'low_shelf':
+        sq = 2 * torch.sqrt(gain) * alpha
+        b = [gain * ((gain + 1) - (gain - 1) * cos + sq), 2 * gain * ((gain - 1) - (gain + 1) * cos), gain * ((gain + 1) - (gain - 1) * cos - sq)]
+        a = [(gain + 1) + (gain - 1) * cos + sq, -2 * ((gain - 1) + (gain + 1) * cos), (gain + 1) + (gain - 1) * cos - sq]
+    else:
+        sq = 2 * torch.sqrt(gain) * alpha
+        b = [gain * ((gain + 1) + (gain - 1) * cos + sq), -2 * gain * ((gain - 1) + (gain + 1) * cos), gain * ((gain + 1) + (gain - 1) * cos - sq)]
+        a = [(gain + 1) - (gain - 1) * cos + sq, 2 * ((gain - 1) - (gain + 1) * cos), (gain + 1) - (gain - 1) * cos - sq]
+    return torch.stack(b, dim=-1), torch.stack(a, dim=-1)
+
+
+def polynomial_response(c, z):
+    # Values of polynomials c[:, 0] + c[:, 1] * z + c[:, 2] * z ^ 2 for every z: (n, bins)
+    return c[:, 0:1] + (c[:, 1:2] + c[:, 2:3] * z) * z
+
+
+class BatchAugmentations:
+    """
+    Augmentations applied to whole batches after collation: either in dataloader workers (as collate_fn) or
+    on training device. Cheap stem augmentations are vectorized over batch and stems: channel shuffle, inverse,
+    polarity, seven band parametric EQ (biquads applied in frequency domain), tanh distortion, gaussian noise
+    and loudness. Heavy ones (pitch shift, time stretch, mp3, pedalboard effects) stay in MSSDataset.augm_data,
+    which runs in CPU dataloader workers. Mixture is rebuilt from augmented stems, mixture-only changes
+    (mp3_compression_on_mixture) are kept.
+    Parameters and probabilities are the same as in augmentations section of config.
+    With training.mix_on_device dataloader returns only stems: mixup, loudness and mixture are done here,
+    on training device, and cheap augmentations are applied only if batch_augmentations is on. Mixup is
+    done only for dataset types with random mixes of tracks (1, 2, 3 and 5), as in MSSDataset.
+    """
+    def __init__(self, config, dataset_type=1, dataset=None):
+        self.config = config
+        # Training dataset: collate_fn takes random generator of the last sample of batch from it
+        self.dataset = dataset
+        self.instruments = list(config.training.instruments)
+        self.sample_rate = config.audio.get('sample_rate', 44100)
+        self.mix_on_device = config.training.get('mix_on_device', False)
+        augmentations = config['augmentations'] if 'augmentations' in config else dict()
+        enabled = augmentations.get('enable', False)
+        self.stem_augmentations = enabled and augmentations.get('batch_augmentations', False)
+        self.on_device = self.mix_on_device or augmentations.get('batch_augmentations_on_device', False)
+
+        self.target_index = None
+        if config.training.get('target_instrument', None) is not None:
+            self.target_index = self.instruments.index(config.training.target_instrument)
+
+        # exp(-jw) on rfft bins for every FFT size and device
+        self.eq_z = dict()
+        # Random generator of current call (None: global torch random state)
+        self.generator = None
+
+        self.loudness = None
+        if enabled and (self.stem_augmentations or self.mix_on_device) and augmentations.get('loudness', False):
+            self.loudness = (augmentations['loudness_min'], augmentations['loudness_max'])
+
+        # Mixup with stems of other samples in batch (stems-only mode, otherwise it's done in MSSDataset).
+        # Stems of aligned dataset types (4, 6) come from the same track and aren't mixed with other tracks
+        self.mixup_probs = []
+        if enabled and self.mix_on_device and dataset_type in [1, 2, 3, 5] and augmentations.get('mixup', False):
+            self.mixup_probs = list(augmentations['mixup_probs'])
+            self.mixup_loudness = (augmentations['loudness_min'], augmentations['loudness_max'])
+
+        # Every augmentation: probability and parameters for every stem
+        augs = [self.get_stem_augs(instr) for instr in self.instruments] if self.stem_augmentations else []
+        self.probs = dict()
+        self.params = dict()
+        for name in BATCH_AUGMENTATIONS if self.stem_augmentations else []:
+            probs = [float(a.get(name, 0)) for a in augs]
+            if max(probs) > 0:
+                self.probs[name] = torch.tensor(probs)
+        param_names = {
+            'seven_band_parametric_eq': ['seven_band_parametric_eq_min_gain_db', 'seven_band_parametric_eq_max_gain_db'],
+            'tanh_distortion': ['tanh_distortion_min', 'tanh_distortion_max'],
+            'gaussian_noise': ['gaussian_noise_min_amplitude', 'gaussian_noise_max_amplitude'],
+        }
+        for name, keys in param_names.items():
+            if name in self.probs:
+                self.params[name] = torch.tensor([[float(a.get(k, 0)) for k in keys] for a in augs])
+
+    def get_stem_augs(self, instr):
+        # Augmentations from "all" with overrides from stem subsection
+        augs = dict()
+        if 'all' in self.config['augmentations']:
+            augs.update(self.config['augmentations']['all'])
+        if instr in self.config['augmentations']:
+            augs.update(self.config['augmentations'][instr])
+        return augs
+
+    def rand(self, shape, device):
+        return torch.rand(shape, device=device, generator=self.generator)
+
+    def uniform(self, name, rows):
+        # Random parameter for selected (batch, stem) rows in stem specific range
+        low, high = self.params[name].to(rows[1].device)[rows[1]].unbind(-1)
+        return low + (high - low) * self.rand(low.shape, low.device)
+
+    def select(self, name, batch_size, device):
+        # Rows (batch index, stem index) where augmentation is applied
+        if name not in self.probs:
+            return None
+        mask = self.rand((batch_size, len(self.instruments)), device) < self.probs[name].to(device)
+        rows = mask.nonzero(as_tuple=True)
+        if len(rows[0]) == 0:
+            return None
+        return rows
+
+    def equalizer(self, x, rows):
+        n, length = x.shape[0], x.shape[-1]
+        n_fft = fast_fft_size(length + EQ_PAD)
+        key = (n_fft, str(x.device))
+        if key not in self.eq_z:
+            w = torch.linspace(0, math.pi, n_fft // 2 + 1, device=x.device)
+            self.eq_z[key] = torch.polar(torch.ones_like(w), -w)
+        z = self.eq_z[key]
+        num = den = None
+        low, high = self.params['seven_band_parametric_eq'].to(x.device)[rows[1]].unbind(-1)
+        for kind, min_freq, max_freq, min_q, max_q in EQ_BANDS:
+            mel = hz_to_mel(min_freq) + (hz_to_mel(max_freq) - hz_to_mel(min_freq)) * self.rand(n, x.device)
+            w = 2 * math.pi * mel_to_hz(mel) / self.sample_rate
+            gain_db = low + (high - low) * self.rand(n, x.device)
+            q = min_q + (max_q - min_q) * self.rand(n, x.device)
+            b, a = biquad_coefficients(kind, w, gain_db, q)
+            # Cascade response is product of numerators divided by product of denominators
+            num = polynomial_response(b, z) if num is None else num * polynomial_response(b, z)
+            den = polynomial_response(a, z) if den is None else den * polynomial_response(a, z)
+        spec = torch.fft.rfft(x, n=n_fft) * (num / den)[:, None]
+        return torch.fft.irfft(spec, n=n_fft)[..., :length]
+
+    def tanh_distortion(self, x, rows):
+        # Pre-gain from percentile of absolute values, then loudness is restored by RMS (as in audiomentations)
+        amount = self.uniform('tanh_distortion', rows)
+        flat = x.abs().reshape(x.shape[0], -1)
+        # Percentile is estimated from strided subset of samples (full sort of every chunk is slow)
+        flat = flat[:, ::max(flat.shape[1] // TANH_PERCENTILE_SAMPLES, 1)]
+        k = ((1 - 0.99 * amount) * (flat.shape[1] - 1)).round().long()
+        threshold = flat.sort(dim=1).values.gather(1, k[:, None])
+        distorted = torch.tanh(x * (0.5 / (threshold + 1e-6))[:, :, None])
+        rms_before = x.pow(2).mean(dim=(1, 2), keepdim=True).sqrt()
+        rms_after = distorted.pow(2).mean(dim=(1, 2), keepdim=True).sqrt()
+        post_gain = torch.where(rms_before > 1e-9, rms_before / rms_after.clamp(min=1e-12), torch.ones_like(rms_before))
+        return distorted * post_gain
+
+    def mixup(self, stems):
+        """
+        Every stem is averaged with the same stem of other random samples in batch, added with mixup_probs.
+        All parts get random loudness (as mixup in MSSDataset.load_random_mix).
+        """
+        batch_size, n = stems.shape[:2]
+        low, high = self.mixup_loudness
+        res = stems * (low + (high - low) * self.rand((batch_size, n, 1, 1), stems.device))
+        count = torch.ones(batch_size, n, 1, 1, device=stems.device)
+        stem_index = torch.arange(n, device=stems.device)[None]
+        for prob in self.mixup_probs:
+            mask = (self.rand((batch_size, n), stems.device) < prob).float()
+            # Random other sample for every (sample, stem)
+            shift = torch.randint(1, batch_size, (batch_size, n), device=stems.device, generator=self.generator)
+            other = (torch.arange(batch_size, device=stems.device)[:, None] + shift) % batch_size
+            weight = mask * (low + (high - low) * self.rand((batch_size, n), stems.device))
+            res += stems[other, stem_index] * weight[:, :, None, None]
+            count += mask[:, :, None, None]
+        return res / count
+
+    @torch.no_grad()
+    def __call__(self, stems, mix=None, generator=None):
+        # stems: (batch, instruments, channels, time), mix: (batch, channels, time) or None if dataloader returns
+        # only stems. Stems are changed in place. generator (on device of stems) makes result reproducible
+        batch_size, device = stems.shape[0], stems.device
+        self.generator = generator
+        residual = mix - stems.sum(dim=1) if mix is not None else None
+
+        rows = self.select('channel_shuffle', batch_size, device)
+        if rows is not None:
+            stems[rows] = stems[rows].flip(1)
+        rows = self.select('random_inverse', batch_size, device)
+        if rows is not None:
+            stems[rows] = stems[rows].flip(-1)
+        rows = self.select('random_polarity', batch_size, device)
+        if rows is not None:
+            stems[rows] = -stems[rows]
+        rows = self.select('seven_band_parametric_eq', batch_size, device)
+        if rows is not None:
+            stems[rows] = self.equalizer(stems[rows], rows)
+        rows = self.select('tanh_distortion', batch_size, device)
+        if rows is not None:
+            stems[rows] = self.tanh_distortion(stems[rows], rows)
+        rows = self.select('gaussian_noise', batch_size, device)
+        if rows is not None:
+            amplitude = self.uniform('gaussian_noise', rows)
+            noise = torch.randn(stems[rows].shape, dtype=stems.dtype, device=device, generator=self.generator)
+            stems[rows] += amplitude[:, None, None] * noise
+
+        if len(self.mixup_probs) > 0 and batch_size > 1:
+            stems = self.mixup(stems)
+
+        if self.loudness is not None:
+            low, high = self.loudness
+            stems *= (low + (high - low) * self.rand((batch_size, len(self.instruments), 1, 1), device))
+
+        mix = stems.sum(dim=1)
+        if residual is not None:
+            mix += residual
+        if self.target_index is not None:
+            stems = stems[:, self.target_index]
+        return stems, mix
+
+    def __getstate__(self):
+        # Dataloader workers have own copy of dataset, it's taken from worker info
+        state = self.__dict__.copy()
+        state['dataset'] = None
+        return state
+
+    def collate(self, items):
+        # collate_fn for DataLoader: augmentations are done in dataloader workers on CPU. Random generator
+        # of the last loaded sample (MSSDataset.sample) is used, so batch is reproducible with deterministic sampling
+        stems, mix = default_collate(items)
+        worker_info = get_worker_info()
+        dataset = worker_info.dataset if worker_info is not None else self.dataset
+        sample = getattr(dataset, 'sample', None)
+        return self(stems, mix, generator=sample.generator if sample is not None else None)
+
+
+def get_batch_augmentations(config, dataset_type=1, dataset=None):
+    """
+    BatchAugmentations if batch augmentations are enabled in config (augmentations.batch_augmentations) or
+    mixture is made on training device (training.mix_on_device), otherwise None.
+    """
+    if config.training.get('mix_on_device', False):
+        return BatchAugmentations(config, dataset_type, dataset)
+    if 'augmentations' not in config:
+        return None
+    if not config['augmentations'].get('enable', False) or not config['augmentations'].get('batch_augmentations', False):
+        return None
+    return BatchAugmentations(config, dataset_type, dataset)
@@ -7,8 +7,11 @@ import random
 import numpy as np
 import torch
 import soundfile as sf
-import pickle
+import sqlite3
+import json
 import time
+import collections
+import contextlib
 import itertools
 import multiprocessing
 from tqdm.auto import tqdm
@@ -16,16 +19,60 @@ from glob import glob
 import audiomentations as AU
 import pedalboard as PB
 import warnings
+from batch_augmentations import BATCH_AUGMENTATIONS
+from remote_storage import is_remote_path, join_path, RemoteStorage, RemoteShard
 warnings.filterwarnings("ignore")
 
 
-def load_chunk(path, length, chunk_size, offset=None):
+class AudioFilePool:
+    """
+    LRU pool of open audio files. Chunks are read from files which are already open, so there is no
+    open and header parsing for every chunk (it's slow on network filesystems). Every dataloader worker has own pool.
+    """
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.files = collections.OrderedDict()
+
+    def get(self, path):
+        f = self.files.get(path)
+        if f is None:
+            f = sf.SoundFile(path)
+            self.files[path] = f
+            if len(self.files) > self.max_open:
+                self.files.popitem(last=False)[1].close()
+        else:
+            self.files.move_to_end(path)
+        return f
+
+    def read(self, path, start=0, frames=-1):
+        try:
+            f = self.get(path)
+            f.seek(start)
+            return f.read(frames, dtype='float32')
+        except Exception:
+            # File can be in broken state after error, it's opened again next time
+            self.close(path)
+            raise
+
+    def close(self, path):
+        f = self.files.pop(path, None)
+        if f is not None:
+            f.close()
+
+
+def read_audio(path, start=0, frames=-1, files=None):
+    if files is None:
+        return sf.read(path, dtype='float32', start=start, frames=frames)[0]
+    return files.read(path, start, frames)
+
+
+def load_chunk(path, length, chunk_size, offset=None, files=None):
     if chunk_size <= length:
         if offset is None:
             offset = np.random.randint(length - chunk_size + 1)
-        x = sf.read(path, dtype='float32', start=offset, frames=chunk_size)[0]
+        x = read_audio(path, start=offset, frames=chunk_size, files=files)
     else:
-        x = sf.read(path, dtype='float32')[0]
+        x = read_audio(path, files=files)
         pad = np.zeros([chunk_size - length, 2])
         x = np.concatenate([x, pad])
     # Mono fix
@@ -34,6 +81,24 @@ def load_chunk(path, length, chunk_size, offset=None):
     return x.T
 
 
+# Formats where frame count in header can be an estimate (length is taken from full decode)
+DECODE_LENGTH_FORMATS = {'MP3', 'MPEG'}
+
+
+def get_audio_length(path):
+    """
+    Number of frames in audio file. It's read from file header without decoding audio,
+    full decode is used only for formats with unreliable or broken headers.
+    """
+    try:
+        info = sf.info(path)
+        if info.format not in DECODE_LENGTH_FORMATS and info.frames > 0:
+            return info.frames
+    except RuntimeError:
+        pass
+    return len(sf.read(path)[0])
+
+
 def get_track_set_length(params):
     path, instruments, file_types = params
     # Check lengths of all instruments (it can be different in some cases)
@@ -43,7 +108,7 @@ def get_track_set_length(params):
         for extension in file_types:
             path_to_audio_file = path + '/{}.{}'.format(instr, extension)
             if os.path.isfile(path_to_audio_file):
-                length = len(sf.read(path_to_audio_file)[0])
+                length = get_audio_length(path_to_audio_file)
                 break
         if length == -1:
             print('Cant find file "{}" in folder {}'.format(instr, path))
@@ -63,15 +128,334 @@ def get_track_set_length(params):
 # For multiprocessing
 def get_track_length(params):
     path = params
-    length = len(sf.read(path)[0])
+    length = get_audio_length(path)
     return (path, length)
 
 
+def get_file_signature(path):
+    # Size and modification time, file is re-read if any of them changed
+    st = os.stat(path)
+    return '{}:{}'.format(st.st_size, st.st_mtime_ns)
+
+
+def get_track_set_signature(path, instruments, file_types):
+    parts = []
+    for instr in instruments:
+        signature = '-'
+        for extension in file_types:
+            path_to_audio_file = path + '/{}.{}'.format(instr, extension)
+            if os.path.isfile(path_to_audio_file):
+                signature = '{}:{}'.format(extension, get_file_signature(path_to_audio_file))
+                break
+        parts.append(signature)
+    return ';'.join(parts)
+
+
+def get_stem_files(path, instruments, signature):
+    """
+    Stem files of track folder (None for missing stems). Extensions are taken from track signature,
+    so there are no filesystem probes.
+    """
+    files = dict()
+    for instr, part in zip(instruments, signature.split(';')):
+        extension = part.split(':')[0]
+        files[instr] = None if extension == '-' else path + '/{}.{}'.format(instr, extension)
+    return files
+
+
+# Step (in frames) of grid on which chunks are checked for activity index
+ACTIVITY_BLOCK = 4096
+
+
+def get_active_ranges(audio, chunk_size, min_mean_abs, block=ACTIVITY_BLOCK):
+    """
+    Ranges [start, end) of chunk offsets where chunk isn't quiet (mean absolute value >= min_mean_abs).
+    Chunk means are computed for offsets on grid with step `block`, every valid grid offset gives range
+    of `block` offsets after it. Result is int64 array with shape (ranges, 2).
+    """
+    channels, length = audio.shape
+    if length <= chunk_size:
+        # Chunk is the whole track padded with zeros
+        if np.abs(audio).sum() / (channels * chunk_size) >= min_mean_abs:
+            return np.array([[0, 1]], dtype=np.int64)
+        return np.zeros((0, 2), dtype=np.int64)
+    n_blocks = length // block
+    sums = np.abs(audio[:, :n_blocks * block]).reshape(channels, n_blocks, block).sum(axis=(0, 2), dtype=np.float64)
+    sums = np.concatenate([[0], np.cumsum(sums)])
+    chunk_blocks = max(chunk_size // block, 1)
+    starts = np.arange((length - chunk_size) // block + 1)
+    ends = np.minimum(starts + chunk_blocks, n_blocks)
+    means = (sums[ends] - sums[starts]) / (channels * (ends - starts) * block)
+    valid = means >= min_mean_abs
+    # Merge neighbour valid grid offsets into ranges
+    edges = np.diff(np.concatenate([[False], valid, [False]]).astype(np.int8))
+    ranges = np.stack([np.where(edges == 1)[0], np.where(edges == -1)[0]], axis=1) * block
+    ranges[:, 1] = np.minimum(ranges[:, 1], length - chunk_size + 1)
+    return ranges.astype(np.int64)
+
+
+def sample_offset(ranges, rng):
+    # Uniform offset from union of ranges (rng - numpy random generator)
+    lengths = ranges[:, 1] - ranges[:, 0]
+    cumulative = np.cumsum(lengths)
+    pos = rng.integers(cumulative[-1])
+    i = np.searchsorted(cumulative, pos, side='right')
+    return int(ranges[i, 1] - (cumulative[i] - pos))
+
+
+def read_packed_stem(shard, track, instr):
+    """
+    View (2, length) of stem in memory-mapped shard of packed dataset and scale to float values.
+    """
+    shard_path, shard_offset, length, pack = track
+    n_stems = len(pack['instruments'])
+    stems = shard[shard_offset:shard_offset + n_stems * 2 * length].reshape(n_stems, 2, length)
+    scale = 1 / 32768 if pack['dtype'] == 'int16' else 1.0
+    return stems[pack['instruments'].index(instr)], scale
+
+
+def get_packed_stem_ranges(track, instr, offset, frames):
+    """
+    Ranges (first element, number of elements) of both channels of stem chunk in shard of packed dataset
+    and scale to float values. Used for shards in object storage, where only these elements are downloaded.
+    """
+    shard_path, shard_offset, length, pack = track
+    start = shard_offset + pack['instruments'].index(instr) * 2 * length + offset
+    scale = 1 / 32768 if pack['dtype'] == 'int16' else 1.0
+    return [(start, frames), (start + length, frames)], scale
+
+
+# For multiprocessing
+def get_stem_activity(params):
+    source, length, chunk_size, min_mean_abs = params
+    if isinstance(source, str):
+        audio = sf.read(source, dtype='float32', frames=length, always_2d=True)[0].T
+    else:
+        track, instr, storage = source
+        if is_remote_path(track[0]):
+            ranges, scale = get_packed_stem_ranges(track, instr, 0, length)
+            audio = np.stack(RemoteShard(storage, track[0]).read(ranges))
+        else:
+            audio, scale = read_packed_stem(np.load(track[0], mmap_mode='r'), track, instr)
+        audio = audio.astype(np.float32) * scale
+    return get_active_ranges(audio, chunk_size, min_mean_abs)
+
+
+# Index file of packed dataset (created with pack_dataset.py)
+PACK_INDEX_NAME = 'index.json'
+PACK_VERSION = 1
+# Augmentations replaced by precomputed pitch/tempo variants of packed dataset (augmentations.packed_variants)
+VARIANT_AUGMENTATIONS = ['pitch_shift', 'time_stretch', 'pedalboard_pitch_shift']
+
+
+def read_packed_metadata(path, instruments, sample_rate=None, storage=None):
+    """
+    Tracks of packed dataset as list of (shard path, offset in shard, length, pack description) and
+    precomputed pitch/tempo variants of them as dict track key -> list of variant tracks.
+    Dataset can be in object storage (path s3://bucket/prefix), then storage is used to read index.
+    """
+    if is_remote_path(path):
+        index = json.loads(storage.read(join_path(path, PACK_INDEX_NAME)))
+    else:
+        with open(os.path.join(path, PACK_INDEX_NAME)) as f:
+            index = json.load(f)
+    if index['version'] != PACK_VERSION:
+        print('Unsupported packed dataset version {} in {}. Repack it with pack_dataset.py'.format(index['version'], path))
+        exit()
+    missing = [instr for instr in instruments if instr not in index['instruments']]
+    if len(missing) > 0:
+        print('Packed dataset {} has no stems: {}'.format(path, missing))
+        exit()
+    if sample_rate is not None and index['sample_rate'] is not None and index['sample_rate'] != sample_rate:
+        print('Packed dataset {} has sample rate {}, but {} is set in config. Repack it with pack_dataset.py'.format(
+            path, index['sample_rate'], sample_rate))
+        exit()
+    pack = {'dtype': index['dtype'], 'instruments': index['instruments']}
+    shards = [join_path(path, name) for name in index['shards']]
+    tracks = [(shards[t['shard']], t['offset'], t['length'], pack) for t in index['tracks']]
+    metadata = []
+    variants = dict()
+    for t, track in zip(index['tracks'], tracks):
+        if 'variant_of' in t:
+            original = tracks[t['variant_of']]
+            variants.setdefault((original[0], original[1]), []).append(track)
+        else:
+            metadata.append(track)
+    return metadata, variants
+
+
+def get_sample_seed(seed, epoch, index):
+    """
+    Seed of random generators for one training sample. It depends only on (seed, epoch, index), not on
+    dataloader worker or previous samples, so any sample can be reproduced.
+    """
+    return int(np.random.SeedSequence([seed, epoch, index]).generate_state(1)[0])
+
+
+def get_batch_seed(seed, epoch, step, process_index=0):
+    """
+    Seed of random generator for batch augmentations on training device at one training step (of one process
+    in distributed training). Streams are independent of sample seeds from get_sample_seed.
+    """
+    return int(np.random.SeedSequence([seed, epoch, step, process_index + 1]).generate_state(1)[0])
+
+
+class SampleRandom:
+    """
+    Random generators of one training sample made from its seed: random.Random and numpy generator for
+    augmentations, torch generator for batch augmentations in collate_fn and numpy generator for every stem,
+    which chooses tracks and offsets of chunks of this stem. Every stem has own stream, so its first chunk
+    is known before loading (see MSSDataset.plan_sample). Global random states aren't used.
+    """
+    def __init__(self, seed, n_stems):
+        self.rng = random.Random(seed)
+        streams = np.random.SeedSequence(seed).spawn(n_stems + 1)
+        self.np_rng = np.random.default_rng(streams[0])
+        self.stem_rngs = [np.random.default_rng(stream) for stream in streams[1:]]
+        self.generator = torch.Generator().manual_seed(seed)
+        # Track of aligned dataset types (4 and 6) and first chunk of every stem: instr -> (track, offset)
+        self.track = None
+        self.planned = dict()
+
+
+@contextlib.contextmanager
+def seeded_global_random(rng):
+    """
+    Global random and numpy random states are seeded from rng inside the block and restored after it.
+    Audiomentations transforms draw their parameters from global states.
+    """
+    states = random.getstate(), np.random.get_state()
+    seed = rng.getrandbits(32)
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+
+
+class SeekableSampler(torch.utils.data.Sampler):
+    """
+    Sequential indices of training samples, first epoch can start from given position. With deterministic
+    sampling content of sample is defined by its index, so shuffle isn't needed and training can be
+    continued from any step with the same data.
+    """
+    def __init__(self, dataset, start=0):
+        self.length = len(dataset)
+        self.start = start
+
+    def __iter__(self):
+        # Start position is used only once (for epoch where training was stopped)
+        start, self.start = self.start, 0
+        return iter(range(start, self.length))
+
+    def __len__(self):
+        return self.length - self.start
+
+
+class MetadataIndex:
+    """
+    Track lengths stored in sqlite database. Rows are keyed on dataset type, instrument and path
+    and keep signature (size and mtime) of audio files, so replaced files are detected and re-read.
+    New rows are written in batches while metadata is collected, so interrupted collection isn't lost.
+    Database is in WAL mode: many processes can read it at the same time.
+    """
+    version = 2
+
+    def __init__(self, path, verbose=True, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = []
+        self.activity_rows = []
+        self.conn = None
+        if os.path.isfile(path) and verbose:
+            print('Found metadata cache file: {}'.format(path))
+        try:
+            self.connect()
+        except sqlite3.DatabaseError:
+            # Old pickle metadata or broken file. It has no file signatures, so it's rebuilt
+            print('Metadata cache file {} has unknown format. It will be recreated.'.format(path))
+            # File can't be removed while it's open on Windows
+            if self.conn is not None:
+                self.conn.close()
+            os.remove(path)
+            self.connect()
+
+    def connect(self):
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] != self.version:
+            self.conn.execute('DROP TABLE IF EXISTS tracks')
+            self.conn.execute('DROP TABLE IF EXISTS activity')
+            self.conn.execute('PRAGMA user_version = {}'.format(self.version))
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS tracks ('
+            'dataset_type INTEGER, instr TEXT, path TEXT, signature TEXT, length INTEGER, '
+            'PRIMARY KEY (dataset_type, instr, path))'
+        )
+        # Ranges of not quiet chunk offsets for every stem (see get_active_ranges), stored as int64 bytes
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS activity ('
+            'path TEXT, chunk_size INTEGER, min_mean_abs REAL, signature TEXT, ranges BLOB, '
+            'PRIMARY KEY (path, chunk_size, min_mean_abs))'
+        )
+        self.conn.commit()
+
+    def load(self, dataset_type, instr=None):
+        rows = self.conn.execute(
+            'SELECT path, signature, length FROM tracks WHERE dataset_type = ? AND instr = ?',
+            (dataset_type, instr or '')
+        )
+        return {path: (signature, length) for path, signature, length in rows}
+
+    def add(self, dataset_type, instr, path, signature, length):
+        self.rows.append((dataset_type, instr or '', path, signature, int(length)))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def load_activity(self, chunk_size, min_mean_abs):
+        rows = self.conn.execute(
+            'SELECT path, signature, ranges FROM activity WHERE chunk_size = ? AND min_mean_abs = ?',
+            (chunk_size, float(min_mean_abs))
+        )
+        return {
+            path: (signature, np.frombuffer(ranges, dtype=np.int64).reshape(-1, 2))
+            for path, signature, ranges in rows
+        }
+
+    def add_activity(self, path, chunk_size, min_mean_abs, signature, ranges):
+        self.activity_rows.append((path, chunk_size, float(min_mean_abs), signature, ranges.astype(np.int64).tobytes()))
+        if len(self.activity_rows) >= self.batch_size:
+            self.flush()
+
+    def delete(self, dataset_type, instr, paths):
+        self.conn.executemany(
+            'DELETE FROM tracks WHERE dataset_type = ? AND instr = ? AND path = ?',
+            [(dataset_type, instr or '', path) for path in paths]
+        )
+        self.conn.commit()
+
+    def flush(self):
+        if len(self.rows) > 0:
+            self.conn.executemany('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)', self.rows)
+            self.conn.commit()
+            self.rows = []
+        if len(self.activity_rows) > 0:
+            self.conn.executemany('INSERT OR REPLACE INTO activity VALUES (?, ?, ?, ?, ?)', self.activity_rows)
+            self.conn.commit()
+            self.activity_rows = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
 class MSSDataset(torch.utils.data.Dataset):
-    def __init__(self, config, data_path, metadata_path="metadata.pkl", dataset_type=1, batch_size=None, verbose=True):
+    def __init__(self, config, data_path, metadata_path="metadata.db", dataset_type=1, batch_size=None, verbose=True, seed=None):
         self.verbose = verbose
         self.config = config
-        self.dataset_type = dataset_type # 1, 2, 3 or 4
+        self.dataset_type = dataset_type # 1, 2, 3, 4, 5 or 6
         self.data_path = data_path
         self.instruments = instruments = config.training.instruments
         if batch_size is None:
@@ -79,6 +463,38 @@ class MSSDataset(torch.utils.data.Dataset):
         self.batch_size = batch_size
         self.file_types = ['wav', 'flac']
         self.metadata_path = metadata_path
+        # Deterministic sampling: random generators of every sample are made from (seed, epoch, index)
+        self.seed = seed
+        self.epoch = 0
+        # Random generators of sample which is loaded now (SampleRandom) and chunks read ahead for batch
+        self.sample = None
+        self.prefetched = dict()
+        # Memory-mapped shards of packed dataset (types 5 and 6), opened lazily in every worker
+        self.packed_shards = dict()
+        # Precomputed pitch/tempo variants of packed tracks: track key -> variants, variant key -> original track
+        self.packed_variants = dict()
+        self.packed_originals = dict()
+        # Packed datasets (types 5 and 6) can be in S3-compatible object storage: --data_path s3://bucket/prefix
+        self.remote = None
+        data_paths = data_path if type(data_path) == list else [data_path]
+        if any(is_remote_path(path) for path in data_paths):
+            if dataset_type not in [5, 6]:
+                print('Datasets in object storage are supported only for types 5 and 6 (packed with pack_dataset.py)')
+                exit()
+            self.remote = RemoteStorage(
+                endpoint_url=config.training.get('remote_endpoint_url', None),
+                cache_path=config.training.get('remote_cache_path', os.path.join(os.path.dirname(metadata_path), 'remote_cache')),
+                cache_size=float(config.training.get('remote_cache_size', 20.0)),
+                block_size=float(config.training.get('remote_block_size', 1.0)),
+                threads=int(config.training.get('remote_threads', 8)),
+            )
+        # Stem files of every track folder (types 1 and 4): track path -> instr -> file path or None
+        self.stem_files = dict()
+        # Tracks which have file of stem (types 1 and 4): instr -> list of tracks
+        self.stem_tracks = dict()
+        # Open audio files reused between chunks (every dataloader worker has own pool)
+        self.max_open_files = int(config.training.get('max_open_files', 32))
+        self.audio_files = AudioFilePool(self.max_open_files) if self.max_open_files > 0 else None
 
         # Augmentation block
         self.aug = False
@@ -90,10 +506,30 @@ class MSSDataset(torch.utils.data.Dataset):
         else:
             if self.verbose:
                 print('There is no augmentations block in config. Augmentations disabled for training...')
+        # Cheap augmentations are applied to whole batches (see batch_augmentations.py)
+        self.batch_aug = self.aug and config['augmentations'].get('batch_augmentations', False)
+        if self.batch_aug and self.verbose:
+            print('Use batch augmentations: {}'.format(', '.join(BATCH_AUGMENTATIONS + ['loudness'])))
+        # Dataloader returns only stems (optionally in float16), mixture is made on training device. Loudness
+        # and mixup are done there too (see batch_augmentations.py), so host to device transfer is halved
+        self.mix_on_device = config.training.get('mix_on_device', False)
+        self.stems_fp16 = config.training.get('stems_fp16', False)
+        if self.mix_on_device and self.verbose:
+            print('Mixture is made on training device, dataloader returns only stems{}'.format(' (float16)' if self.stems_fp16 else ''))
+            if self.aug and 'mp3_compression_on_mixture' in config['augmentations']:
+                print('Warning: mp3_compression_on_mixture is not applied with mix_on_device')
+        # Augmentation processors reused between calls (every dataloader worker has own copy)
+        self.augm_pool = dict()
+        # Time of every augmentation, reported every profile_every samples
+        self.augm_profile = None
+        if self.aug and config['augmentations'].get('profile', False):
+            self.augm_profile = dict()
+            self.augm_profile_samples = 0
+            self.augm_profile_every = config['augmentations'].get('profile_every', 1000)
 
         metadata = self.get_metadata()
 
-        if self.dataset_type in [1, 4]:
+        if self.dataset_type in [1, 4, 5, 6]:
             if len(metadata) > 0:
                 if self.verbose:
                     print('Found tracks in dataset: {}'.format(len(metadata)))
@@ -106,34 +542,63 @@ class MSSDataset(torch.utils.data.Dataset):
                     print('Found tracks for {} in dataset: {}'.format(instr, len(metadata[instr])))
         self.metadata = metadata
         self.chunk_size = config.audio.chunk_size
+
+        # Probability to sample precomputed variant of packed track instead of original. Live pitch shift
+        # and time stretch are disabled then, they are replaced by variants
+        self.variant_prob = 0.0
+        if self.aug and self.dataset_type in [5, 6]:
+            self.variant_prob = float(config['augmentations'].get('packed_variants', 0))
+            if self.variant_prob > 0 and len(self.packed_variants) == 0:
+                print('Packed dataset has no precomputed variants, packed_variants is ignored')
+                self.variant_prob = 0.0
+            elif self.variant_prob > 0 and self.verbose:
+                print('Use precomputed variants of {} tracks instead of: {}'.format(
+                    len(self.packed_variants), ', '.join(VARIANT_AUGMENTATIONS)
+                ))
         self.min_mean_abs = config.audio.min_mean_abs
+        self.activity, self.active_tracks = self.get_activity_index()
 
     def __len__(self):
         return self.config.training.num_steps * self.batch_size
 
-    def read_from_metadata_cache(self, track_paths, instr=None):
+    def set_epoch(self, epoch):
+        # Must be called before every epoch (dataloader workers get copy of dataset when epoch starts)
+        self.epoch = epoch
+
+    def __getstate__(self):
+        # Memory maps must not be pickled into dataloader workers (it copies their data)
+        state = self.__dict__.copy()
+        state['packed_shards'] = dict()
+        # Open files can't be pickled, workers open their own
+        state['audio_files'] = AudioFilePool(self.max_open_files) if self.max_open_files > 0 else None
+        # Pedalboard plugins can't be pickled, workers create their own
+        state['augm_pool'] = dict()
+        state['sample'] = None
+        state['prefetched'] = dict()
+        return state
+
+    def read_from_metadata_cache(self, index, track_paths, signatures, instr=None):
+        """
+        Split tracks into ones with valid length in metadata index and ones which must be (re)read.
+        Tracks are valid if size and mtime of their files didn't change. Rows of deleted files are dropped.
+        """
+        cached = index.load(self.dataset_type, instr)
         metadata = []
-        if os.path.isfile(self.metadata_path):
-            if self.verbose:
-                print('Found metadata cache file: {}'.format(self.metadata_path))
-            old_metadata = pickle.load(open(self.metadata_path, 'rb'))
-        else:
-            return track_paths, metadata
-
-        if instr:
-            old_metadata = old_metadata[instr]
-
-        # We will not re-read tracks existed in old metadata file
-        track_paths_set = set(track_paths)
-        for old_path, file_size in old_metadata:
-            if old_path in track_paths_set:
-                metadata.append([old_path, file_size])
-                track_paths_set.remove(old_path)
-        track_paths = list(track_paths_set)
-        if len(metadata) > 0:
+        new_track_paths = []
+        for path in track_paths:
+            row = cached.get(path)
+            if row is not None and row[0] == signatures[path]:
+                metadata.append((path, row[1]))
+            else:
+                new_track_paths.append(path)
+        deleted = [path for path in cached if path not in signatures and not os.path.exists(path)]
+        index.delete(self.dataset_type, instr, deleted)
+        if len(metadata) > 0 and self.verbose:
             print('Old metadata was used for {} tracks.'.format(len(metadata)))
-        return track_paths, metadata
-
+        changed = len([path for path in new_track_paths if path in cached])
+        if (changed > 0 or len(deleted) > 0) and self.verbose:
+            print('Changed tracks: {} Deleted tracks: {}'.format(changed, len(deleted)))
+        return new_track_paths, metadata
 
     def get_metadata(self):
         read_metadata_procs = multiprocessing.cpu_count()
@@ -147,6 +612,22 @@ class MSSDataset(torch.utils.data.Dataset):
                 '\nCollecting metadata for', str(self.data_path),
             )
 
+        if self.dataset_type in [5, 6]:
+            # Packed dataset has own index with lengths, nothing to read from audio
+            metadata = []
+            data_paths = self.data_path if type(self.data_path) == list else [self.data_path]
+            for path in data_paths:
+                tracks, variants = read_packed_metadata(path, self.instruments, self.config.audio.get('sample_rate', 44100), self.remote)
+                metadata += tracks
+                self.packed_variants.update(variants)
+            originals = {self.get_track_key(t): t for t in metadata}
+            for key, variants in self.packed_variants.items():
+                for variant in variants:
+                    self.packed_originals[self.get_track_key(variant)] = originals[key]
+            return metadata
+
+        index = MetadataIndex(self.metadata_path, verbose=self.verbose)
+
         if self.dataset_type in [1, 4]:
             track_paths = []
             if type(self.data_path) == list:
@@ -159,12 +640,14 @@ class MSSDataset(torch.utils.data.Dataset):
                 track_paths += sorted(glob(self.data_path + '/*'))
 
             track_paths = [path for path in track_paths if os.path.basename(path)[0] != '.' and os.path.isdir(path)]
-            track_paths, metadata = self.read_from_metadata_cache(track_paths, None)
+            signatures = {path: get_track_set_signature(path, self.instruments, self.file_types) for path in track_paths}
+            track_paths, metadata = self.read_from_metadata_cache(index, track_paths, signatures, None)
 
             if read_metadata_procs <= 1:
                 for path in tqdm(track_paths):
                     track_path, track_length = get_track_set_length((path, self.instruments, self.file_types))
                     metadata.append((track_path, track_length))
+                    index.add(self.dataset_type, None, track_path, signatures[track_path], track_length)
             else:
                 p = multiprocessing.Pool(processes=read_metadata_procs)
                 with tqdm(total=len(track_paths)) as pbar:
@@ -174,8 +657,17 @@ class MSSDataset(torch.utils.data.Dataset):
                     )
                     for track_path, track_length in track_iter:
                         metadata.append((track_path, track_length))
+                        index.add(self.dataset_type, None, track_path, signatures[track_path], track_length)
                         pbar.update()
                 p.close()
+            self.stem_files = {path: get_stem_files(path, self.instruments, signatures[path]) for path, _ in metadata}
+            # Tracks which have file of stem. Stem without files in all tracks can't be sampled
+            for instr in self.instruments:
+                self.stem_tracks[instr] = [track for track in metadata if self.stem_files[track[0]][instr] is not None]
+                if len(metadata) > 0 and len(self.stem_tracks[instr]) == 0:
+                    print('No files for stem \'{}\' in any track of dataset. '
+                          'Check instruments in config and names of files!'.format(instr))
+                    exit()
 
         elif self.dataset_type == 2:
             metadata = dict()
@@ -190,16 +682,20 @@ class MSSDataset(torch.utils.data.Dataset):
                     track_paths += sorted(glob(self.data_path + '/{}/*.wav'.format(instr)))
                     track_paths += sorted(glob(self.data_path + '/{}/*.flac'.format(instr)))
 
-                track_paths, metadata[instr] = self.read_from_metadata_cache(track_paths, instr)
+                signatures = {path: get_file_signature(path) for path in track_paths}
+                track_paths, metadata[instr] = self.read_from_metadata_cache(index, track_paths, signatures, instr)
 
                 if read_metadata_procs <= 1:
                     for path in tqdm(track_paths):
-                        length = len(sf.read(path)[0])
+                        length = get_audio_length(path)
                         metadata[instr].append((path, length))
+                        index.add(self.dataset_type, instr, path, signatures[path], length)
                 else:
                     p = multiprocessing.Pool(processes=read_metadata_procs)
-                    for out in tqdm(p.imap(get_track_length, track_paths), total=len(track_paths)):
-                        metadata[instr].append(out)
+                    for path, length in tqdm(p.imap(get_track_length, track_paths), total=len(track_paths)):
+                        metadata[instr].append((path, length))
+                        index.add(self.dataset_type, instr, path, signatures[path], length)
+                    p.close()
 
         elif self.dataset_type == 3:
             import pandas as pd
@@ -215,59 +711,287 @@ class MSSDataset(torch.utils.data.Dataset):
                 skipped = 0
                 for instr in self.instruments:
                     part = df[df['instrum'] == instr].copy()
-                    print('Tracks found for {}: {}'.format(instr, len(part)))
+                    if self.verbose:
+                        print('Tracks found for {}: {}'.format(instr, len(part)))
                 for instr in self.instruments:
                     part = df[df['instrum'] == instr].copy()
                     metadata[instr] = []
-                    track_paths = list(part['path'].values)
-                    track_paths, metadata[instr] = self.read_from_metadata_cache(track_paths, instr)
-
-                    for path in tqdm(track_paths):
+                    track_paths = []
+                    for path in part['path'].values:
                         if not os.path.isfile(path):
                             print('Cant find track: {}'.format(path))
                             skipped += 1
                             continue
+                        track_paths.append(path)
+                    signatures = {path: get_file_signature(path) for path in track_paths}
+                    track_paths, metadata[instr] = self.read_from_metadata_cache(index, track_paths, signatures, instr)
+
+                    for path in tqdm(track_paths):
                         # print(path)
                         try:
-                            length = len(sf.read(path)[0])
+                            length = get_audio_length(path)
                         except:
                             print('Problem with path: {}'.format(path))
                             skipped += 1
                             continue
                         metadata[instr].append((path, length))
+                        index.add(self.dataset_type, instr, path, signatures[path], length)
                 if skipped > 0:
                     print('Missing tracks: {} from {}'.format(skipped, len(df)))
         else:
-            print('Unknown dataset type: {}. Must be 1, 2, 3 or 4'.format(self.dataset_type))
+            print('Unknown dataset type: {}. Must be 1, 2, 3, 4, 5 or 6'.format(self.dataset_type))
             exit()
 
-        # Save metadata
-        pickle.dump(metadata, open(self.metadata_path, 'wb'))
+        # Write rows which are left in buffer
+        index.close()
         return metadata
 
-    def load_source(self, metadata, instr):
-        while True:
-            if self.dataset_type in [1, 4]:
-                track_path, track_length = random.choice(metadata)
-                for extension in self.file_types:
-                    path_to_audio_file = track_path + '/{}.{}'.format(instr, extension)
-                    if os.path.isfile(path_to_audio_file):
-                        try:
-                            source = load_chunk(path_to_audio_file, track_length, self.chunk_size)
-                        except Exception as e:
-                            # Sometimes error during FLAC reading, catch it and use zero stem
-                            print('Error: {} Path: {}'.format(e, path_to_audio_file))
-                            source = np.zeros((2, self.chunk_size), dtype=np.float32)
-                        break
+    def get_tracks(self, instr):
+        if self.dataset_type in [2, 3]:
+            return self.metadata[instr]
+        if self.dataset_type == 1:
+            return self.stem_tracks[instr]
+        return self.metadata
+
+    def get_track_key(self, track):
+        if self.dataset_type in [5, 6]:
+            return track[0], track[1]
+        return track[0]
+
+    def get_activity_index(self):
+        """
+        Ranges of chunk offsets where every stem isn't quiet (mean absolute value >= min_mean_abs). It requires
+        decoding of all audio, so it's enabled with training.activity_index and stored in metadata index:
+        only new or changed files are processed. Sampling takes offsets from these ranges, so quiet chunks
+        are almost never read and rejected. Tracks without active chunks of stem aren't used for this stem.
+        :return: ranges as dict instr -> track key -> array, dict instr -> list of tracks with active chunks
+        """
+        if not self.config.training.get('activity_index', False) or self.min_mean_abs <= 0:
+            return None, None
+
+        read_metadata_procs = int(self.config.training.get('read_metadata_procs', multiprocessing.cpu_count()))
+        index = MetadataIndex(self.metadata_path, verbose=False)
+        cached = index.load_activity(self.chunk_size, self.min_mean_abs)
+        activity = {instr: dict() for instr in self.instruments}
+        tasks = []
+        for instr in self.instruments:
+            for track in self.get_tracks(instr):
+                if self.dataset_type in [5, 6]:
+                    # Stem inside shard of packed dataset
+                    path = '{}:{}:{}'.format(track[0], track[1], instr)
+                    if is_remote_path(track[0]):
+                        signature = self.remote.signature(track[0])
+                    else:
+                        signature = get_file_signature(track[0])
+                    source = (track, instr, self.remote)
+                    length = track[2]
+                else:
+                    if self.dataset_type in [2, 3]:
+                        path = track[0]
+                    else:
+                        path = self.stem_files[track[0]][instr]
+                        if path is None:
+                            continue
+                    signature = get_file_signature(path)
+                    source = path
+                    length = track[1]
+                row = cached.get(path)
+                if row is not None and row[0] == signature:
+                    activity[instr][self.get_track_key(track)] = row[1]
+                else:
+                    params = (source, length, self.chunk_size, self.min_mean_abs)
+                    tasks.append((instr, track, path, signature, params))
+
+        if len(tasks) > 0:
+            if self.verbose:
+                print('Computing activity index for {} stems'.format(len(tasks)))
+            if read_metadata_procs <= 1:
+                ranges_iter = map(get_stem_activity, [task[-1] for task in tasks])
+            else:
+                p = multiprocessing.Pool(processes=read_metadata_procs)
+                ranges_iter = p.imap(get_stem_activity, [task[-1] for task in tasks])
+            for (instr, track, path, signature, _), ranges in tqdm(zip(tasks, ranges_iter), total=len(tasks)):
+                activity[instr][self.get_track_key(track)] = ranges
+                index.add_activity(path, self.chunk_size, self.min_mean_abs, signature, ranges)
+            if read_metadata_procs > 1:
+                p.close()
+        index.close()
+
+        active_tracks = dict()
+        for instr in self.instruments:
+            tracks = self.get_tracks(instr)
+            active_tracks[instr] = [t for t in tracks if len(activity[instr].get(self.get_track_key(t), [])) > 0]
+            if self.verbose:
+                print('Tracks with active chunks for {}: {} from {}'.format(instr, len(active_tracks[instr]), len(tracks)))
+            if len(active_tracks[instr]) == 0:
+                active_tracks[instr] = tracks
+        return activity, active_tracks
+
+    def get_offset(self, track, instr, rng):
+        # Random offset of not quiet chunk from activity index (None - there is no activity index for stem)
+        if self.activity is None:
+            return None
+        # Variants of packed tracks use activity of original track
+        original = self.packed_originals.get(self.get_track_key(track), track)
+        ranges = self.activity[instr].get(self.get_track_key(original))
+        if ranges is None or len(ranges) == 0:
+            return None
+        offset = sample_offset(ranges, rng)
+        if original is not track:
+            # Time stretched variant: position is scaled by ratio of lengths
+            offset = min(int(offset * track[2] / original[2]), max(track[2] - self.chunk_size, 0))
+        return offset
+
+    def choose_offset(self, track, instr, rng):
+        # Offset of chunk: from activity index or uniform (0 if track is shorter than chunk)
+        offset = self.get_offset(track, instr, rng)
+        if offset is None:
+            length = track[2] if self.dataset_type in [5, 6] else track[1]
+            offset = int(rng.integers(length - self.chunk_size + 1)) if self.chunk_size <= length else 0
+        return offset
+
+    def is_quiet_stem(self, track, instr):
+        # Stem has no chunks above threshold according to activity index, so there is no reason to retry
+        if self.activity is None:
+            return False
+        original = self.packed_originals.get(self.get_track_key(track), track)
+        ranges = self.activity[instr].get(self.get_track_key(original))
+        return ranges is not None and len(ranges) == 0
+
+    def get_packed_variant(self, track, rng):
+        # Precomputed pitch/tempo variant of packed track with probability augmentations.packed_variants
+        if self.variant_prob > 0 and rng.random() < self.variant_prob:
+            variants = self.packed_variants.get(self.get_track_key(track))
+            if variants is not None:
+                return variants[rng.integers(len(variants))]
+        return track
+
+    def choose_chunk(self, instr, rng):
+        # Track and offset of chunk of stem for dataset types with random mixes (1, 2, 3 and 5)
+        if self.active_tracks is not None:
+            # Only tracks where stem has not quiet chunks
+            tracks = self.active_tracks[instr]
+        else:
+            tracks = self.get_tracks(instr)
+        track = tracks[rng.integers(len(tracks))]
+        if self.dataset_type == 5:
+            track = self.get_packed_variant(track, rng)
+        return track, self.choose_offset(track, instr, rng)
+
+    def plan_sample(self, index):
+        """
+        Random generators of sample and its first chunk of every stem (following chunks depend on loaded
+        data: quiet chunks are rejected, mixup chunks are added randomly). With deterministic sampling the seed
+        depends only on (seed, epoch, index), otherwise it's random.
+        """
+        if self.seed is not None:
+            sample_seed = get_sample_seed(self.seed, self.epoch, index)
+        else:
+            sample_seed = int.from_bytes(os.urandom(4), 'little')
+        sample = SampleRandom(sample_seed, len(self.instruments))
+        if self.dataset_type in [4, 6]:
+            # All stems are from the same position of the same track (variant for packed type 6)
+            track = self.metadata[sample.stem_rngs[0].integers(len(self.metadata))]
+            if self.dataset_type == 6:
+                track = self.get_packed_variant(track, sample.stem_rngs[0])
+            sample.track = track
+            for instr, rng in zip(self.instruments, sample.stem_rngs):
+                if self.dataset_type == 4 and self.stem_files[track[0]][instr] is None:
+                    continue
+                sample.planned[instr] = (track, self.choose_offset(track, instr, rng))
+        else:
+            for instr, rng in zip(self.instruments, sample.stem_rngs):
+                sample.planned[instr] = self.choose_chunk(instr, rng)
+        return sample
+
+    def get_packed_shard(self, path):
+        shard = self.packed_shards.get(path)
+        if shard is None:
+            if is_remote_path(path):
+                shard = RemoteShard(self.remote, path)
             else:
-                track_path, track_length = random.choice(metadata[instr])
-                try:
-                    source = load_chunk(track_path, track_length, self.chunk_size)
-                except Exception as e:
-                    # Sometimes error during FLAC reading, catch it and use zero stem
-                    print('Error: {} Path: {}'.format(e, track_path))
-                    source = np.zeros((2, self.chunk_size), dtype=np.float32)
+                shard = np.load(path, mmap_mode='r')
+            self.packed_shards[path] = shard
+        return shard
+
+    def load_packed_chunk(self, track, instr, offset):
+        # Chunk is slice of memory-mapped shard, only conversion to float32 is done.
+        # From shard in object storage only elements of chunk are downloaded
+        length = track[2]
+        if self.chunk_size <= length:
+            frames = self.chunk_size
+        else:
+            offset, frames = 0, length
+        shard = self.get_packed_shard(track[0])
+        if isinstance(shard, RemoteShard):
+            ranges, scale = get_packed_stem_ranges(track, instr, offset, frames)
+            chunk = np.stack(shard.read(ranges))
+        else:
+            stem, scale = read_packed_stem(shard, track, instr)
+            chunk = stem[:, offset:offset + frames]
+        if frames == self.chunk_size:
+            source = chunk.astype(np.float32)
+        else:
+            source = np.zeros((2, self.chunk_size), dtype=np.float32)
+            source[:, :length] = chunk
+        if scale != 1.0:
+            source *= scale
+        return source
+
+    def get_chunk_position(self, track, instr, offset):
+        # File and position in it where chunk is stored (reads are sorted by it)
+        if self.dataset_type in [5, 6]:
+            return track[0], track[1] + track[3]['instruments'].index(instr) * 2 * track[2] + offset
+        if self.dataset_type in [1, 4]:
+            return self.stem_files[track[0]][instr], offset
+        return track[0], offset
 
+    def load_stem_chunk(self, track, instr, offset):
+        if self.dataset_type in [5, 6]:
+            return self.load_packed_chunk(track, instr, offset)
+        path, _ = self.get_chunk_position(track, instr, offset)
+        try:
+            return load_chunk(path, track[1], self.chunk_size, offset, self.audio_files)
+        except Exception as e:
+            # Sometimes error during FLAC reading, catch it and use zero stem
+            print('Error: {} Path: {}'.format(e, path))
+            return np.zeros((2, self.chunk_size), dtype=np.float32)
+
+    def read_chunk(self, track, instr, offset):
+        # Chunk read ahead by prefetch_chunks or read now
+        source = self.prefetched.pop((self.get_track_key(track), instr, offset), None)
+        if source is None:
+            source = self.load_stem_chunk(track, instr, offset)
+        return source
+
+    def prefetch_chunks(self, samples):
+        """
+        Read planned first chunks of all samples of batch in order of their position in files, so reads of
+        the same file go one after another. Downloads of chunks from object storage are started together.
+        """
+        chunks = dict()
+        for sample in samples:
+            for instr, (track, offset) in sample.planned.items():
+                chunks[(self.get_track_key(track), instr, offset)] = (track, instr, offset)
+        chunks = sorted(chunks.items(), key=lambda item: self.get_chunk_position(*item[1]))
+        if self.remote is not None:
+            for key, (track, instr, offset) in chunks:
+                shard = self.get_packed_shard(track[0])
+                if isinstance(shard, RemoteShard):
+                    frames = min(self.chunk_size, track[2])
+                    offset = offset if self.chunk_size <= track[2] else 0
+                    shard.prefetch(get_packed_stem_ranges(track, instr, offset, frames)[0])
+        for key, chunk in chunks:
+            self.prefetched[key] = self.load_stem_chunk(*chunk)
+
+    def load_source(self, instr):
+        rng = self.sample.stem_rngs[self.instruments.index(instr)]
+        # First chunk was planned (and usually read ahead), next ones are chosen here
+        planned = self.sample.planned.pop(instr, None)
+        while True:
+            track, offset = planned if planned is not None else self.choose_chunk(instr, rng)
+            planned = None
+            source = self.read_chunk(track, instr, offset)
             if np.abs(source).mean() >= self.min_mean_abs:  # remove quiet chunks
                 break
         if self.aug:
@@ -277,18 +1001,18 @@ class MSSDataset(torch.utils.data.Dataset):
     def load_random_mix(self):
         res = []
         for instr in self.instruments:
-            s1 = self.load_source(self.metadata, instr)
-            # Mixup augmentation. Multiple mix of same type of stems
-            if self.aug:
+            s1 = self.load_source(instr)
+            # Mixup augmentation. Multiple mix of same type of stems (with mix_on_device it's done for whole batch)
+            if self.aug and not self.mix_on_device:
                 if 'mixup' in self.config['augmentations']:
                     if self.config['augmentations'].mixup:
                         mixup = [s1]
                         for prob in self.config.augmentations.mixup_probs:
-                            if random.uniform(0, 1) < prob:
-                                s2 = self.load_source(self.metadata, instr)
+                            if self.sample.rng.uniform(0, 1) < prob:
+                                s2 = self.load_source(instr)
                                 mixup.append(s2)
                         mixup = torch.stack(mixup, dim=0)
-                        loud_values = np.random.uniform(
+                        loud_values = self.sample.np_rng.uniform(
                             low=self.config.augmentations.loudness_min,
                             high=self.config.augmentations.loudness_max,
                             size=(len(mixup),)
@@ -301,26 +1025,26 @@ class MSSDataset(torch.utils.data.Dataset):
         return res
 
     def load_aligned_data(self):
-        track_path, track_length = random.choice(self.metadata)
+        # Types 4 and 6: chunks of all stems from the same position of the same track
+        track = self.sample.track
         res = []
-        for i in self.instruments:
-            attempts = 10
+        for instr, rng in zip(self.instruments, self.sample.stem_rngs):
+            if self.dataset_type == 4 and self.stem_files[track[0]][instr] is None:
+                # Track has no file for this stem
+                res.append(np.zeros((2, self.chunk_size), dtype=np.float32))
+                continue
+            quiet_stem = self.is_quiet_stem(track, instr)
+            attempts = 1 if quiet_stem else 10
+            planned = self.sample.planned.pop(instr, None)
             while attempts:
-                for extension in self.file_types:
-                    path_to_audio_file = track_path + '/{}.{}'.format(i, extension)
-                    if os.path.isfile(path_to_audio_file):
-                        try:
-                            source = load_chunk(path_to_audio_file, track_length, self.chunk_size)
-                        except Exception as e:
-                            # Sometimes error during FLAC reading, catch it and use zero stem
-                            print('Error: {} Path: {}'.format(e, path_to_audio_file))
-                            source = np.zeros((2, self.chunk_size), dtype=np.float32)
-                        break
+                offset = planned[1] if planned is not None else self.choose_offset(track, instr, rng)
+                planned = None
+                source = self.read_chunk(track, instr, offset)
                 if np.abs(source).mean() >= self.min_mean_abs:  # remove quiet chunks
                     break
                 attempts -= 1
-                if attempts <= 0:
-                    print('Attempts max!', track_path)
+                if attempts <= 0 and not quiet_stem:
+                    print('Attempts max!', track[0])
             res.append(source)
         res = np.stack(res, axis=0)
         if self.aug:
@@ -328,12 +1052,50 @@ class MSSDataset(torch.utils.data.Dataset):
                 res[i] = self.augm_data(res[i], instr)
         return torch.tensor(res, dtype=torch.float32)
 
+    def get_augm(self, name, instr, create):
+        # Augmentation processors are created once per worker and stem. AU objects randomize their
+        # parameters on every call, parameters of pedalboard plugins are set before every call
+        key = (name, instr)
+        augm = self.augm_pool.get(key)
+        if augm is None:
+            augm = create()
+            self.augm_pool[key] = augm
+        return augm
+
+    def run_augm(self, name, func, *args, **kwargs):
+        # Audiomentations transforms use global random states, with deterministic sampling
+        # they are seeded from random generator of sample
+        start_time = time.perf_counter()
+        with seeded_global_random(self.sample.rng) if self.seed is not None else contextlib.nullcontext():
+            res = func(*args, **kwargs)
+        if self.augm_profile is not None:
+            stat = self.augm_profile.setdefault(name, [0, 0.])
+            stat[0] += 1
+            stat[1] += time.perf_counter() - start_time
+        return res
+
+    def report_augm_profile(self):
+        """
+        Time of every augmentation in this worker: number of calls, time per call and average time per sample.
+        """
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        total = sum(stat[1] for stat in self.augm_profile.values())
+        print('Augmentation profile (worker {}, samples: {}, ms per sample: {:.2f})'.format(
+            worker_id, self.augm_profile_samples, 1000 * total / self.augm_profile_samples
+        ))
+        for name, (calls, spent) in sorted(self.augm_profile.items(), key=lambda x: -x[1][1]):
+            print('  {}: calls: {} ms per call: {:.2f} ms per sample: {:.2f}'.format(
+                name, calls, 1000 * spent / calls, 1000 * spent / self.augm_profile_samples
+            ))
+
     def augm_data(self, source, instr):
         # source.shape = (2, 261120) - first channels, second length
         source_shape = source.shape
         applied_augs = []
+        # Copy: stem overrides must not get into config shared by all stems
         if 'all' in self.config['augmentations']:
-            augs = self.config['augmentations']['all']
+            augs = dict(self.config['augmentations']['all'])
         else:
             augs = dict()
 
@@ -342,91 +1104,98 @@ class MSSDataset(torch.utils.data.Dataset):
             for el in self.config['augmentations'][instr]:
                 augs[el] = self.config['augmentations'][instr][el]
 
+        # These augmentations are done later for whole batch
+        if self.batch_aug:
+            augs = {k: v for k, v in augs.items() if k not in BATCH_AUGMENTATIONS}
+        # Pitch shift and time stretch are replaced by precomputed variants of packed tracks
+        if self.variant_prob > 0:
+            augs = {k: v for k, v in augs.items() if k not in VARIANT_AUGMENTATIONS}
+
         # Channel shuffle
         if 'channel_shuffle' in augs:
             if augs['channel_shuffle'] > 0:
-                if random.uniform(0, 1) < augs['channel_shuffle']:
-                    source = source[::-1].copy()
+                if self.sample.rng.uniform(0, 1) < augs['channel_shuffle']:
+                    source = self.run_augm('channel_shuffle', lambda x: x[::-1].copy(), source)
                     applied_augs.append('channel_shuffle')
         # Random inverse
         if 'random_inverse' in augs:
             if augs['random_inverse'] > 0:
-                if random.uniform(0, 1) < augs['random_inverse']:
-                    source = source[:, ::-1].copy()
+                if self.sample.rng.uniform(0, 1) < augs['random_inverse']:
+                    source = self.run_augm('random_inverse', lambda x: x[:, ::-1].copy(), source)
                     applied_augs.append('random_inverse')
         # Random polarity (multiply -1)
         if 'random_polarity' in augs:
             if augs['random_polarity'] > 0:
-                if random.uniform(0, 1) < augs['random_polarity']:
-                    source = -source.copy()
+                if self.sample.rng.uniform(0, 1) < augs['random_polarity']:
+                    source = self.run_augm('random_polarity', lambda x: -x.copy(), source)
                     applied_augs.append('random_polarity')
         # Random pitch shift
         if 'pitch_shift' in augs:
             if augs['pitch_shift'] > 0:
-                if random.uniform(0, 1) < augs['pitch_shift']:
-                    apply_aug = AU.PitchShift(
+                if self.sample.rng.uniform(0, 1) < augs['pitch_shift']:
+                    apply_aug = self.get_augm('pitch_shift', instr, lambda: AU.PitchShift(
                         min_semitones=augs['pitch_shift_min_semitones'],
                         max_semitones=augs['pitch_shift_max_semitones'],
                         p=1.0
-                    )
-                    source = apply_aug(samples=source, sample_rate=44100)
+                    ))
+                    source = self.run_augm('pitch_shift', apply_aug, samples=source, sample_rate=44100)
                     applied_augs.append('pitch_shift')
         # Random seven band parametric eq
         if 'seven_band_parametric_eq' in augs:
             if augs['seven_band_parametric_eq'] > 0:
-                if random.uniform(0, 1) < augs['seven_band_parametric_eq']:
-                    apply_aug = AU.SevenBandParametricEQ(
+                if self.sample.rng.uniform(0, 1) < augs['seven_band_parametric_eq']:
+                    apply_aug = self.get_augm('seven_band_parametric_eq', instr, lambda: AU.SevenBandParametricEQ(
                         min_gain_db=augs['seven_band_parametric_eq_min_gain_db'],
                         max_gain_db=augs['seven_band_parametric_eq_max_gain_db'],
                         p=1.0
-                    )
-                    source = apply_aug(samples=source, sample_rate=44100)
+                    ))
+                    source = self.run_augm('seven_band_parametric_eq', apply_aug, samples=source, sample_rate=44100)
                     applied_augs.append('seven_band_parametric_eq')
         # Random tanh distortion
         if 'tanh_distortion' in augs:
             if augs['tanh_distortion'] > 0:
-                if random.uniform(0, 1) < augs['tanh_distortion']:
-                    apply_aug = AU.TanhDistortion(
+                if self.sample.rng.uniform(0, 1) < augs['tanh_distortion']:
+                    apply_aug = self.get_augm('tanh_distortion', instr, lambda: AU.TanhDistortion(
                         min_distortion=augs['tanh_distortion_min'],
                         max_distortion=augs['tanh_distortion_max'],
                         p=1.0
-                    )
-                    source = apply_aug(samples=source, sample_rate=44100)
+                    ))
+                    source = self.run_augm('tanh_distortion', apply_aug, samples=source, sample_rate=44100)
                     applied_augs.append('tanh_distortion')
         # Random MP3 Compression
         if 'mp3_compression' in augs:
             if augs['mp3_compression'] > 0:
-                if random.uniform(0, 1) < augs['mp3_compression']:
-                    apply_aug = AU.Mp3Compression(
+                if self.sample.rng.uniform(0, 1) < augs['mp3_compression']:
+                    apply_aug = self.get_augm('mp3_compression', instr, lambda: AU.Mp3Compression(
                         min_bitrate=augs['mp3_compression_min_bitrate'],
                         max_bitrate=augs['mp3_compression_max_bitrate'],
                         backend=augs['mp3_compression_backend'],
                         p=1.0
-                    )
-                    source = apply_aug(samples=source, sample_rate=44100)
+                    ))
+                    source = self.run_augm('mp3_compression', apply_aug, samples=source, sample_rate=44100)
                     applied_augs.append('mp3_compression')
         # Random AddGaussianNoise
         if 'gaussian_noise' in augs:
             if augs['gaussian_noise'] > 0:
-                if random.uniform(0, 1) < augs['gaussian_noise']:
-                    apply_aug = AU.AddGaussianNoise(
+                if self.sample.rng.uniform(0, 1) < augs['gaussian_noise']:
+                    apply_aug = self.get_augm('gaussian_noise', instr, lambda: AU.AddGaussianNoise(
                         min_amplitude=augs['gaussian_noise_min_amplitude'],
                         max_amplitude=augs['gaussian_noise_max_amplitude'],
                         p=1.0
-                    )
-                    source = apply_aug(samples=source, sample_rate=44100)
+                    ))
+                    source = self.run_augm('gaussian_noise', apply_aug, samples=source, sample_rate=44100)
                     applied_augs.append('gaussian_noise')
         # Random TimeStretch
         if 'time_stretch' in augs:
             if augs['time_stretch'] > 0:
-                if random.uniform(0, 1) < augs['time_stretch']:
-                    apply_aug = AU.TimeStretch(
+                if self.sample.rng.uniform(0, 1) < augs['time_stretch']:
+                    apply_aug = self.get_augm('time_stretch', instr, lambda: AU.TimeStretch(
                         min_rate=augs['time_stretch_min_rate'],
                         max_rate=augs['time_stretch_max_rate'],
                         leave_length_unchanged=True,
                         p=1.0
-                    )
-                    source = apply_aug(samples=source, sample_rate=44100)
+                    ))
+                    source = self.run_augm('time_stretch', apply_aug, samples=source, sample_rate=44100)
                     applied_augs.append('time_stretch')
 
         # Possible fix of shape
@@ -436,190 +1205,189 @@ class MSSDataset(torch.utils.data.Dataset):
         # Random Reverb
         if 'pedalboard_reverb' in augs:
             if augs['pedalboard_reverb'] > 0:
-                if random.uniform(0, 1) < augs['pedalboard_reverb']:
-                    room_size = random.uniform(
+                if self.sample.rng.uniform(0, 1) < augs['pedalboard_reverb']:
+                    plugin = self.get_augm('pedalboard_reverb', instr, PB.Reverb)
+                    plugin.room_size = self.sample.rng.uniform(
                         augs['pedalboard_reverb_room_size_min'],
                         augs['pedalboard_reverb_room_size_max'],
-                    )
-                    damping = random.uniform(
+                    )  # 0.1 - 0.9
+                    plugin.damping = self.sample.rng.uniform(
                         augs['pedalboard_reverb_damping_min'],
                         augs['pedalboard_reverb_damping_max'],
-                    )
-                    wet_level = random.uniform(
+                    )  # 0.1 - 0.9
+                    plugin.wet_level = self.sample.rng.uniform(
                         augs['pedalboard_reverb_wet_level_min'],
                         augs['pedalboard_reverb_wet_level_max'],
-                    )
-                    dry_level = random.uniform(
+                    )  # 0.1 - 0.9
+                    plugin.dry_level = self.sample.rng.uniform(
                         augs['pedalboard_reverb_dry_level_min'],
                         augs['pedalboard_reverb_dry_level_max'],
-                    )
-                    width = random.uniform(
+                    )  # 0.1 - 0.9
+                    plugin.width = self.sample.rng.uniform(
                         augs['pedalboard_reverb_width_min'],
                         augs['pedalboard_reverb_width_max'],
-                    )
-                    board = PB.Pedalboard([PB.Reverb(
-                        room_size=room_size,  # 0.1 - 0.9
-                        damping=damping,  # 0.1 - 0.9
-                        wet_level=wet_level,  # 0.1 - 0.9
-                        dry_level=dry_level,  # 0.1 - 0.9
-                        width=width,  # 0.9 - 1.0
-                        freeze_mode=0.0,
-                    )])
-                    source = board(source, 44100)
+                    )  # 0.9 - 1.0
+                    plugin.freeze_mode = 0.0
+                    # Clear internal state (parameter smoothing, tails) left from previous call
+                    plugin.reset()
+                    source = self.run_augm('pedalboard_reverb', plugin, source, 44100)
                     applied_augs.append('pedalboard_reverb')
 
         # Random Chorus
         if 'pedalboard_chorus' in augs:
             if augs['pedalboard_chorus'] > 0:
-                if random.uniform(0, 1) < augs['pedalboard_chorus']:
-                    rate_hz = random.uniform(
+                if self.sample.rng.uniform(0, 1) < augs['pedalboard_chorus']:
+                    plugin = self.get_augm('pedalboard_chorus', instr, PB.Chorus)
+                    plugin.rate_hz = self.sample.rng.uniform(
                         augs['pedalboard_chorus_rate_hz_min'],
                         augs['pedalboard_chorus_rate_hz_max'],
                     )
-                    depth = random.uniform(
+                    plugin.depth = self.sample.rng.uniform(
                         augs['pedalboard_chorus_depth_min'],
                         augs['pedalboard_chorus_depth_max'],
                     )
-                    centre_delay_ms = random.uniform(
+                    plugin.centre_delay_ms = self.sample.rng.uniform(
                         augs['pedalboard_chorus_centre_delay_ms_min'],
                         augs['pedalboard_chorus_centre_delay_ms_max'],
                     )
-                    feedback = random.uniform(
+                    plugin.feedback = self.sample.rng.uniform(
                         augs['pedalboard_chorus_feedback_min'],
                         augs['pedalboard_chorus_feedback_max'],
                     )
-                    mix = random.uniform(
+                    plugin.mix = self.sample.rng.uniform(
                         augs['pedalboard_chorus_mix_min'],
                         augs['pedalboard_chorus_mix_max'],
                     )
-                    board = PB.Pedalboard([PB.Chorus(
-                        rate_hz=rate_hz,
-                        depth=depth,
-                        centre_delay_ms=centre_delay_ms,
-                        feedback=feedback,
-                        mix=mix,
-                    )])
-                    source = board(source, 44100)
+                    plugin.reset()
+                    source = self.run_augm('pedalboard_chorus', plugin, source, 44100)
                     applied_augs.append('pedalboard_chorus')
 
         # Random Phazer
         if 'pedalboard_phazer' in augs:
             if augs['pedalboard_phazer'] > 0:
-                if random.uniform(0, 1) < augs['pedalboard_phazer']:
-                    rate_hz = random.uniform(
+                if self.sample.rng.uniform(0, 1) < augs['pedalboard_phazer']:
+                    plugin = self.get_augm('pedalboard_phazer', instr, PB.Phaser)
+                    plugin.rate_hz = self.sample.rng.uniform(
                         augs['pedalboard_phazer_rate_hz_min'],
                         augs['pedalboard_phazer_rate_hz_max'],
                     )
-                    depth = random.uniform(
+                    plugin.depth = self.sample.rng.uniform(
                         augs['pedalboard_phazer_depth_min'],
                         augs['pedalboard_phazer_depth_max'],
                     )
-                    centre_frequency_hz = random.uniform(
+                    plugin.centre_frequency_hz = self.sample.rng.uniform(
                         augs['pedalboard_phazer_centre_frequency_hz_min'],
                         augs['pedalboard_phazer_centre_frequency_hz_max'],
                     )
-                    feedback = random.uniform(
+                    plugin.feedback = self.sample.rng.uniform(
                         augs['pedalboard_phazer_feedback_min'],
                         augs['pedalboard_phazer_feedback_max'],
                     )
-                    mix = random.uniform(
+                    plugin.mix = self.sample.rng.uniform(
                         augs['pedalboard_phazer_mix_min'],
                         augs['pedalboard_phazer_mix_max'],
                     )
-                    board = PB.Pedalboard([PB.Phaser(
-                        rate_hz=rate_hz,
-                        depth=depth,
-                        centre_frequency_hz=centre_frequency_hz,
-                        feedback=feedback,
-                        mix=mix,
-                    )])
-                    source = board(source, 44100)
+                    plugin.reset()
+                    source = self.run_augm('pedalboard_phazer', plugin, source, 44100)
                     applied_augs.append('pedalboard_phazer')
 
         # Random Distortion
         if 'pedalboard_distortion' in augs:
             if augs['pedalboard_distortion'] > 0:
-                if random.uniform(0, 1) < augs['pedalboard_distortion']:
-                    drive_db = random.uniform(
+                if self.sample.rng.uniform(0, 1) < augs['pedalboard_distortion']:
+                    plugin = self.get_augm('pedalboard_distortion', instr, PB.Distortion)
+                    plugin.drive_db = self.sample.rng.uniform(
                         augs['pedalboard_distortion_drive_db_min'],
                         augs['pedalboard_distortion_drive_db_max'],
                     )
-                    board = PB.Pedalboard([PB.Distortion(
-                        drive_db=drive_db,
-                    )])
-                    source = board(source, 44100)
+                    plugin.reset()
+                    source = self.run_augm('pedalboard_distortion', plugin, source, 44100)
                     applied_augs.append('pedalboard_distortion')
 
         # Random PitchShift
         if 'pedalboard_pitch_shift' in augs:
             if augs['pedalboard_pitch_shift'] > 0:
-                if random.uniform(0, 1) < augs['pedalboard_pitch_shift']:
-                    semitones = random.uniform(
+                if self.sample.rng.uniform(0, 1) < augs['pedalboard_pitch_shift']:
+                    plugin = self.get_augm('pedalboard_pitch_shift', instr, PB.PitchShift)
+                    plugin.semitones = self.sample.rng.uniform(
                         augs['pedalboard_pitch_shift_semitones_min'],
                         augs['pedalboard_pitch_shift_semitones_max'],
                     )
-                    board = PB.Pedalboard([PB.PitchShift(
-                        semitones=semitones
-                    )])
-                    source = board(source, 44100)
+                    plugin.reset()
+                    source = self.run_augm('pedalboard_pitch_shift', plugin, source, 44100)
                     applied_augs.append('pedalboard_pitch_shift')
 
         # Random Resample
         if 'pedalboard_resample' in augs:
             if augs['pedalboard_resample'] > 0:
-                if random.uniform(0, 1) < augs['pedalboard_resample']:
-                    target_sample_rate = random.uniform(
+                if self.sample.rng.uniform(0, 1) < augs['pedalboard_resample']:
+                    plugin = self.get_augm('pedalboard_resample', instr, PB.Resample)
+                    plugin.target_sample_rate = self.sample.rng.uniform(
                         augs['pedalboard_resample_target_sample_rate_min'],
                         augs['pedalboard_resample_target_sample_rate_max'],
                     )
-                    board = PB.Pedalboard([PB.Resample(
-                        target_sample_rate=target_sample_rate
-                    )])
-                    source = board(source, 44100)
+                    plugin.reset()
+                    source = self.run_augm('pedalboard_resample', plugin, source, 44100)
                     applied_augs.append('pedalboard_resample')
 
         # Random Bitcrash
         if 'pedalboard_bitcrash' in augs:
             if augs['pedalboard_bitcrash'] > 0:
-                if random.uniform(0, 1) < augs['pedalboard_bitcrash']:
-                    bit_depth = random.uniform(
+                if self.sample.rng.uniform(0, 1) < augs['pedalboard_bitcrash']:
+                    plugin = self.get_augm('pedalboard_bitcrash', instr, PB.Bitcrush)
+                    plugin.bit_depth = self.sample.rng.uniform(
                         augs['pedalboard_bitcrash_bit_depth_min'],
                         augs['pedalboard_bitcrash_bit_depth_max'],
                     )
-                    board = PB.Pedalboard([PB.Bitcrush(
-                        bit_depth=bit_depth
-                    )])
-                    source = board(source, 44100)
+                    plugin.reset()
+                    source = self.run_augm('pedalboard_bitcrash', plugin, source, 44100)
                     applied_augs.append('pedalboard_bitcrash')
 
         # Random MP3Compressor
         if 'pedalboard_mp3_compressor' in augs:
             if augs['pedalboard_mp3_compressor'] > 0:
-                if random.uniform(0, 1) < augs['pedalboard_mp3_compressor']:
-                    vbr_quality = random.uniform(
+                if self.sample.rng.uniform(0, 1) < augs['pedalboard_mp3_compressor']:
+                    plugin = self.get_augm('pedalboard_mp3_compressor', instr, PB.MP3Compressor)
+                    plugin.vbr_quality = self.sample.rng.uniform(
                         augs['pedalboard_mp3_compressor_pedalboard_mp3_compressor_min'],
                         augs['pedalboard_mp3_compressor_pedalboard_mp3_compressor_max'],
                     )
-                    board = PB.Pedalboard([PB.MP3Compressor(
-                        vbr_quality=vbr_quality
-                    )])
-                    source = board(source, 44100)
+                    plugin.reset()
+                    source = self.run_augm('pedalboard_mp3_compressor', plugin, source, 44100)
                     applied_augs.append('pedalboard_mp3_compressor')
 
         # print(applied_augs)
         return source
 
     def __getitem__(self, index):
-        if self.dataset_type in [1, 2, 3]:
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices):
+        """
+        Samples of batch (DataLoader passes all indices of batch at once). First chunks of all samples are
+        planned and read ahead in order of their position in files.
+        """
+        samples = [self.plan_sample(index) for index in indices]
+        self.prefetch_chunks(samples)
+        res = [self.get_sample(sample) for sample in samples]
+        # Chunks planned twice in batch are read only once, left copies are dropped
+        self.prefetched.clear()
+        return res
+
+    def get_sample(self, sample):
+        # Sample doesn't depend on worker which loads it: all random values are taken from its generators.
+        # Batch augmentations in collate_fn use torch generator of the last sample of batch
+        self.sample = sample
+        if self.dataset_type in [1, 2, 3, 5]:
             res = self.load_random_mix()
         else:
             res = self.load_aligned_data()
 
         # Randomly change loudness of each stem
-        if self.aug:
+        if self.aug and not self.batch_aug and not self.mix_on_device:
             if 'loudness' in self.config['augmentations']:
                 if self.config['augmentations']['loudness']:
-                    loud_values = np.random.uniform(
+                    loud_values = self.sample.np_rng.uniform(
                         low=self.config['augmentations']['loudness_min'],
                         high=self.config['augmentations']['loudness_max'],
                         size=(len(res),)
@@ -627,26 +1395,36 @@ class MSSDataset(torch.utils.data.Dataset):
                     loud_values = torch.tensor(loud_values, dtype=torch.float32)
                     res *= loud_values[:, None, None]
 
-        mix = res.sum(0)
+        # With mix_on_device mixture is made from stems on training device
+        mix = None if self.mix_on_device else res.sum(0)
 
-        if self.aug:
+        if self.aug and not self.mix_on_device:
             if 'mp3_compression_on_mixture' in self.config['augmentations']:
-                apply_aug = AU.Mp3Compression(
+                apply_aug = self.get_augm('mp3_compression_on_mixture', None, lambda: AU.Mp3Compression(
                     min_bitrate=self.config['augmentations']['mp3_compression_on_mixture_bitrate_min'],
                     max_bitrate=self.config['augmentations']['mp3_compression_on_mixture_bitrate_max'],
                     backend=self.config['augmentations']['mp3_compression_on_mixture_backend'],
                     p=self.config['augmentations']['mp3_compression_on_mixture']
-                )
+                ))
                 mix_conv = mix.cpu().numpy().astype(np.float32)
                 required_shape = mix_conv.shape
-                mix = apply_aug(samples=mix_conv, sample_rate=44100)
+                mix = self.run_augm('mp3_compression_on_mixture', apply_aug, samples=mix_conv, sample_rate=44100)
                 # Sometimes it gives longer audio (so we cut)
                 if mix.shape != required_shape:
                     mix = mix[..., :required_shape[-1]]
                 mix = torch.tensor(mix, dtype=torch.float32)
 
-        # If we need only given stem (for roformers)
-        if self.config.training.target_instrument is not None:
+        if self.augm_profile is not None:
+            self.augm_profile_samples += 1
+            if self.augm_profile_samples % self.augm_profile_every == 0:
+                self.report_augm_profile()
+
+        if self.mix_on_device:
+            # Only stems are returned: loudness, mixup, mixture and target stem are done for whole batch
+            return res.half() if self.stems_fp16 else res
+
+        # If we need only given stem (for roformers). With batch augmentations it's selected after them
+        if self.config.training.target_instrument is not None and not self.batch_aug:
             index = self.config.training.instruments.index(self.config.training.target_instrument)
             return res[index], mix
 
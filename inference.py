@@ -17,7 +17,7 @@ from utils import prefer_target_instrument
 # Using the embedded version of Python can also correctly import the utils module.
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
-from utils import demix, get_model_from_config
+from utils import demix, get_model_from_config, quantize_model, int8_cache_is_valid, compile_model
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -129,6 +129,10 @@ def proc_folder(args):
     parser.add_argument("--force_cpu", action = 'store_true', help="Force the use of CPU even if CUDA is available")
     parser.add_argument("--flac_file", action = 'store_true', help="Output flac file instead of wav")
     parser.add_argument("--pcm_type", type=str, choices=['PCM_16', 'PCM_24'], default='PCM_24', help="PCM type for FLAC files (PCM_16 or PCM_24)")
+    parser.add_argument("--int8", action='store_true', help="Apply dynamic int8 quantization to Linear/LSTM/GRU layers. Works only on CPU. Quantized weights are cached next to checkpoint.")
+    parser.add_argument("--fuse", action='store_true', help="mdx23c only: use inference variant with fused norm/activation and channels-last convolutions. Loads the same checkpoints.")
+    parser.add_argument("--compile", type=str, choices=['none', 'compile', 'trace'], default='none', help="Compile model for faster inference: torch.compile or torch.jit.trace. Result is cached in --compile_cache_dir")
+    parser.add_argument("--compile_cache_dir", type=str, default='compile_cache', help="Folder to store compiled models")
     parser.add_argument("--use_tta", action='store_true', help="Flag adds test time augmentation during inference (polarity and channel inverse). While this triples the runtime, it reduces noise and slightly improves prediction quality.")
     if args is None:
         args = parser.parse_args()
@@ -145,13 +149,20 @@ def proc_folder(args):
     elif torch.backends.mps.is_available():
         device = "mps"
 
+    if args.int8 and device != "cpu":
+        print('Dynamic int8 quantization is supported only on CPU. Switch to CPU.')
+        device = "cpu"
+
     print("Using device: ", device)
 
     model_load_start_time = time.time()
     torch.backends.cudnn.benchmark = True
 
     model, config = get_model_from_config(args.model_type, args.config_path)
-    if args.start_check_point != '':
+    if args.start_check_point != '' and args.int8 and int8_cache_is_valid(args.start_check_point, args.config_path):
+        # No need to read float weights, quantized weights will be loaded from cache
+        pass
+    elif args.start_check_point != '':
         print('Start from checkpoint: {}'.format(args.start_check_point))
         if args.model_type in ['htdemucs', 'apollo']:
             state_dict = torch.load(args.start_check_point, map_location=device, weights_only=False)
@@ -164,6 +175,14 @@ def proc_folder(args):
         else:
             state_dict = torch.load(args.start_check_point, map_location=device, weights_only=True)
         model.load_state_dict(state_dict)
+    if args.int8:
+        model = quantize_model(model, args.start_check_point, args.config_path)
+    if args.fuse:
+        if args.model_type == 'mdx23c':
+            from models.mdx23c_tfc_tdf_v3 import fuse_tfc_tdf_net
+            model = fuse_tfc_tdf_net(model)
+        else:
+            print('Fused inference variant is available only for mdx23c. Ignore --fuse.')
     print("Instruments: {}".format(config.training.instruments))
 
     # in case multiple CUDA GPUs are used and --device_ids arg is passed
@@ -172,6 +191,27 @@ def proc_folder(args):
 
     model = model.to(device)
 
+    if args.compile != 'none':
+        if isinstance(model, nn.DataParallel):
+            print('Compilation is not supported for multiple GPUs. Use eager mode.')
+        else:
+            if args.model_type == 'htdemucs':
+                chunk_size = int(config.training.samplerate * config.training.segment)
+            else:
+                chunk_size = config.audio.chunk_size
+            input_shape = (config.inference.batch_size, config.audio.get('num_channels', 2), chunk_size)
+            model = compile_model(
+                model,
+                args.model_type + ('_fused' if args.fuse else ''),
+                args.config_path,
+                input_shape,
+                device,
+                mode=args.compile,
+                cache_dir=args.compile_cache_dir,
+                check_point_path=args.start_check_point,
+                use_amp=config.training.get('use_amp', False),
+            )
+
     print("Model load time: {:.2f} sec".format(time.time() - model_load_start_time))
 
     run_folder(model, args, config, device, verbose=True)
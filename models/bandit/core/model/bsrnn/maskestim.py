@@ -6,6 +6,7 @@ from torch import nn
 from torch.nn.modules import activation
 
 from models.bandit.core.model.bsrnn.utils import (
+    band_assembly_plan,
     band_widths_from_specs,
     check_no_gap,
     check_no_overlap,
@@ -257,6 +258,12 @@ class OverlappingMaskEstimationModule(MaskEstimationModuleBase):
         else:
             self.use_freq_weights = False
 
+        freq_index, freq_weight = band_assembly_plan(
+                band_specs, freq_weights if self.use_freq_weights else None
+        )
+        self.register_buffer("freq_index", freq_index, persistent=False)
+        self.register_buffer("freq_weight", freq_weight, persistent=False)
+
         self.cond_dim = cond_dim
 
     def forward(self, q, cond=None):
@@ -288,18 +295,20 @@ class OverlappingMaskEstimationModule(MaskEstimationModuleBase):
                 q
         )  # [n_bands  * (batch, in_channel, bandwidth, n_time)]
 
+        mask_list = torch.cat(mask_list, dim=2)  # (batch, in_channel, sum of bandwidths, n_time)
+        if self.freq_weight is not None:
+            mask_list = mask_list * self.freq_weight[:, None]
+
         masks = torch.zeros(
                 (batch, self.in_channel, self.n_freq, n_time),
                 device=q.device,
-                dtype=mask_list[0].dtype,
+                dtype=mask_list.dtype,
         )
 
-        for im, mask in enumerate(mask_list):
-            fstart, fend = self.band_specs[im]
-            if self.use_freq_weights:
-                fw = self.get_buffer(f"freq_weights/{im}")[:, None]
-                mask = mask * fw
-            masks[:, :, fstart:fend, :] += mask
+        # index_put_ instead of index_add_, which keeps mask_list for backward
+        masks.transpose(0, 2).index_put_(
+                (self.freq_index,), mask_list.transpose(0, 2), accumulate=True
+        )
 
         return masks
 
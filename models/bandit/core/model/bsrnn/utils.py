@@ -16,6 +16,19 @@ def band_widths_from_specs(band_specs):
     return [e - i for i, e in band_specs]
 
 
+def band_assembly_plan(band_specs, freq_weights=None):
+    """
+    Precomputed plan for assembling masks of all bands (concatenated along frequency) into the full
+    frequency axis with one accumulating index_put_: frequency index of every concatenated bin and its weight
+    (normalized filterbank weights from BandsplitSpecification.get_freq_weights, None if not used).
+    """
+    freq_index = torch.cat([torch.arange(fstart, fend) for fstart, fend in band_specs])
+    if freq_weights is None:
+        return freq_index, None
+    weights = torch.cat([torch.as_tensor(fw, dtype=torch.float32) for fw in freq_weights])
+    return freq_index, weights
+
+
 def check_nonzero_bandwidth(band_specs):
     # pprint(band_specs)
     for fstart, fend in band_specs:
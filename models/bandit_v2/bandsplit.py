@@ -9,6 +9,8 @@ from .utils import (
     check_no_gap,
     check_no_overlap,
     check_nonzero_bandwidth,
+    group_bands_by_width,
+    init_linear_,
 )
 
 
@@ -51,6 +53,68 @@ class NormFC(nn.Module):
         return checkpoint_sequential(self.combined, 1, xb, use_reentrant=False)
 
 
+class GroupedNormFC(nn.Module):
+    """
+    NormFC for a run of bands with the same width, all bands are processed with one batched matmul.
+    """
+    def __init__(
+        self,
+        emb_dim: int,
+        band_specs: List[Tuple[int, int]],
+        in_channels: int,
+    ) -> None:
+        super().__init__()
+
+        reim = 2
+        n_bands = len(band_specs)
+        self.bandwidth = band_widths_from_specs(band_specs)[0]
+        self.eps = 1e-5
+
+        fc_in = in_channels * self.bandwidth * reim
+
+        # (bandwidth, reim) features of every band in channel of spectrogram flattened as (n_freq * reim),
+        # single band is sliced, several bands are gathered with one indexing
+        self.feature_slice = slice(band_specs[0][0] * reim, band_specs[0][1] * reim)
+        feature_index = torch.tensor([list(range(fstart * reim, fend * reim)) for fstart, fend in band_specs])
+        self.register_buffer("feature_index", feature_index, persistent=False)
+
+        self.norm_weight = nn.Parameter(torch.ones(n_bands, fc_in))
+        self.norm_bias = nn.Parameter(torch.zeros(n_bands, fc_in))
+        self.fc_weight = nn.Parameter(torch.zeros(n_bands, fc_in, emb_dim))
+        self.fc_bias = nn.Parameter(torch.zeros(n_bands, 1, emb_dim))
+
+        for i in range(n_bands):
+            init_linear_(self.fc_weight[i], self.fc_bias[i, 0])
+
+    @torch.no_grad()
+    def load_band(self, i, state_dict):
+        # state_dict of NormFC for i-th band of the run
+        self.norm_weight[i] = state_dict["combined.0.weight"]
+        self.norm_bias[i] = state_dict["combined.0.bias"]
+        self.fc_weight[i] = state_dict["combined.1.weight"].T
+        self.fc_bias[i, 0] = state_dict["combined.1.bias"]
+
+    def forward(self, xp):
+        # xp = spectrogram (batch, n_time, in_chan, n_freq * reim)
+        batch, n_time = xp.shape[:2]
+        n_bands, fc_in, emb_dim = self.fc_weight.shape
+
+        # LayerNorm affine transform is folded into fc
+        weight = self.fc_weight * self.norm_weight[:, :, None]
+        bias = torch.baddbmm(self.fc_bias, self.norm_bias[:, None], self.fc_weight)
+
+        if n_bands == 1:
+            xb = xp[..., self.feature_slice]
+        else:
+            xb = xp[..., self.feature_index].transpose(2, 3)
+        xb = torch.reshape(xb, (-1, n_bands, fc_in))  # (batch * n_time, n_bands, fc_in)
+        xb = nn.functional.layer_norm(xb, (fc_in,), eps=self.eps)
+        zb = torch.baddbmm(bias, xb.transpose(0, 1), weight)  # (n_bands, batch * n_time, emb_dim)
+
+        zb = torch.reshape(zb, (n_bands, batch, n_time, emb_dim))
+        return zb.transpose(0, 1)  # (batch, n_bands, n_time, emb_dim)
+
+
 class BandSplitModule(nn.Module):
     def __init__(
         self,
@@ -79,52 +143,46 @@ class BandSplitModule(nn.Module):
         self.n_bands = len(band_specs)
         self.emb_dim = emb_dim
 
-        try:
-            self.norm_fc_modules = nn.ModuleList(
-                [  # type: ignore
-                    torch.compile(
-                        NormFC(
-                            emb_dim=emb_dim,
-                            bandwidth=bw,
-                            in_channels=in_channels,
-                            normalize_channel_independently=normalize_channel_independently,
-                            treat_channel_as_feature=treat_channel_as_feature,
-                        ),
-                        disable=True,
-                    )
-                    for bw in self.band_widths
-                ]
-            )
-        except Exception as e:
-            self.norm_fc_modules = nn.ModuleList(
-                [  # type: ignore
-                    NormFC(
-                        emb_dim=emb_dim,
-                        bandwidth=bw,
-                        in_channels=in_channels,
-                        normalize_channel_independently=normalize_channel_independently,
-                        treat_channel_as_feature=treat_channel_as_feature,
-                    )
-                    for bw in self.band_widths
-                ]
-            )
+        if not treat_channel_as_feature or normalize_channel_independently:
+            raise NotImplementedError
+
+        self.band_groups = group_bands_by_width(self.band_widths)
+        self.norm_fc_modules = nn.ModuleList(
+            [
+                GroupedNormFC(
+                    emb_dim=emb_dim,
+                    band_specs=band_specs[start:end],
+                    in_channels=in_channels,
+                )
+                for start, end in self.band_groups
+            ]
+        )
+        self._register_load_state_dict_pre_hook(self._convert_per_band_state_dict)
+
+    def _convert_per_band_state_dict(self, state_dict, prefix, *args):
+        # Checkpoints with per band NormFC modules (norm_fc_modules.{band}.combined...)
+        if prefix + "norm_fc_modules.0.combined.0.weight" not in state_dict:
+            return
+        for (start, end), nfm in zip(self.band_groups, self.norm_fc_modules):
+            for b in range(start, end):
+                band_prefix = prefix + "norm_fc_modules.{}.".format(b)
+                band_state = {
+                    k[len(band_prefix):]: state_dict.pop(k)
+                    for k in list(state_dict.keys())
+                    if k.startswith(band_prefix)
+                }
+                nfm.load_band(b - start, band_state)
+        for k, v in self.norm_fc_modules.state_dict().items():
+            state_dict[prefix + "norm_fc_modules." + k] = v
 
     def forward(self, x: torch.Tensor):
         # x = complex spectrogram (batch, in_chan, n_freq, n_time)
 
-        batch, in_chan, band_width, n_time = x.shape
-
-        z = torch.zeros(
-            size=(batch, self.n_bands, n_time, self.emb_dim), device=x.device
-        )
+        batch, in_chan, n_freq, n_time = x.shape
 
-        x = torch.permute(x, (0, 3, 1, 2)).contiguous()
+        xp = torch.view_as_real(torch.permute(x, (0, 3, 1, 2)).contiguous())
+        xp = torch.reshape(xp, (batch, n_time, in_chan, -1))  # (batch, n_time, in_chan, n_freq * reim)
 
-        for i, nfm in enumerate(self.norm_fc_modules):
-            fstart, fend = self.band_specs[i]
-            xb = x[:, :, :, fstart:fend]
-            xb = torch.view_as_real(xb)
-            xb = torch.reshape(xb, (batch, n_time, -1))
-            z[:, i, :, :] = nfm(xb)
+        z = torch.cat([nfm(xp) for nfm in self.norm_fc_modules], dim=1)  # (batch, n_bands, n_time, emb_dim)
 
         return z
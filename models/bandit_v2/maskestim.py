@@ -2,14 +2,19 @@ from typing import Dict, List, Optional, Tuple, Type
 
 import torch
 from torch import nn
+from torch.nn import functional as F
 from torch.nn.modules import activation
-from torch.utils.checkpoint import checkpoint_sequential
+from torch.utils.checkpoint import checkpoint, checkpoint_sequential
 
 from .utils import (
+    band_assembly_plan,
     band_widths_from_specs,
     check_no_gap,
     check_no_overlap,
     check_nonzero_bandwidth,
+    group_bands_by_width,
+    init_linear_,
+    split_time,
 )
 
 
@@ -106,6 +111,92 @@ class NormMLP(BaseNormMLP):
         return mb
 
 
+class GroupedNormMLP(nn.Module):
+    """
+    NormMLP for a run of bands with the same width, all bands are processed with batched matmuls.
+    """
+    def __init__(
+        self,
+        emb_dim: int,
+        mlp_dim: int,
+        bandwidth: int,
+        n_bands: int,
+        in_channels: Optional[int],
+        hidden_activation: str = "Tanh",
+        hidden_activation_kwargs=None,
+        complex_mask: bool = True,
+    ) -> None:
+        super().__init__()
+        if hidden_activation_kwargs is None:
+            hidden_activation_kwargs = {}
+
+        self.bandwidth = bandwidth
+        self.in_channels = in_channels
+        self.complex_mask = complex_mask
+        self.reim = 2 if complex_mask else 1
+        self.glu_mult = 2
+        out_dim = bandwidth * in_channels * self.reim * self.glu_mult
+
+        self.activation = activation.__dict__[hidden_activation](**hidden_activation_kwargs)
+        self.norm_weight = nn.Parameter(torch.ones(n_bands, 1, emb_dim))
+        self.norm_bias = nn.Parameter(torch.zeros(n_bands, 1, emb_dim))
+        self.hidden_weight = nn.Parameter(torch.zeros(n_bands, emb_dim, mlp_dim))
+        self.hidden_bias = nn.Parameter(torch.zeros(n_bands, 1, mlp_dim))
+        self.output_weight = nn.Parameter(torch.zeros(n_bands, mlp_dim, out_dim))
+        self.output_bias = nn.Parameter(torch.zeros(n_bands, 1, out_dim))
+
+        for i in range(n_bands):
+            init_linear_(self.hidden_weight[i], self.hidden_bias[i, 0])
+            init_linear_(self.output_weight[i], self.output_bias[i, 0])
+
+    @torch.no_grad()
+    def load_band(self, i, state_dict):
+        # state_dict of NormMLP for i-th band of the run
+        self.norm_weight[i, 0] = state_dict["norm.weight"]
+        self.norm_bias[i, 0] = state_dict["norm.bias"]
+        self.hidden_weight[i] = state_dict["hidden.0.weight"].T
+        self.hidden_bias[i, 0] = state_dict["hidden.0.bias"]
+        self.output_weight[i] = state_dict["output.0.weight"].T
+        self.output_bias[i, 0] = state_dict["output.0.bias"]
+
+    @staticmethod
+    def normalize(qb):
+        n, batch, n_time, emb_dim = qb.shape
+        return F.layer_norm(torch.reshape(qb, (n, batch * n_time, emb_dim)), (emb_dim,))
+
+    def forward(self, qb):
+        # qb = (n_bands, batch, n_time, emb_dim) for bands of the run
+        n, batch, n_time, emb_dim = qb.shape
+        frame_size = n * batch * max(emb_dim, self.hidden_weight.shape[2], self.output_weight.shape[2])
+
+        # LayerNorm affine transform is folded into hidden layer
+        hidden_weight = self.hidden_weight * self.norm_weight.transpose(1, 2)
+        hidden_bias = torch.baddbmm(self.hidden_bias, self.norm_bias, self.hidden_weight)
+
+        # Long inputs are processed in parts along time, every part is one batched matmul for all bands
+        masks = []
+        for first, last in split_time(n_time, frame_size):
+            # Like checkpoint of norm in NormMLP: reshaped copy of input isn't kept for backward
+            if torch.is_grad_enabled():
+                hb = checkpoint(self.normalize, qb[:, :, first:last], use_reentrant=False)
+            else:
+                hb = self.normalize(qb[:, :, first:last])
+            hb = self.activation(torch.baddbmm(hidden_bias, hb, hidden_weight))
+            mb = F.glu(torch.baddbmm(self.output_bias, hb, self.output_weight), dim=-1)
+
+            if self.complex_mask:
+                mb = mb.reshape(n, batch, last - first, self.in_channels, self.bandwidth, self.reim)
+                mb = torch.view_as_complex(mb)
+            else:
+                mb = mb.reshape(n, batch, last - first, self.in_channels, self.bandwidth)
+
+            mb = torch.permute(mb, (1, 3, 0, 4, 2))  # (batch, in_channels, n_bands, bandwidth, n_frames)
+            masks.append(torch.reshape(mb, (batch, self.in_channels, n * self.bandwidth, last - first)))
+
+        # (batch, in_channels, n_bands * bandwidth, n_time)
+        return torch.cat(masks, dim=3) if len(masks) > 1 else masks[0]
+
+
 class MaskEstimationModuleSuperBase(nn.Module):
     pass
 
@@ -134,40 +225,69 @@ class MaskEstimationModuleBase(MaskEstimationModuleSuperBase):
         if norm_mlp_kwargs is None:
             norm_mlp_kwargs = {}
 
-        self.norm_mlp = nn.ModuleList(
-            [
-                norm_mlp_cls(
-                    bandwidth=self.band_widths[b],
-                    emb_dim=emb_dim,
-                    mlp_dim=mlp_dim,
-                    in_channels=in_channels,
-                    hidden_activation=hidden_activation,
-                    hidden_activation_kwargs=hidden_activation_kwargs,
-                    complex_mask=complex_mask,
-                    **norm_mlp_kwargs,
-                )
-                for b in range(self.n_bands)
-            ]
-        )
-
-    def compute_masks(self, q):
-        batch, n_bands, n_time, emb_dim = q.shape
-
-        masks = []
+        self.band_groups = group_bands_by_width(self.band_widths)
+        # Runs of bands with the same width are processed with batched matmuls, custom norm_mlp_cls
+        # (or NormMLP with extra arguments) is called for every band separately
+        self.grouped = norm_mlp_cls is NormMLP and not norm_mlp_kwargs
+        if self.grouped:
+            self.norm_mlp = nn.ModuleList(
+                [
+                    GroupedNormMLP(
+                        emb_dim=emb_dim,
+                        mlp_dim=mlp_dim,
+                        bandwidth=self.band_widths[start],
+                        n_bands=end - start,
+                        in_channels=in_channels,
+                        hidden_activation=hidden_activation,
+                        hidden_activation_kwargs=hidden_activation_kwargs,
+                        complex_mask=complex_mask,
+                    )
+                    for start, end in self.band_groups
+                ]
+            )
+            self._register_load_state_dict_pre_hook(self._convert_per_band_state_dict)
+        else:
+            self.norm_mlp = nn.ModuleList(
+                [
+                    norm_mlp_cls(
+                        bandwidth=self.band_widths[b],
+                        emb_dim=emb_dim,
+                        mlp_dim=mlp_dim,
+                        in_channels=in_channels,
+                        hidden_activation=hidden_activation,
+                        hidden_activation_kwargs=hidden_activation_kwargs,
+                        complex_mask=complex_mask,
+                        **norm_mlp_kwargs,
+                    )
+                    for b in range(self.n_bands)
+                ]
+            )
 
-        for b, nmlp in enumerate(self.norm_mlp):
-            # print(f"maskestim/{b:02d}")
-            qb = q[:, b, :, :]
-            mb = nmlp(qb)
-            masks.append(mb)
+    def _convert_per_band_state_dict(self, state_dict, prefix, *args):
+        # Checkpoints with per band NormMLP modules (norm_mlp.{band}.norm..., norm_mlp.{band}.combined...)
+        if prefix + "norm_mlp.0.norm.weight" not in state_dict:
+            return
+        for (start, end), nmlp in zip(self.band_groups, self.norm_mlp):
+            for b in range(start, end):
+                band_prefix = prefix + "norm_mlp.{}.".format(b)
+                band_state = {
+                    k[len(band_prefix):]: state_dict.pop(k)
+                    for k in list(state_dict.keys())
+                    if k.startswith(band_prefix)
+                }
+                nmlp.load_band(b - start, band_state)
+        for k, v in self.norm_mlp.state_dict().items():
+            state_dict[prefix + "norm_mlp." + k] = v
 
-        return masks
+    def compute_masks(self, q):
+        # q = (batch, n_bands, n_time, emb_dim)
+        if self.grouped:
+            q = q.transpose(0, 1)
+            masks = [nmlp(q[start:end]) for (start, end), nmlp in zip(self.band_groups, self.norm_mlp)]
+        else:
+            masks = [nmlp(q[:, b, :, :]) for b, nmlp in enumerate(self.norm_mlp)]
 
-    def compute_mask(self, q, b):
-        batch, n_bands, n_time, emb_dim = q.shape
-        qb = q[:, b, :, :]
-        mb = self.norm_mlp[b](qb)
-        return mb
+        return torch.cat(masks, dim=2)  # (batch, in_channels, sum of bandwidths, n_time)
 
 
 class OverlappingMaskEstimationModule(MaskEstimationModuleBase):
@@ -217,26 +337,31 @@ class OverlappingMaskEstimationModule(MaskEstimationModuleBase):
         else:
             self.use_freq_weights = False
 
+        freq_index, freq_weight = band_assembly_plan(
+            band_specs, freq_weights if self.use_freq_weights else None
+        )
+        self.register_buffer("freq_index", freq_index, persistent=False)
+        self.register_buffer("freq_weight", freq_weight, persistent=False)
+
     def forward(self, q):
         # q = (batch, n_bands, n_time, emb_dim)
 
         batch, n_bands, n_time, emb_dim = q.shape
 
+        band_masks = self.compute_masks(q)  # (batch, in_channels, sum of bandwidths, n_time)
+        if self.freq_weight is not None:
+            band_masks = band_masks * self.freq_weight[:, None]
+
         masks = torch.zeros(
             (batch, self.in_channels, self.n_freq, n_time),
             device=q.device,
             dtype=torch.complex64,
         )
 
-        for im in range(n_bands):
-            fstart, fend = self.band_specs[im]
-
-            mask = self.compute_mask(q, im)
-
-            if self.use_freq_weights:
-                fw = self.get_buffer(f"freq_weights/{im}")[:, None]
-                mask = mask * fw
-            masks[:, :, fstart:fend, :] += mask
+        # index_put_ instead of index_add_, which keeps band_masks for backward
+        masks.transpose(0, 2).index_put_(
+            (self.freq_index,), band_masks.to(masks.dtype).transpose(0, 2), accumulate=True
+        )
 
         return masks
 
@@ -271,11 +396,7 @@ class MaskEstimationModule(OverlappingMaskEstimationModule):
     def forward(self, q, cond=None):
         # q = (batch, n_bands, n_time, emb_dim)
 
-        masks = self.compute_masks(
-            q
-        )  # [n_bands  * (batch, in_channels, bandwidth, n_time)]
-
         # TODO: currently this requires band specs to have no gap and no overlap
-        masks = torch.concat(masks, dim=2)  # (batch, in_channels, n_freq, n_time)
+        masks = self.compute_masks(q)  # (batch, in_channels, n_freq, n_time)
 
         return masks
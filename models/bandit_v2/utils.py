@@ -1,3 +1,4 @@
+import math
 import os
 from abc import abstractmethod
 from typing import Callable
@@ -15,6 +16,56 @@ def band_widths_from_specs(band_specs):
     return [e - i for i, e in band_specs]
 
 
+def group_bands_by_width(band_widths):
+    """
+    Splits bands into runs of consecutive bands with the same width, every run is processed
+    with batched matmuls.
+    :return: list of (first band, last band + 1)
+    """
+    groups = []
+    start = 0
+    for end in range(1, len(band_widths) + 1):
+        if end == len(band_widths) or band_widths[end] != band_widths[start]:
+            groups.append((start, end))
+            start = end
+    return groups
+
+
+def split_time(n_time, frame_size, max_size=2 ** 20):
+    """
+    Splits time frames into parts, so the largest intermediate of batched matmuls for a run of bands
+    (frame_size = n_bands * batch * largest feature dim elements per frame) stays below max_size elements.
+    :return: list of (first frame, last frame + 1)
+    """
+    step = max(1, max_size // frame_size)
+    return [(first, min(first + step, n_time)) for first in range(0, n_time, step)]
+
+
+@torch.no_grad()
+def init_linear_(weight, bias):
+    """
+    Initialization of nn.Linear (with the same sequence of random numbers) for weight stored
+    as (in_features, out_features).
+    """
+    fan_in, fan_out = weight.shape
+    weight.copy_(torch.nn.init.kaiming_uniform_(torch.empty(fan_out, fan_in), a=math.sqrt(5)).T)
+    bound = 1 / math.sqrt(fan_in)
+    torch.nn.init.uniform_(bias, -bound, bound)
+
+
+def band_assembly_plan(band_specs, freq_weights=None):
+    """
+    Precomputed plan for assembling masks of all bands (concatenated along frequency) into the full
+    frequency axis with one index_add: frequency index of every concatenated bin and its weight
+    (normalized filterbank weights from BandsplitSpecification.get_freq_weights, None if not used).
+    """
+    freq_index = torch.cat([torch.arange(fstart, fend) for fstart, fend in band_specs])
+    if freq_weights is None:
+        return freq_index, None
+    weights = torch.cat([torch.as_tensor(fw, dtype=torch.float32) for fw in freq_weights])
+    return freq_index, weights
+
+
 def check_nonzero_bandwidth(band_specs):
     # pprint(band_specs)
     for fstart, fend in band_specs:
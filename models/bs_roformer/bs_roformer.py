@@ -6,6 +6,7 @@ from torch.nn import Module, ModuleList
 import torch.nn.functional as F
 
 from models.bs_roformer.attend import Attend
+from models.stft import get_window
 from torch.utils.checkpoint import checkpoint
 
 from beartype.typing import Tuple, Optional, List, Callable
@@ -337,6 +338,7 @@ class BSRoformer(Module):
             time_transformer_depth=2,
             freq_transformer_depth=2,
             linear_transformer_depth=0,
+            linear_time_transformer=False,  # if True, time transformer uses linear attention with O(n) memory over time
             freqs_per_bands: Tuple[int, ...] = DEFAULT_FREQS_PER_BANDS,
             # in the paper, they divide into ~60 bands, test with 1 for starters
             dim_head=64,
@@ -388,9 +390,14 @@ class BSRoformer(Module):
             tran_modules = []
             if linear_transformer_depth > 0:
                 tran_modules.append(Transformer(depth=linear_transformer_depth, linear_attn=True, **transformer_kwargs))
-            tran_modules.append(
-                Transformer(depth=time_transformer_depth, rotary_embed=time_rotary_embed, **transformer_kwargs)
-            )
+            if linear_time_transformer:
+                tran_modules.append(
+                    Transformer(depth=time_transformer_depth, linear_attn=True, **transformer_kwargs)
+                )
+            else:
+                tran_modules.append(
+                    Transformer(depth=time_transformer_depth, rotary_embed=time_rotary_embed, **transformer_kwargs)
+                )
             tran_modules.append(
                 Transformer(depth=freq_transformer_depth, rotary_embed=freq_rotary_embed, **transformer_kwargs)
             )
@@ -405,7 +412,7 @@ class BSRoformer(Module):
             normalized=stft_normalized
         )
 
-        self.stft_window_fn = partial(default(stft_window_fn, torch.hann_window), stft_win_length)
+        self.stft_window_fn = partial(get_window, stft_win_length, window_fn=default(stft_window_fn, torch.hann_window))
 
         freqs = torch.stft(torch.randn(1, 4096), **self.stft_kwargs, window=torch.ones(stft_win_length), return_complex=True).shape[1]
 
@@ -482,10 +489,14 @@ class BSRoformer(Module):
 
         # RuntimeError: FFT operations are only supported on MacOS 14+
         # Since it's tedious to define whether we're on correct MacOS version - simple try-catch is used
-        try:
+        # Only done for MPS, so graph stays free of try-catch for torch.compile / torch.jit.trace on other devices
+        if x_is_mps:
+            try:
+                stft_repr = torch.stft(raw_audio, **self.stft_kwargs, window=stft_window, return_complex=True)
+            except:
+                stft_repr = torch.stft(raw_audio.cpu(), **self.stft_kwargs, window=stft_window.cpu(), return_complex=True).to(device)
+        else:
             stft_repr = torch.stft(raw_audio, **self.stft_kwargs, window=stft_window, return_complex=True)
-        except:
-            stft_repr = torch.stft(raw_audio.cpu() if x_is_mps else raw_audio, **self.stft_kwargs, window=stft_window.cpu() if x_is_mps else stft_window, return_complex=True).to(device)
 
         stft_repr = torch.view_as_real(stft_repr)
 
@@ -570,10 +581,13 @@ class BSRoformer(Module):
         stft_repr = rearrange(stft_repr, 'b n (f s) t -> (b n s) f t', s=self.audio_channels)
 
         # same as torch.stft() fix for MacOS MPS above
-        try:
+        if x_is_mps:
+            try:
+                recon_audio = torch.istft(stft_repr, **self.stft_kwargs, window=stft_window, return_complex=False, length=raw_audio.shape[-1])
+            except:
+                recon_audio = torch.istft(stft_repr.cpu(), **self.stft_kwargs, window=stft_window.cpu(), return_complex=False, length=raw_audio.shape[-1]).to(device)
+        else:
             recon_audio = torch.istft(stft_repr, **self.stft_kwargs, window=stft_window, return_complex=False, length=raw_audio.shape[-1])
-        except:
-            recon_audio = torch.istft(stft_repr.cpu() if x_is_mps else stft_repr, **self.stft_kwargs, window=stft_window.cpu() if x_is_mps else stft_window, return_complex=False, length=raw_audio.shape[-1]).to(device)
 
         recon_audio = rearrange(recon_audio, '(b n s) t -> b n s t', s=self.audio_channels, n=num_stems)
 
@@ -602,7 +616,7 @@ class BSRoformer(Module):
                 n_fft=max(window_size, self.multi_stft_n_fft),  # not sure what n_fft is across multi resolution stft
                 win_length=window_size,
                 return_complex=True,
-                window=self.multi_stft_window_fn(window_size, device=device),
+                window=get_window(window_size, device, window_fn=self.multi_stft_window_fn),
                 **self.multi_stft_kwargs,
             )
 
@@ -6,6 +6,7 @@ from torch.nn import Module, ModuleList
 import torch.nn.functional as F
 
 from models.bs_roformer.attend import Attend
+from models.stft import get_window
 from torch.utils.checkpoint import checkpoint
 
 from beartype.typing import Tuple, Optional, List, Callable
@@ -224,7 +225,7 @@ class MelBandLlama(Module):
             self.layers.append(nn.ModuleList(tran_modules))
 
 
-        self.stft_window_fn = partial(default(stft_window_fn, torch.hann_window), stft_win_length)
+        self.stft_window_fn = partial(get_window, stft_win_length, window_fn=default(stft_window_fn, torch.hann_window))
 
         self.stft_kwargs = dict(
             n_fft=stft_n_fft,
@@ -486,7 +487,7 @@ class MelBandLlama(Module):
                 n_fft=max(window_size, self.multi_stft_n_fft),  # not sure what n_fft is across multi resolution stft
                 win_length=window_size,
                 return_complex=True,
-                window=self.multi_stft_window_fn(window_size, device=device),
+                window=get_window(window_size, device, window_fn=self.multi_stft_window_fn),
                 **self.multi_stft_kwargs,
             )
 
@@ -6,6 +6,7 @@ from torch.nn import Module, ModuleList
 import torch.nn.functional as F
 
 from models.bs_roformer.attend import Attend
+from models.stft import get_window
 from torch.utils.checkpoint import checkpoint
 
 from beartype.typing import Tuple, Optional, List, Callable
@@ -331,6 +332,7 @@ class MelBandRoformer(Module):
             time_transformer_depth=2,
             freq_transformer_depth=2,
             linear_transformer_depth=0,
+            linear_time_transformer=False,  # if True, time transformer uses linear attention with O(n) memory over time
             num_bands=60,
             dim_head=64,
             heads=8,
@@ -382,15 +384,20 @@ class MelBandRoformer(Module):
             tran_modules = []
             if linear_transformer_depth > 0:
                 tran_modules.append(Transformer(depth=linear_transformer_depth, linear_attn=True, **transformer_kwargs))
-            tran_modules.append(
-                Transformer(depth=time_transformer_depth, rotary_embed=time_rotary_embed, **transformer_kwargs)
-            )
+            if linear_time_transformer:
+                tran_modules.append(
+                    Transformer(depth=time_transformer_depth, linear_attn=True, **transformer_kwargs)
+                )
+            else:
+                tran_modules.append(
+                    Transformer(depth=time_transformer_depth, rotary_embed=time_rotary_embed, **transformer_kwargs)
+                )
             tran_modules.append(
                 Transformer(depth=freq_transformer_depth, rotary_embed=freq_rotary_embed, **transformer_kwargs)
             )
             self.layers.append(nn.ModuleList(tran_modules))
 
-        self.stft_window_fn = partial(default(stft_window_fn, torch.hann_window), stft_win_length)
+        self.stft_window_fn = partial(get_window, stft_win_length, window_fn=default(stft_window_fn, torch.hann_window))
 
         self.stft_kwargs = dict(
             n_fft=stft_n_fft,
@@ -645,7 +652,7 @@ class MelBandRoformer(Module):
                 n_fft=max(window_size, self.multi_stft_n_fft),  # not sure what n_fft is across multi resolution stft
                 win_length=window_size,
                 return_complex=True,
-                window=self.multi_stft_window_fn(window_size, device=device),
+                window=get_window(window_size, device, window_fn=self.multi_stft_window_fn),
                 **self.multi_stft_kwargs,
             )
 
@@ -11,13 +11,12 @@ from demucs.demucs import Demucs
 from demucs.hdemucs import HDemucs
 
 import math
-from openunmix.filtering import wiener
 from torch import nn
 from torch.nn import functional as F
 from fractions import Fraction
 from einops import rearrange
 
-from demucs.transformer import CrossTransformerEncoder
+from demucs.transformer import CrossTransformerEncoder, MyTransformerEncoderLayer, get_elementary_mask
 
 from demucs.demucs import rescale_module
 from demucs.states import capture_init
@@ -25,6 +24,161 @@ from demucs.spec import spectro, ispectro
 from demucs.hdemucs import pad1d, ScaledEmbedding, HEncLayer, MultiWrap, HDecLayer
 
 
+def _invert(m):
+    # Closed form inverse for 1x1 and 2x2 matrices (mono/stereo), general inverse otherwise
+    channels = m.shape[-1]
+    if channels == 1:
+        return 1 / m
+    elif channels == 2:
+        inv_det = 1 / (m[..., 0, 0] * m[..., 1, 1] - m[..., 0, 1] * m[..., 1, 0])
+        return torch.stack([
+            torch.stack([m[..., 1, 1], -m[..., 0, 1]], -1),
+            torch.stack([-m[..., 1, 0], m[..., 0, 0]], -1),
+        ], -2) * inv_det[..., None, None]
+    return torch.linalg.inv(m)
+
+
+def wiener_batched(targets_spectrograms, mix_stft, iterations=1, residual=False, scale_factor=10.0, eps=1e-10):
+    """
+    Batched version of OpenUnmix wiener filtering (softmask=False). All windows are processed
+    together, intermediates are kept in complex dtype.
+    :param targets_spectrograms: magnitudes of sources, shape (N, frames, bins, channels, sources)
+    :param mix_stft: complex mixture, shape (N, frames, bins, channels)
+    :return: complex sources, shape (N, frames, bins, channels, sources (+1 if residual))
+    """
+    # Initial estimate: source magnitudes with mixture phase
+    y = torch.polar(targets_spectrograms, mix_stft.angle()[..., None])
+    if residual:
+        y = torch.cat([y, mix_stft[..., None] - y.sum(dim=-1, keepdim=True)], dim=-1)
+    if iterations == 0:
+        return y
+
+    # Each window is scaled separately
+    max_abs = torch.clamp(mix_stft.abs().amax(dim=(1, 2, 3)) / scale_factor, min=1.0)
+    max_abs = max_abs[:, None, None, None]
+    mix_stft = mix_stft / max_abs
+    y = y / max_abs[..., None]
+
+    channels = mix_stft.shape[-1]
+    regularization = math.sqrt(eps) * torch.eye(channels, dtype=mix_stft.dtype, device=mix_stft.device)
+    for _ in range(iterations):
+        # M-step: power spectral densities and spatial covariance matrices of sources
+        v = torch.view_as_real(y).pow(2).sum(dim=-1).mean(dim=-2)
+        weight = eps + v.sum(dim=1)
+        R = torch.einsum('ntfcs,ntfds->nfscd', y, y.conj()) / weight[..., None, None]
+        # E-step: y_j = v_j * R_j * Cxx^-1 * x
+        Cxx = regularization + torch.einsum('ntfs,nfscd->ntfcd', v.to(R.dtype), R)
+        inv_x = (_invert(Cxx) @ mix_stft[..., None])[..., 0]
+        y = torch.einsum('nfscd,ntfd->ntfcs', R, inv_x) * v[..., None, :]
+    return y * max_abs[..., None]
+
+
+class BlockSparseAttention(nn.Module):
+    """
+    Replacement for attention of sparse crosstransformer layers which works without xformers (e.g. on CPU).
+    It keeps q, k, v, proj parameters of demucs sparse MultiheadAttention (dense nn.MultiheadAttention
+    weights are converted on load), so the same checkpoints can be used.
+    Static masks (t_mask_type: diag, jmask, random, global) are applied by blocks of queries: every block
+    attends only to keys allowed for at least one of its queries. Memory is O(block * allowed keys) instead
+    of O(T * S) for dense attention. With t_auto_sparsity every block of queries keeps only top (1 - t_sparsity)
+    part of keys (by maximum score over the block) instead of LSH buckets of xformers.
+    """
+    def __init__(self, attn, layer, block_size=256):
+        super().__init__()
+        self.q = attn.q
+        self.k = attn.k
+        self.v = attn.v
+        self.proj = attn.proj
+        self.attn_drop = attn.attn_drop
+        self.proj_drop = attn.proj_drop
+        self.num_heads = attn.num_heads
+        self.auto_sparsity = attn.auto_sparsity
+        if not self.auto_sparsity:
+            self.mask_type = layer.mask_type
+            self.sparse_attn_window = layer.sparse_attn_window
+            self.global_window = layer.global_window
+            self.mask_random_seed = layer.mask_random_seed
+            self.sparsity = layer.sparsity
+        self.block_size = block_size
+        self.plans = dict()
+        self._register_load_state_dict_pre_hook(self._convert_dense_state_dict)
+
+    @staticmethod
+    def _convert_dense_state_dict(state_dict, prefix, *args):
+        # Weights of nn.MultiheadAttention (model trained without sparse attention)
+        for suffix in ['weight', 'bias']:
+            name = prefix + 'in_proj_' + suffix
+            if name in state_dict:
+                q, k, v = state_dict.pop(name).chunk(3)
+                state_dict[prefix + 'q.' + suffix] = q
+                state_dict[prefix + 'k.' + suffix] = k
+                state_dict[prefix + 'v.' + suffix] = v
+            name = prefix + 'out_proj.' + suffix
+            if name in state_dict:
+                state_dict[prefix + 'proj.' + suffix] = state_dict.pop(name)
+
+    def get_plan(self, n_q, n_k, device):
+        # For every block of queries: start position, allowed keys and mask restricted to these keys
+        key = (n_q, n_k, str(device))
+        if key not in self.plans:
+            mask = torch.stack([
+                get_elementary_mask(
+                    n_k, n_q, mask_type, self.sparse_attn_window, self.global_window,
+                    self.mask_random_seed, self.sparsity, device,
+                ) for mask_type in self.mask_type.split('_')
+            ]).any(dim=0)
+            plan = []
+            for start in range(0, n_q, self.block_size):
+                rows = mask[start:start + self.block_size]
+                keys = rows.any(dim=0).nonzero()[:, 0]
+                plan.append((start, keys, rows[:, keys]))
+            self.plans[key] = plan
+        return self.plans[key]
+
+    def forward(self, query, key, value, need_weights=False, attn_mask=None, **kwargs):
+        # batch_first: (B, N, C)
+        B, N_q, C = query.shape
+        N_k = key.shape[1]
+        h = self.num_heads
+        q = self.q(query).reshape(B, N_q, h, C // h).transpose(1, 2)
+        k = self.k(key).reshape(B, N_k, h, C // h).transpose(1, 2)
+        v = self.v(value).reshape(B, N_k, h, C // h).transpose(1, 2)
+        dropout_p = self.attn_drop.p if self.training else 0.0
+
+        out = []
+        if self.auto_sparsity:
+            keep = max(1, int(round(N_k * (1 - self.auto_sparsity))))
+            for start in range(0, N_q, self.block_size):
+                q_block = q[:, :, start:start + self.block_size]
+                # Block of queries attends to keys with highest score for any of its queries
+                with torch.no_grad():
+                    scores = (q_block @ k.transpose(-1, -2)).amax(dim=2)
+                    keys = scores.topk(keep, dim=-1, sorted=False).indices[..., None].expand(-1, -1, -1, C // h)
+                out.append(F.scaled_dot_product_attention(
+                    q_block, k.gather(2, keys), v.gather(2, keys), dropout_p=dropout_p,
+                ))
+        else:
+            for start, keys, mask in self.get_plan(N_q, N_k, query.device):
+                out.append(F.scaled_dot_product_attention(
+                    q[:, :, start:start + self.block_size], k[:, :, keys], v[:, :, keys],
+                    attn_mask=mask, dropout_p=dropout_p,
+                ))
+        x = torch.cat(out, dim=2).transpose(1, 2).reshape(B, N_q, C)
+        x = self.proj_drop(self.proj(x))
+        return x, None
+
+
+def use_block_sparse_attention(crosstransformer):
+    # Sparse layers of demucs need xformers. Without it their attention is replaced by BlockSparseAttention.
+    for layer in list(crosstransformer.layers) + list(crosstransformer.layers_t):
+        if not layer.sparse:
+            continue
+        name = 'self_attn' if isinstance(layer, MyTransformerEncoderLayer) else 'cross_attn'
+        setattr(layer, name, BlockSparseAttention(getattr(layer, name), layer))
+        # Mask is built inside attention, layer must not request xformers mask
+        layer.sparse = False
+
+
 class HTDemucs(nn.Module):
     """
     Spectrogram and hybrid Demucs model.
@@ -421,6 +575,11 @@ class HTDemucs(nn.Module):
                 sparsity=t_sparsity,
                 auto_sparsity=t_auto_sparsity,
             )
+            if t_sparse_self_attn or t_sparse_cross_attn:
+                try:
+                    import xformers.ops  # noqa
+                except ImportError:
+                    use_block_sparse_attention(self.crosstransformer)
         else:
             self.crosstransformer = None
 
@@ -485,30 +644,30 @@ class HTDemucs(nn.Module):
             return self._wiener(m, z, niters)
 
     def _wiener(self, mag_out, mix_stft, niters):
-        # apply wiener filtering from OpenUnmix.
+        # apply wiener filtering from OpenUnmix, all samples and windows at once.
         init = mix_stft.dtype
         wiener_win_len = 300
         residual = self.wiener_residual
 
         B, S, C, Fq, T = mag_out.shape
         mag_out = mag_out.permute(0, 4, 3, 2, 1)
-        mix_stft = torch.view_as_real(mix_stft.permute(0, 3, 2, 1))
-
-        outs = []
-        for sample in range(B):
-            pos = 0
-            out = []
-            for pos in range(0, T, wiener_win_len):
-                frame = slice(pos, pos + wiener_win_len)
-                z_out = wiener(
-                    mag_out[sample, frame],
-                    mix_stft[sample, frame],
-                    niters,
-                    residual=residual,
-                )
-                out.append(z_out.transpose(-1, -2))
-            outs.append(torch.cat(out, dim=0))
-        out = torch.view_as_complex(torch.stack(outs, 0))
+        mix_stft = mix_stft.permute(0, 3, 2, 1)
+
+        # Full windows are stacked along batch dimension and processed in one pass,
+        # shorter last window (if any) is processed for all samples in second pass
+        windows = T // wiener_win_len
+        full = windows * wiener_win_len
+        out = []
+        if windows > 0:
+            out.append(wiener_batched(
+                mag_out[:, :full].reshape(B * windows, wiener_win_len, Fq, C, S),
+                mix_stft[:, :full].reshape(B * windows, wiener_win_len, Fq, C),
+                niters,
+                residual=residual,
+            ).reshape(B, full, Fq, C, -1))
+        if full < T:
+            out.append(wiener_batched(mag_out[:, full:], mix_stft[:, full:], niters, residual=residual))
+        out = torch.cat(out, dim=1)
         out = out.permute(0, 4, 3, 2, 1).contiguous()
         if residual:
             out = out[:, :-1]
@@ -29,6 +29,7 @@ class Mamba2(nn.Module):
                  expand: int = 2,  # expansion factor (E)
                  headdim: int = 64,  # head dimension (P)
                  chunk_size: int = 64,  # matrix partition size (Q)
+                 ssd_mode: str = 'chunked',  # 'chunked' or 'scan' (sequential recurrence, used in eval mode only)
                  ):
         super().__init__()
         self.n_layer = n_layer
@@ -36,6 +37,9 @@ class Mamba2(nn.Module):
         self.headdim = headdim
         # self.chunk_size = torch.tensor(chunk_size, dtype=torch.int32)
         self.chunk_size = chunk_size
+        self.ssd_mode = ssd_mode
+        # Causal masks for every sequence length and device
+        self.masks = dict()
 
         self.d_inner = expand * d_model
         assert self.d_inner % self.headdim == 0, "self.d_inner must be divisible by self.headdim"
@@ -79,10 +83,11 @@ class Mamba2(nn.Module):
         _p = self.headdim
         x = x.reshape(_b, _l, _h, _p)
 
-        y = self.ssd(x * dt.unsqueeze(-1),
-                     A * dt,
-                     B.unsqueeze(2),
-                     C.unsqueeze(2), )
+        ssd = self.ssd_scan if self.ssd_mode == 'scan' and not self.training else self.ssd
+        y = ssd(x * dt.unsqueeze(-1),
+                A * dt,
+                B.unsqueeze(2),
+                C.unsqueeze(2), )
 
         y = y + x * self.D.unsqueeze(-1)
 
@@ -94,58 +99,90 @@ class Mamba2(nn.Module):
 
         return y
 
+    def get_mask(self, T, device):
+        key = (T, str(device))
+        if key not in self.masks:
+            self.masks[key] = torch.tril(torch.ones(T, T, dtype=torch.bool, device=device), diagonal=0)
+        return self.masks[key]
+
     def segsum(self, x: Tensor) -> Tensor:
+        # segsum[..., i, j] = x[..., j + 1] + ... + x[..., i] for j <= i, -inf otherwise
         T = x.size(-1)
-        device = x.device
-        x = x[..., None].repeat(1, 1, 1, 1, T)
-        mask = torch.tril(torch.ones(T, T, dtype=torch.bool, device=device), diagonal=-1)
-        x = x.masked_fill(~mask, 0)
-        x_segsum = torch.cumsum(x, dim=-2)
-        mask = torch.tril(torch.ones(T, T, dtype=torch.bool, device=device), diagonal=0)
-        x_segsum = x_segsum.masked_fill(~mask, -torch.inf)
-        return x_segsum
+        x_cumsum = torch.cumsum(x, dim=-1)
+        x_segsum = x_cumsum[..., :, None] - x_cumsum[..., None, :]
+        return x_segsum.masked_fill_(~self.get_mask(T, x.device), -torch.inf)
 
     def ssd(self, x, A, B, C):
+        """
+        Chunked SSD. Shapes: x (b, l, h, p), A (b, l, h), B and C (b, l, 1, n) (shared by all heads).
+        Sequence is zero padded to multiple of chunk_size (padded steps are after real ones, so they
+        don't change output). B and C are shared by heads, so heads are folded into matmul rows
+        instead of broadcasting B and C, and the inter-chunk recurrence updates states in place.
+        """
         chunk_size = self.chunk_size
-        # if x.shape[1] % chunk_size == 0:
-        #
-        x = x.reshape(x.shape[0], x.shape[1] // chunk_size, chunk_size, x.shape[2], x.shape[3], )
-        B = B.reshape(B.shape[0], B.shape[1] // chunk_size, chunk_size, B.shape[2], B.shape[3], )
-        C = C.reshape(C.shape[0], C.shape[1] // chunk_size, chunk_size, C.shape[2], C.shape[3], )
-        A = A.reshape(A.shape[0], A.shape[1] // chunk_size, chunk_size, A.shape[2])
-        A = A.permute(0, 3, 1, 2)
-        A_cumsum = torch.cumsum(A, dim=-1)
+        b, seqlen, h, p = x.shape
+        pad = (chunk_size - seqlen % chunk_size) % chunk_size
+        if pad > 0:
+            x = F.pad(x, (0, 0, 0, 0, 0, pad))
+            A = F.pad(A, (0, 0, 0, pad))
+            B = F.pad(B, (0, 0, 0, 0, 0, pad))
+            C = F.pad(C, (0, 0, 0, 0, 0, pad))
+        c = x.shape[1] // chunk_size
+
+        x = x.reshape(b, c, chunk_size, h, p)
+        B = B.reshape(b, c, chunk_size, -1)
+        C = C.reshape(b, c, chunk_size, -1)
+        A = A.reshape(b, c, chunk_size, h).permute(0, 3, 1, 2)
+        A_cumsum = torch.cumsum(A, dim=-1)  # (b, h, c, l)
 
         # 1. Compute the output for each intra-chunk (diagonal blocks)
-        L = torch.exp(self.segsum(A))
-        Y_diag = torch.einsum("bclhn, bcshn, bhcls, bcshp -> bclhp", C, B, L, x)
+        L = self.segsum(A.transpose(1, 2)).exp_()  # (b, c, h, l, s)
+        CB = (C @ B.transpose(-1, -2)).unsqueeze(2)  # (b, c, 1, l, s)
+        # exp output is needed for backward, so it's overwritten only without autograd
+        L = L * CB if torch.is_grad_enabled() else L.mul_(CB)
+        Y_diag = L @ x.transpose(2, 3)  # (b, c, h, l, p)
+        del L
 
         # 2. Compute the state for each intra-chunk
         # (right term of low-rank factorization of off-diagonal blocks; B terms)
-        decay_states = torch.exp(A_cumsum[:, :, :, -1:] - A_cumsum)
-        states = torch.einsum("bclhn, bhcl, bclhp -> bchpn", B, decay_states, x)
+        decay_states = torch.exp(A_cumsum[:, :, :, -1:] - A_cumsum).permute(0, 2, 3, 1)  # (b, c, l, h)
+        states = (x * decay_states[..., None]).reshape(b, c, chunk_size, h * p).transpose(-1, -2) @ B
+        states = states.reshape(b, c, h, p, -1)  # (b, c, h, p, n)
 
         # 3. Compute the inter-chunk SSM recurrence; produces correct SSM states at chunk boundaries
-        # (middle term of factorization of off-diag blocks; A terms)
-
-        initial_states = torch.zeros_like(states[:, :1])
-        states = torch.cat([initial_states, states], dim=1)
-
-        decay_chunk = torch.exp(self.segsum(F.pad(A_cumsum[:, :, :, -1], (1, 0))))[0]
-        new_states = torch.einsum("bhzc, bchpn -> bzhpn", decay_chunk, states)
-        states = new_states[:, :-1]
+        # (middle term of factorization of off-diag blocks; A terms). After the loop states[:, z] is
+        # the state entering chunk z
+        decay_chunk = torch.exp(A_cumsum[:, :, :, -1])  # (b, h, c)
+        carry = torch.zeros_like(states[:, 0])
+        for z in range(c):
+            chunk_state = states[:, z].clone()
+            states[:, z] = carry
+            carry = carry * decay_chunk[:, :, z, None, None] + chunk_state
 
         # 4. Compute state -> output conversion per chunk
         # (left term of low-rank factorization of off-diagonal blocks; C terms)
-        state_decay_out = torch.exp(A_cumsum)
-        Y_off = torch.einsum("bclhn, bchpn, bhcl -> bclhp", C, states, state_decay_out)
-
+        state_decay_out = torch.exp(A_cumsum).permute(0, 2, 3, 1)  # (b, c, l, h)
+        Y = C @ states.reshape(b, c, h * p, -1).transpose(-1, -2)  # (b, c, l, h * p)
+        Y = Y.reshape(b, c, chunk_size, h, p).mul_(state_decay_out[..., None])
         # Add output of intra-chunk and inter-chunk terms (diagonal and off-diagonal blocks)
-        # Y = rearrange(Y_diag + Y_off, "b c l h p -> b (c l) h p")
-        Y = Y_diag + Y_off
-        Y = Y.reshape(Y.shape[0], Y.shape[1] * Y.shape[2], Y.shape[3], Y.shape[4], )
-
-        return Y
+        Y += Y_diag.transpose(2, 3)
+        Y = Y.reshape(b, c * chunk_size, h, p)
+
+        return Y[:, :seqlen]
+
+    def ssd_scan(self, x, A, B, C):
+        """
+        Sequential SSM recurrence: h_t = exp(A_t) * h_{t-1} + x_t * B_t, y_t = h_t * C_t.
+        Memory doesn't depend on sequence length and chunk_size (state has shape (b, h, p, n)).
+        """
+        b, l, h, p = x.shape
+        state = x.new_zeros(b, h, p, B.shape[-1])
+        decay = torch.exp(A)
+        Y = []
+        for t in range(l):
+            state = state * decay[:, t, :, None, None] + x[:, t, :, :, None] * B[:, t, :, None, :]
+            Y.append((state @ C[:, t, :, :, None])[..., 0])
+        return torch.stack(Y, dim=1)
 
 
 class _BiMamba2(nn.Module):
@@ -159,11 +196,12 @@ class _BiMamba2(nn.Module):
                  expand: int = 2,  # expansion factor (E)
                  headdim: int = 64,  # head dimension (P)
                  chunk_size: int = 64,  # matrix partition size (Q)
+                 ssd_mode: str = 'chunked',  # 'chunked' or 'scan' (sequential recurrence, used in eval mode only)
                  ):
         super().__init__()
         self.fc_in = nn.Linear(cin, d_model, bias=False)  # 调整通道数到cmid
-        self.mamba2_for = Mamba2(d_model, n_layer, d_state, d_conv, expand, headdim, chunk_size, )  # 正向
-        self.mamba2_back = Mamba2(d_model, n_layer, d_state, d_conv, expand, headdim, chunk_size, )  # 负向
+        self.mamba2_for = Mamba2(d_model, n_layer, d_state, d_conv, expand, headdim, chunk_size, ssd_mode)  # 正向
+        self.mamba2_back = Mamba2(d_model, n_layer, d_state, d_conv, expand, headdim, chunk_size, ssd_mode)  # 负向
         self.fc_out = nn.Linear(d_model, cout, bias=False)  # 调整通道数到cout
         self.chunk_size = chunk_size
 
@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 from .base_model import BaseModel
+from models.stft import get_window
 
 
 class RMSNorm(nn.Module):
@@ -238,6 +239,8 @@ class Apollo(BaseModel):
         self.enc_dim = self.win // 2 + 1
         self.feature_dim = feature_dim
         self.eps = torch.finfo(torch.float32).eps
+        # grouped band weights cached for inference, see get_grouped_params
+        self.grouped_params = {}
 
         # 80 bands
         bandwidth = int(self.win / 160)
@@ -265,39 +268,88 @@ class Apollo(BaseModel):
                                              )
                                )
 
+    def train(self, mode=True):
+        self.grouped_params.clear()
+        return super().train(mode)
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to() / .half() / .cuda() replace parameter tensors
+        self.grouped_params.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.grouped_params.clear()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def get_grouped_params(self, name):
+        # Weights of the equal-width bands of self.BN / self.output joined into grouped RMSNorm + Conv1d
+        # weights. With gradients enabled they are rebuilt on every call so that gradients reach the per-band
+        # parameters, otherwise (inference, validation) they are built once and reused until train(),
+        # load_state_dict() or .to() is called
+        if torch.is_grad_enabled() or name not in self.grouped_params:
+            modules = getattr(self, name)[:self.nband - 1]
+            params = (
+                torch.stack([m[0].weight for m in modules]),  # nband, N
+                torch.cat([m[1].weight for m in modules]),  # nband * N_out, N, 1
+                torch.cat([m[1].bias for m in modules]),  # nband * N_out
+            )
+            if torch.is_grad_enabled():
+                return params
+            self.grouped_params[name] = params
+        return self.grouped_params[name]
+
+    def band_norm_conv(self, input, name):
+        # Applies per-band RMSNorm + Conv1d (kernel 1) to all bands at once with grouped convolution
+        # input size: (B, nband, N, T), name: 'BN' or 'output', Sequential(RMSNorm, Conv1d) for each band
+        B, nband, N, T = input.shape
+
+        norm_weight, conv_weight, conv_bias = self.get_grouped_params(name)
+
+        input_float = input.float()
+        input_norm = input_float * torch.rsqrt(input_float.pow(2).mean(2, keepdim=True) + self.BN[0][0].eps)
+        input_norm = input_norm.type_as(input) * norm_weight.reshape(1, nband, N, 1)
+
+        output = F.conv1d(input_norm.reshape(B, nband * N, T), conv_weight, conv_bias, groups=nband)
+
+        return output.reshape(B, nband, -1, T)
+
     def spec_band_split(self, input):
 
         B, nch, nsample = input.shape
 
         spec = torch.stft(input.view(B * nch, nsample), n_fft=self.win, hop_length=self.stride,
-                          window=torch.hann_window(self.win).to(input.device), return_complex=True)
+                          window=get_window(self.win, input.device), return_complex=True)
+        T = spec.shape[-1]
 
-        subband_spec = []
-        subband_spec_norm = []
-        subband_power = []
-        band_idx = 0
-        for i in range(self.nband):
-            this_spec = spec[:, band_idx:band_idx + self.band_width[i]]
-            subband_spec.append(this_spec)  # B, BW, T
-            subband_power.append((this_spec.abs().pow(2).sum(1) + self.eps).sqrt().unsqueeze(1))  # B, 1, T
-            subband_spec_norm.append(
-                torch.complex(this_spec.real / subband_power[-1], this_spec.imag / subband_power[-1]))  # B, BW, T
-            band_idx += self.band_width[i]
-        subband_power = torch.cat(subband_power, 1)  # B, nband, T
+        # all bands except last one have the same width, so they are processed as single tensor
+        nsame = self.nband - 1
+        width = self.band_width[0]
+        same_spec = spec[:, :nsame * width].reshape(B * nch, nsame, width, T)  # B, nband-1, BW, T
+        last_spec = spec[:, nsame * width:].unsqueeze(1)  # B, 1, BW_last, T
 
-        return subband_spec_norm, subband_power
+        same_power = (same_spec.abs().pow(2).sum(2) + self.eps).sqrt()  # B, nband-1, T
+        last_power = (last_spec.abs().pow(2).sum(2) + self.eps).sqrt()  # B, 1, T
+        subband_power = torch.cat([same_power, last_power], 1)  # B, nband, T
+
+        same_spec_norm = same_spec / same_power.unsqueeze(2)
+        last_spec_norm = last_spec / last_power.unsqueeze(2)
+
+        return (same_spec_norm, last_spec_norm), subband_power
 
     def feature_extractor(self, input):
 
-        subband_spec_norm, subband_power = self.spec_band_split(input)
+        (same_spec_norm, last_spec_norm), subband_power = self.spec_band_split(input)
+        log_power = torch.log(subband_power).unsqueeze(2)  # B, nband, 1, T
+        nsame = self.nband - 1
 
         # normalization and bottleneck
-        subband_feature = []
-        for i in range(self.nband):
-            concat_spec = torch.cat(
-                [subband_spec_norm[i].real, subband_spec_norm[i].imag, torch.log(subband_power[:, i].unsqueeze(1))], 1)
-            subband_feature.append(self.BN[i](concat_spec))
-        subband_feature = torch.stack(subband_feature, 1)  # B, nband, N, T
+        same_spec = torch.cat([same_spec_norm.real, same_spec_norm.imag, log_power[:, :nsame]], 2)  # B, nband-1, BW*2+1, T
+        same_feature = self.band_norm_conv(same_spec, 'BN')
+
+        last_spec = torch.cat([last_spec_norm.real, last_spec_norm.imag, log_power[:, nsame:]], 2)[:, 0]  # B, BW_last*2+1, T
+        last_feature = self.BN[-1](last_spec).unsqueeze(1)
+
+        subband_feature = torch.cat([same_feature, last_feature], 1)  # B, nband, N, T
 
         return subband_feature
 
@@ -308,14 +360,18 @@ class Apollo(BaseModel):
         subband_feature = self.feature_extractor(input)
         feature = self.net(subband_feature)
 
-        est_spec = []
-        for i in range(self.nband):
-            this_RI = self.output[i](feature[:, i]).view(B * nch, 2, self.band_width[i], -1)
-            est_spec.append(torch.complex(this_RI[:, 0], this_RI[:, 1]))
-        est_spec = torch.cat(est_spec, 1)
+        nsame = self.nband - 1
+        width = self.band_width[0]
+        same_RI = F.glu(self.band_norm_conv(feature[:, :nsame], 'output'), dim=2)
+        same_RI = same_RI.view(B * nch, nsame, 2, width, -1)
+        last_RI = self.output[-1](feature[:, -1]).view(B * nch, 2, self.band_width[-1], -1)
+
+        est_real = torch.cat([same_RI[:, :, 0].reshape(B * nch, nsame * width, -1), last_RI[:, 0]], 1)
+        est_imag = torch.cat([same_RI[:, :, 1].reshape(B * nch, nsame * width, -1), last_RI[:, 1]], 1)
+        est_spec = torch.complex(est_real, est_imag)
         est_spec = est_spec.to(dtype=torch.complex64)
         output = torch.istft(est_spec, n_fft=self.win, hop_length=self.stride,
-                             window=torch.hann_window(self.win).to(input.device), length=nsample).view(B, nch, -1)
+                             window=get_window(self.win, input.device), length=nsample).view(B, nch, -1)
 
         return output
 
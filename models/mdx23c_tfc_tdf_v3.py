@@ -1,48 +1,10 @@
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from functools import partial
 from utils import prefer_target_instrument
-
-class STFT:
-    def __init__(self, config):
-        self.n_fft = config.n_fft
-        self.hop_length = config.hop_length
-        self.window = torch.hann_window(window_length=self.n_fft, periodic=True)
-        self.dim_f = config.dim_f
-
-    def __call__(self, x):
-        window = self.window.to(x.device)
-        batch_dims = x.shape[:-2]
-        c, t = x.shape[-2:]
-        x = x.reshape([-1, t])
-        x = torch.stft(
-            x,
-            n_fft=self.n_fft,
-            hop_length=self.hop_length,
-            window=window,
-            center=True,
-            return_complex=True
-        )
-        x = torch.view_as_real(x)
-        x = x.permute([0, 3, 1, 2])
-        x = x.reshape([*batch_dims, c, 2, -1, x.shape[-1]]).reshape([*batch_dims, c * 2, -1, x.shape[-1]])
-        return x[..., :self.dim_f, :]
-
-    def inverse(self, x):
-        window = self.window.to(x.device)
-        batch_dims = x.shape[:-3]
-        c, f, t = x.shape[-3:]
-        n = self.n_fft // 2 + 1
-        f_pad = torch.zeros([*batch_dims, c, n - f, t]).to(x.device)
-        x = torch.cat([x, f_pad], -2)
-        x = x.reshape([*batch_dims, c // 2, 2, n, t]).reshape([-1, 2, n, t])
-        x = x.permute([0, 2, 3, 1])
-        x = x[..., 0] + x[..., 1] * 1.j
-        x = torch.istft(x, n_fft=self.n_fft, hop_length=self.hop_length, window=window, center=True)
-        x = x.reshape([*batch_dims, 2, -1])
-        return x
-
+from models.stft import STFT
 
 def get_norm(norm_type):
     def norm(c, norm_type):
@@ -187,6 +149,7 @@ class TFC_TDF_net(nn.Module):
         )
 
         self.stft = STFT(config.audio)
+        self.channels_last = False
 
     def cac2cws(self, x):
         k = self.num_subbands
@@ -211,6 +174,8 @@ class TFC_TDF_net(nn.Module):
         first_conv_out = x = self.first_conv(x)
 
         x = x.transpose(-1, -2)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
 
         encoder_outputs = []
         for block in self.encoder_blocks:
@@ -240,3 +205,99 @@ class TFC_TDF_net(nn.Module):
         x = self.stft.inverse(x)
 
         return x
+
+
+def act_inplace(act, x):
+    if isinstance(act, nn.ReLU):
+        return F.relu_(x)
+    elif isinstance(act, nn.ELU):
+        return F.elu_(x, act.alpha)
+    # There is no in-place GELU
+    return act(x)
+
+
+def batch_norm_scale_shift(norm):
+    scale = norm.weight / torch.sqrt(norm.running_var + norm.eps)
+    shift = norm.bias - norm.running_mean * scale
+    return scale.detach(), shift.detach()
+
+
+class NormAct(nn.Module):
+    """
+    Inference replacement for pair norm -> act. BatchNorm in eval mode is per-channel affine transform,
+    so it's applied as single addcmul. Activation is done in-place on normalized tensor.
+    """
+    def __init__(self, norm, act):
+        super().__init__()
+        self.act = act
+        self.norm = None
+        if isinstance(norm, nn.BatchNorm2d):
+            scale, shift = batch_norm_scale_shift(norm)
+            self.register_buffer('scale', scale.reshape(1, -1, 1, 1))
+            self.register_buffer('shift', shift.reshape(1, -1, 1, 1))
+        elif not isinstance(norm, nn.Identity):
+            self.norm = norm
+
+    def forward(self, x):
+        if self.norm is not None:
+            return act_inplace(self.act, self.norm(x))
+        elif hasattr(self, 'scale'):
+            return act_inplace(self.act, torch.addcmul(self.shift, x, self.scale))
+        # Without norm input tensor must stay untouched
+        return self.act(x)
+
+
+class TDF_fused(nn.Module):
+    """
+    Inference version of TDF bottleneck: norm -> act -> Linear -> norm -> act -> Linear.
+    BatchNorm after first Linear is folded into it: Linear weight is shared by all channels and
+    BatchNorm is per-channel, so fold is applied as in-place affine right after single matmul.
+    """
+    def __init__(self, tdf):
+        super().__init__()
+        self.norm_act1 = NormAct(tdf[0], tdf[1])
+        self.linear1 = tdf[2]
+        self.norm_act2 = NormAct(tdf[3], tdf[4])
+        self.fold = isinstance(tdf[3], nn.BatchNorm2d)
+        self.linear2 = tdf[5]
+
+    def forward(self, x):
+        x = self.linear1(self.norm_act1(x))
+        if self.fold:
+            x = act_inplace(self.norm_act2.act, x.mul_(self.norm_act2.scale).add_(self.norm_act2.shift))
+        else:
+            x = self.norm_act2(x)
+        return self.linear2(x)
+
+
+def fuse_norm_act(sequential):
+    # Sequential(norm, act, conv) -> Sequential(NormAct, conv)
+    return nn.Sequential(NormAct(sequential[0], sequential[1]), *sequential[2:])
+
+
+def fuse_tfc_tdf_net(model, channels_last=None):
+    """
+    Inference-optimized copy of trained TFC_TDF_net (use the same checkpoints: load weights into
+    TFC_TDF_net first, then call this function). Norm/act pairs are fused, BatchNorm is folded where
+    it directly follows linear layer, convolutions run in channels-last memory format.
+    Returned model is for inference only.
+    :param channels_last: None - enabled for all norms except InstanceNorm (it has no channels-last
+    kernels and makes every block slower on CPU)
+    """
+    if channels_last is None:
+        channels_last = model.config.model.norm != 'InstanceNorm'
+    model = copy.deepcopy(model).eval()
+    for module in list(model.modules()):
+        if isinstance(module, TFC_TDF):
+            for block in module.blocks:
+                block.tfc1 = fuse_norm_act(block.tfc1)
+                block.tdf = TDF_fused(block.tdf)
+                block.tfc2 = fuse_norm_act(block.tfc2)
+        elif isinstance(module, (Upscale, Downscale)):
+            module.conv = fuse_norm_act(module.conv)
+    model.channels_last = channels_last
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
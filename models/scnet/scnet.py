@@ -1,8 +1,8 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from collections import deque
 from .separation import SeparationNet
+from models.stft import get_window
 import typing as tp
 import math
 
@@ -68,8 +68,11 @@ class FusionLayer(nn.Module):
     def forward(self, x, skip=None):
         if skip is not None:
             x += skip
-        x = x.repeat(1, 2, 1, 1)
-        x = self.conv(x)
+        # Input is repeated twice along channels before convolution: conv([x, x]) = conv with summed halves
+        # of weight applied to x. Same result with half of computations and without repeated tensor.
+        channels = x.shape[1]
+        weight = self.conv.weight[:, :channels] + self.conv.weight[:, channels:]
+        x = F.conv2d(x, weight, self.conv.bias, self.conv.stride, self.conv.padding)
         x = F.glu(x, dim=1)
         return x
 
@@ -103,35 +106,43 @@ class SDlayer(nn.Module):
         # Saving rate proportions for determining splits
         self.SR_low = band_configs['low']['SR']
         self.SR_mid = band_configs['mid']['SR']
+        self.plans = dict()
+
+    def get_plan(self, Fr):
+        # Band borders and paddings depend only on number of frequencies, so they are computed once
+        if Fr not in self.plans:
+            splits = [
+                (0, math.ceil(Fr * self.SR_low)),
+                (math.ceil(Fr * self.SR_low), math.ceil(Fr * (self.SR_low + self.SR_mid))),
+                (math.ceil(Fr * (self.SR_low + self.SR_mid)), Fr)
+            ]
+            plan = []
+            for stride, kernel, (start, end) in zip(self.strides, self.kernels, splits):
+                current_length = end - start
+                if stride == 1:
+                    total_padding = kernel - stride
+                else:
+                    total_padding = (stride - current_length % stride) % stride
+                pad_left = total_padding // 2
+                pad_right = total_padding - pad_left
+                plan.append((start, end, pad_left, pad_right))
+            self.plans[Fr] = plan
+        return self.plans[Fr]
 
     def forward(self, x):
         B, C, Fr, T = x.shape
-        # Define splitting points based on sampling rates
-        splits = [
-            (0, math.ceil(Fr * self.SR_low)),
-            (math.ceil(Fr * self.SR_low), math.ceil(Fr * (self.SR_low + self.SR_mid))),
-            (math.ceil(Fr * (self.SR_low + self.SR_mid)), Fr)
-        ]
 
         # Processing each band with the corresponding convolution
         outputs = []
         original_lengths = []
-        for conv, stride, kernel, (start, end) in zip(self.convs, self.strides, self.kernels, splits):
+        for conv, (start, end, pad_left, pad_right) in zip(self.convs, self.get_plan(Fr)):
             extracted = x[:, :, start:end, :]
             original_lengths.append(end - start)
-            current_length = extracted.shape[2]
-
-            # padding
-            if stride == 1:
-                total_padding = kernel - stride
+            if pad_left == pad_right:
+                # Symmetric padding is done inside convolution without padded copy of band
+                output = F.conv2d(extracted, conv.weight, conv.bias, conv.stride, (pad_left, 0))
             else:
-                total_padding = (stride - current_length % stride) % stride
-            pad_left = total_padding // 2
-            pad_right = total_padding - pad_left
-
-            padded = F.pad(extracted, (0, 0, pad_left, pad_right))
-
-            output = conv(padded)
+                output = conv(F.pad(extracted, (0, 0, pad_left, pad_right)))
             outputs.append(output)
 
         return outputs, original_lengths
@@ -159,21 +170,28 @@ class SUlayer(nn.Module):
     def forward(self, x, lengths, origin_lengths):
         B, C, Fr, T = x.shape
         # Define splitting points based on input lengths
-        splits = [
-            (0, lengths[0]),
-            (lengths[0], lengths[0] + lengths[1]),
-            (lengths[0] + lengths[1], None)
-        ]
+        starts = [0, lengths[0], lengths[0] + lengths[1], Fr]
         # Processing each band with the corresponding convolution
         outputs = []
-        for idx, (convtr, (start, end)) in enumerate(zip(self.convtrs, splits)):
-            out = convtr(x[:, :, start:end, :])
+        for idx, convtr in enumerate(self.convtrs):
+            band = x[:, :, starts[idx]:starts[idx + 1], :]
+            kernel, stride = convtr.kernel_size[0], convtr.stride[0]
+            current_Fr_length = (band.shape[2] - 1) * stride + kernel
             # Calculate the distance to trim the output symmetrically to original length
-            current_Fr_length = out.shape[2]
             dist = abs(origin_lengths[idx] - current_Fr_length) // 2
-
-            # Trim the output to the original length symmetrically
-            trimmed_out = out[:, :, dist:dist + origin_lengths[idx], :]
+            if kernel == stride:
+                # Transposed convolution without overlap is matmul of every input frequency with kernel,
+                # only frequencies which stay after trim are computed
+                first = dist // stride
+                last = min(band.shape[2], -(-(dist + origin_lengths[idx]) // stride))
+                out = torch.einsum('bcft,cok->bofkt', band[:, :, first:last], convtr.weight[..., 0])
+                out = out.reshape(B, out.shape[1], -1, T) + convtr.bias[:, None, None]
+                offset = dist - first * stride
+                trimmed_out = out[:, :, offset:offset + origin_lengths[idx], :]
+            else:
+                out = convtr(band)
+                # Trim the output to the original length symmetrically
+                trimmed_out = out[:, :, dist:dist + origin_lengths[idx], :]
 
             outputs.append(trimmed_out)
 
@@ -247,6 +265,8 @@ class SCNet(nn.Module):
     - conv_kernel (int): Kernel size for convolution layer in convolution module.
     - num_dplayer (int): Number of dual-path layers.
     - expand (int): Expansion factor in the dual-path RNN, default is 1.
+    - causal_time_rnn (bool): Use causal time-path LSTM. Such model can be used in streaming mode, where
+      chunks don't overlap and LSTM state is carried from one chunk to the next one (see forward_stream).
 
     """
 
@@ -271,11 +291,13 @@ class SCNet(nn.Module):
                  # Dual-path RNN
                  num_dplayer=6,
                  expand=1,
+                 causal_time_rnn=False,
                  ):
         super().__init__()
         self.sources = sources
         self.audio_channels = audio_channels
         self.dims = dims
+        self.causal_time_rnn = causal_time_rnn
         band_keys = ['low', 'mid', 'high']
         self.band_configs = {band_keys[i]: {'SR': band_SR[i], 'stride': band_stride[i], 'kernel': band_kernel[i]} for i
                              in range(len(band_keys))}
@@ -320,11 +342,25 @@ class SCNet(nn.Module):
             channels=dims[-1],
             expand=expand,
             num_layers=num_dplayer,
+            causal=causal_time_rnn,
         )
 
     def forward(self, x):
+        return self.forward_stream(x)[0]
+
+    def forward_stream(self, x, state=None, length=None):
+        """
+        Same as forward, but also takes and returns state of causal time-path LSTMs. To process long audio
+        call it for consecutive chunks passing state returned for the previous chunk.
+        length - number of real samples in x if it was padded by caller (default: whole x). Returned state
+        is taken after the last STFT frame of real audio, so padding doesn't get into the next chunk.
+        """
         # B, C, L = x.shape
         B = x.shape[0]
+        if length is None:
+            length = x.shape[-1]
+        # With center=True frame t is centered at sample t * hop_length
+        n_frames = (length + self.hop_length - 1) // self.hop_length
         # In the initial padding, ensure that the number of frames after the STFT (the length of the T dimension) is even,
         # so that the RFFT operation can be used in the separation network.
         padding = self.hop_length - x.shape[-1] % self.hop_length
@@ -335,16 +371,19 @@ class SCNet(nn.Module):
         # STFT
         L = x.shape[-1]
         x = x.reshape(-1, L)
-        x = torch.stft(x, **self.stft_config, return_complex=True)
+        # Rectangular window (torch.stft default when no window is given), which SCNet weights are trained with
+        window = get_window(self.stft_config['win_length'], x.device, window_fn=torch.ones)
+        x = torch.stft(x, **self.stft_config, window=window, return_complex=True)
         x = torch.view_as_real(x)
         x = x.permute(0, 3, 1, 2).reshape(x.shape[0] // self.audio_channels, x.shape[3] * self.audio_channels,
                                           x.shape[1], x.shape[2])
 
         B, C, Fr, T = x.shape
 
-        save_skip = deque()
-        save_lengths = deque()
-        save_original_lengths = deque()
+        # Plain lists used as stacks (instead of deque) to keep forward traceable by torch.compile / torch.jit.trace
+        save_skip = []
+        save_lengths = []
+        save_original_lengths = []
         # encoder
         for sd_layer in self.encoder:
             x, skip, lengths, original_lengths = sd_layer(x)
@@ -353,7 +392,7 @@ class SCNet(nn.Module):
             save_original_lengths.append(original_lengths)
 
         # separation
-        x = self.separation_net(x)
+        x, state = self.separation_net(x, state, n_frames)
 
         # decoder
         for fusion_layer, su_layer in self.decoder:
@@ -365,9 +404,9 @@ class SCNet(nn.Module):
         x = x.view(B, n, -1, Fr, T)
         x = x.reshape(-1, 2, Fr, T).permute(0, 2, 3, 1)
         x = torch.view_as_complex(x.contiguous())
-        x = torch.istft(x, **self.stft_config)
+        x = torch.istft(x, **self.stft_config, window=window)
         x = x.reshape(B, len(self.sources), self.audio_channels, -1)
 
         x = x[:, :, :, :-padding]
 
-        return x
+        return x, state
@@ -42,23 +42,37 @@ class DualPathRNN(nn.Module):
         d_model (int): The number of expected features in the input (input_size).
         expand (int): Expansion factor used to calculate the hidden_size of LSTM.
         bidirectional (bool): If True, becomes a bidirectional LSTM.
+        causal (bool): If True, time-path LSTM is unidirectional, so its hidden state can be carried
+                       between consecutive chunks in streaming mode.
     """
 
-    def __init__(self, d_model, expand, bidirectional=True):
+    def __init__(self, d_model, expand, bidirectional=True, causal=False):
         super(DualPathRNN, self).__init__()
 
         self.d_model = d_model
         self.hidden_size = d_model * expand
         self.bidirectional = bidirectional
+        self.causal = causal
         # Initialize LSTM layers and normalization layers
-        self.lstm_layers = nn.ModuleList([self._init_lstm_layer(self.d_model, self.hidden_size) for _ in range(2)])
-        self.linear_layers = nn.ModuleList([nn.Linear(self.hidden_size * 2, self.d_model) for _ in range(2)])
+        self.lstm_layers = nn.ModuleList([
+            self._init_lstm_layer(self.d_model, self.hidden_size, bidirectional),
+            self._init_lstm_layer(self.d_model, self.hidden_size, bidirectional and not causal),
+        ])
+        self.linear_layers = nn.ModuleList([
+            nn.Linear(self.hidden_size * (2 if lstm.bidirectional else 1), self.d_model) for lstm in self.lstm_layers
+        ])
         self.norm_layers = nn.ModuleList([nn.GroupNorm(1, d_model) for _ in range(2)])
 
-    def _init_lstm_layer(self, d_model, hidden_size):
-        return LSTM(d_model, hidden_size, num_layers=1, bidirectional=self.bidirectional, batch_first=True)
+    def _init_lstm_layer(self, d_model, hidden_size, bidirectional):
+        return LSTM(d_model, hidden_size, num_layers=1, bidirectional=bidirectional, batch_first=True)
 
-    def forward(self, x):
+    def forward(self, x, state=None, n_frames=None):
+        """
+        :param state: (h, c) of time-path LSTM from previous chunk (only used if causal)
+        :param n_frames: number of frames made from real audio, the rest are padding frames. Returned state is
+                         taken after the last real frame, padding frames are processed starting from it
+        :return: output and (h, c) of time-path LSTM for the next chunk (None if not causal)
+        """
         B, C, F, T = x.shape
 
         # Process dual-path rnn
@@ -75,12 +89,20 @@ class DualPathRNN(nn.Module):
         # Time-path
         x = self.norm_layers[1](x)
         x = x.transpose(1, 2).contiguous().view(B * F, C, T).transpose(1, 2)
-        x, _ = self.lstm_layers[1](x)
+        if self.causal and n_frames is not None and n_frames < T:
+            x_real, state = self.lstm_layers[1](x[:, :n_frames], state)
+            x_pad, _ = self.lstm_layers[1](x[:, n_frames:], state)
+            x = torch.cat([x_real, x_pad], dim=1)
+        elif self.causal:
+            x, state = self.lstm_layers[1](x, state)
+        else:
+            x, _ = self.lstm_layers[1](x)
+            state = None
         x = self.linear_layers[1](x)
         x = x.transpose(1, 2).contiguous().view(B, F, C, T).transpose(1, 2)
         x = x + original_x
 
-        return x
+        return x, state
 
 
 class SeparationNet(nn.Module):
@@ -91,23 +113,30 @@ class SeparationNet(nn.Module):
     - channels (int): Number input channels.
     - expand (int): Expansion factor used to calculate the hidden_size of LSTM.
     - num_layers (int): Number of dual-path layers.
+    - causal (bool): Use causal time-path LSTM in dual-path layers which work on time axis. Odd layers work on
+      RFFT of time axis (whole chunk), so they stay bidirectional.
     """
 
-    def __init__(self, channels, expand=1, num_layers=6):
+    def __init__(self, channels, expand=1, num_layers=6, causal=False):
         super(SeparationNet, self).__init__()
 
         self.num_layers = num_layers
 
         self.dp_modules = nn.ModuleList([
-            DualPathRNN(channels * (2 if i % 2 == 1 else 1), expand) for i in range(num_layers)
+            DualPathRNN(channels * (2 if i % 2 == 1 else 1), expand, causal=causal and i % 2 == 0)
+            for i in range(num_layers)
         ])
 
         self.feature_conversion = nn.ModuleList([
             FeatureConversion(channels * 2, inverse=False if i % 2 == 0 else True) for i in range(num_layers)
         ])
 
-    def forward(self, x):
+    def forward(self, x, states=None, n_frames=None):
+        if states is None:
+            states = [None] * self.num_layers
+        new_states = []
         for i in range(self.num_layers):
-            x = self.dp_modules[i](x)
+            x, state = self.dp_modules[i](x, states[i], n_frames)
+            new_states.append(state)
             x = self.feature_conversion[i](x)
-        return x
+        return x, new_states
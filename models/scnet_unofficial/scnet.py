@@ -13,6 +13,7 @@ import torchaudio
 
 from models.scnet_unofficial.modules import DualPathRNN, SDBlock, SUBlock
 from models.scnet_unofficial.utils import compute_sd_layer_shapes, compute_gcr
+from models.stft import get_window
 
 from einops import rearrange, pack, unpack
 from functools import partial
@@ -177,7 +178,7 @@ class SCNet(nn.Module):
             normalized=stft_normalized
         )
 
-        self.stft_window_fn = partial(default(stft_window_fn, torch.hann_window), win_length)
+        self.stft_window_fn = partial(get_window, win_length, window_fn=default(stft_window_fn, torch.hann_window))
         self.n_sources = n_sources
         self.hop_length = hop_length
 
@@ -0,0 +1,66 @@
+import math
+import torch
+
+
+# Windows are created only once for every (window function, length, device, dtype)
+_window_cache = dict()
+
+
+def get_window(window_length, device=None, dtype=torch.float32, window_fn=torch.hann_window):
+    key = (window_fn, window_length, str(device), dtype)
+    window = _window_cache.get(key)
+    if window is None:
+        # Window can be first requested inside inference_mode (validation before training). Inference tensors
+        # can't be saved for backward, so always create normal tensor.
+        with torch.inference_mode(False):
+            window = window_fn(window_length, device=device, dtype=dtype)
+        _window_cache[key] = window
+    return window
+
+
+class STFT:
+    """
+    STFT with real-view layout used by spectrogram models (mdx23c, segm_models, torchseg, swin_upernet):
+    (..., channels, time) -> (..., channels * 2, dim_f, frames) and back.
+    """
+    def __init__(self, config):
+        self.n_fft = config.n_fft
+        self.hop_length = config.hop_length
+        self.dim_f = config.dim_f
+
+    def __call__(self, x):
+        window = get_window(self.n_fft, x.device)
+        batch_dims = x.shape[:-2]
+        c, t = x.shape[-2:]
+        x = x.reshape([-1, t])
+        x = torch.stft(
+            x,
+            n_fft=self.n_fft,
+            hop_length=self.hop_length,
+            window=window,
+            center=True,
+            return_complex=True
+        )
+        # Views only, frequencies are cut before the single copy in reshape
+        x = torch.view_as_real(x)[:, :self.dim_f]
+        x = x.permute([0, 3, 1, 2])
+        return x.reshape([*batch_dims, c * 2, -1, x.shape[-1]])
+
+    def inverse(self, x):
+        window = get_window(self.n_fft, x.device)
+        batch_dims = x.shape[:-3]
+        c, f, t = x.shape[-3:]
+        n = self.n_fft // 2 + 1
+        # Real/imag parts are written directly into real view of complex spectrogram,
+        # cut high frequencies stay zero (no separate padding tensor and concatenation)
+        spec = torch.zeros([math.prod(batch_dims) * c // 2, n, t, 2], dtype=torch.float32, device=x.device)
+        spec[:, :f] = x.reshape([-1, 2, f, t]).permute([0, 2, 3, 1])
+        x = torch.istft(
+            torch.view_as_complex(spec),
+            n_fft=self.n_fft,
+            hop_length=self.hop_length,
+            window=window,
+            center=True
+        )
+        x = x.reshape([*batch_dims, 2, -1])
+        return x
@@ -6,23 +6,29 @@ import torch
 import torch.nn as nn
 import numpy as np
 from torch.utils.checkpoint import checkpoint_sequential
+from models.stft import get_window
 try:
     from mamba_ssm.modules.mamba2 import Mamba2
+    LOCAL_MAMBA2 = False
 except Exception as e:
     print('Exception during load Mamba2 modules: {}'.format(str(e)))
     print('Load local torch implementation!')
     from .ex_bi_mamba2 import Mamba2
+    LOCAL_MAMBA2 = True
 
 
 class MambaBlock(nn.Module):
-    def __init__(self, in_channels):
+    def __init__(self, in_channels, ssd_mode='chunked'):
         super(MambaBlock, self).__init__()
+        # ssd_mode ('chunked' or 'scan') is an option of local torch implementation only
+        mamba2_args = dict(ssd_mode=ssd_mode) if LOCAL_MAMBA2 else dict()
         self.forward_mamba2 = Mamba2(
             d_model=in_channels,  
             d_state=128,  
             d_conv=4,  
             expand=4,
             headdim=64,
+            **mamba2_args,
         )
 
         self.backward_mamba2 = Mamba2(
@@ -31,6 +37,7 @@ class MambaBlock(nn.Module):
             d_conv=4, 
             expand=4,  
             headdim=64,
+            **mamba2_args,
         )
     def forward(self, input):
         forward_f = input
@@ -88,7 +95,7 @@ class TAC(nn.Module):
         return output
 
 class ResMamba(nn.Module):
-    def __init__(self, input_size, hidden_size, dropout=0., bidirectional=True):
+    def __init__(self, input_size, hidden_size, dropout=0., bidirectional=True, ssd_mode='chunked'):
         super(ResMamba, self).__init__()
 
         self.input_size = input_size
@@ -97,7 +104,7 @@ class ResMamba(nn.Module):
 
         self.norm = nn.GroupNorm(1, input_size, self.eps)
         self.dropout = nn.Dropout(p=dropout)
-        self.rnn = MambaBlock(input_size)
+        self.rnn = MambaBlock(input_size, ssd_mode)
         self.proj = nn.Linear(input_size*2 ,input_size)
         # linear projection layer
 
@@ -111,14 +118,14 @@ class ResMamba(nn.Module):
         return input + rnn_output.transpose(1, 2).contiguous()
 
 class BSNet(nn.Module):
-    def __init__(self, in_channel, nband=7):
+    def __init__(self, in_channel, nband=7, ssd_mode='chunked'):
         super(BSNet, self).__init__()
 
         self.nband = nband
         self.feature_dim = in_channel // nband
 
-        self.band_rnn = ResMamba(self.feature_dim, self.feature_dim*2)
-        self.band_comm = ResMamba(self.feature_dim, self.feature_dim*2)
+        self.band_rnn = ResMamba(self.feature_dim, self.feature_dim*2, ssd_mode=ssd_mode)
+        self.band_comm = ResMamba(self.feature_dim, self.feature_dim*2, ssd_mode=ssd_mode)
         self.channel_comm = TAC(self.feature_dim, self.feature_dim*3)
 
     def forward(self, input):
@@ -138,7 +145,8 @@ class BSNet(nn.Module):
         return output.view(B, nch, N, T)
 
 class Separator(nn.Module):
-    def __init__(self, sr=44100, win=2048, stride=512, feature_dim=128, num_repeat_mask=8, num_repeat_map=4, num_output=4):
+    def __init__(self, sr=44100, win=2048, stride=512, feature_dim=128, num_repeat_mask=8, num_repeat_map=4, num_output=4,
+                 ssd_mode='chunked'):
         super(Separator, self).__init__()
         
         self.sr = sr
@@ -183,12 +191,12 @@ class Separator(nn.Module):
 
         self.separator_mask = []
         for i in range(num_repeat_mask):
-            self.separator_mask.append(BSNet(self.nband*self.feature_dim, self.nband))
+            self.separator_mask.append(BSNet(self.nband*self.feature_dim, self.nband, ssd_mode))
         self.separator_mask = nn.Sequential(*self.separator_mask)
         
         self.separator_map = []
         for i in range(num_repeat_map):
-            self.separator_map.append(BSNet(self.nband * self.feature_dim, self.nband))
+            self.separator_map.append(BSNet(self.nband * self.feature_dim, self.nband, ssd_mode))
         self.separator_map = nn.Sequential(*self.separator_map)
 
         self.in_conv = nn.Conv1d(self.feature_dim*2, self.feature_dim, 1)
@@ -237,7 +245,7 @@ class Separator(nn.Module):
        
         # frequency-domain separation
         spec = torch.stft(input, n_fft=self.win, hop_length=self.stride, 
-                          window=torch.hann_window(self.win).to(input.device).type(input.type()),
+                          window=get_window(self.win, input.device, dtype=input.dtype),
                           return_complex=True)
 
         # concat real and imag, split to subbands
@@ -301,10 +309,10 @@ class Separator(nn.Module):
 
         output = torch.istft(sep_subband_spec.view(batch_size*nch*self.num_output, self.enc_dim, -1), 
                              n_fft=self.win, hop_length=self.stride, 
-                             window=torch.hann_window(self.win).to(input.device).type(input.type()), length=nsample)
+                             window=get_window(self.win, input.device, dtype=input.dtype), length=nsample)
         output_mask = torch.istft(est_spec_mask.view(batch_size*nch*self.num_output, self.enc_dim, -1),
                              n_fft=self.win, hop_length=self.stride,
-                             window=torch.hann_window(self.win).to(input.device).type(input.type()), length=nsample)
+                             window=get_window(self.win, input.device, dtype=input.dtype), length=nsample)
 
         output = output.view(batch_size, nch, self.num_output, -1).transpose(1,2).contiguous()
         output_mask = output_mask.view(batch_size, nch, self.num_output, -1).transpose(1,2).contiguous()
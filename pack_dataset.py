@@ -0,0 +1,184 @@
+# coding: utf-8
+__author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
+
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import numpy as np
+import soundfile as sf
+import pedalboard as PB
+from glob import glob
+from tqdm.auto import tqdm
+
+from dataset import get_track_set_length, PACK_INDEX_NAME, PACK_VERSION
+
+
+def convert_stems(stems, dtype):
+    if dtype == 'int16':
+        stems = np.clip(np.round(stems * 32768), -32768, 32767)
+    return stems.astype(dtype)
+
+
+def render_variant(stems, sample_rate, pitch, tempo, length):
+    """
+    Pitch shifted and time stretched copy of all stems with given length. Silent stems aren't processed.
+    """
+    res = np.zeros((stems.shape[0], 2, length), dtype=np.float32)
+    for i in range(stems.shape[0]):
+        if not np.any(stems[i]):
+            continue
+        x = PB.time_stretch(stems[i], sample_rate, stretch_factor=tempo, pitch_shift_in_semitones=pitch)
+        res[i, :, :min(x.shape[1], length)] = x[:, :length]
+    return res
+
+
+def read_track_stems(params):
+    """
+    Decode all stems of track folder into array with shape (stems, 2, length). Mono stems are
+    duplicated to stereo, missing stems are zeros. Precomputed pitch/tempo variants follow the original.
+    """
+    path, instruments, file_types, length, sample_rate, variants, dtype = params
+    stems = np.zeros((len(instruments), 2, length), dtype=np.float32)
+    for i, instr in enumerate(instruments):
+        for extension in file_types:
+            path_to_audio_file = path + '/{}.{}'.format(instr, extension)
+            if os.path.isfile(path_to_audio_file):
+                x = sf.read(path_to_audio_file, dtype='float32', frames=length, always_2d=True)[0].T
+                stems[i, :, :x.shape[1]] = x[:2]
+                break
+        else:
+            print('Cant find file "{}" in folder {}. Zeros are used.'.format(instr, path))
+    res = [convert_stems(stems, dtype)]
+    for pitch, tempo, variant_length in variants:
+        res.append(convert_stems(render_variant(stems, sample_rate, pitch, tempo, variant_length), dtype))
+    return path, res
+
+
+def get_track_sample_rates(path, instruments, file_types):
+    """
+    Sample rate of every stem file of track folder as dict file path -> sample rate.
+    """
+    res = dict()
+    for instr in instruments:
+        for extension in file_types:
+            path_to_audio_file = path + '/{}.{}'.format(instr, extension)
+            if os.path.isfile(path_to_audio_file):
+                res[path_to_audio_file] = sf.info(path_to_audio_file).samplerate
+                break
+    return res
+
+
+def get_variant_length(length, tempo):
+    # Length of time stretched audio (faster tempo gives shorter audio)
+    return int(math.ceil(length / tempo))
+
+
+def pack_dataset(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", nargs="+", type=str, help="folders with dataset of type 1 (folder per track with stem files)")
+    parser.add_argument("--output_path", type=str, help="folder where packed dataset will be stored")
+    parser.add_argument("--instruments", nargs="+", type=str, help="stems to pack (for example: vocals bass drums other)")
+    parser.add_argument("--dtype", type=str, default='float16', choices=['float16', 'int16'], help="sample type in shards")
+    parser.add_argument("--shard_size", type=float, default=2.0, help="maximum size of one shard in GB")
+    parser.add_argument("--read_procs", type=int, default=multiprocessing.cpu_count(), help="processes used to decode audio")
+    parser.add_argument("--pitch_variants", nargs="+", type=float, default=[], help="pitch shifts in semitones of precomputed variants (for example: -2 2)")
+    parser.add_argument("--tempo_variants", nargs="+", type=float, default=[], help="tempo rates of precomputed variants (for example: 0.9 1.1)")
+    if args is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(args)
+
+    file_types = ['wav', 'flac']
+    track_paths = []
+    for tp in args.data_path:
+        track_paths += sorted(glob(tp + '/*'))
+    track_paths = [path for path in track_paths if os.path.basename(path)[0] != '.' and os.path.isdir(path)]
+    print('Tracks found: {}'.format(len(track_paths)))
+
+    # Lengths and sample rates are taken from headers, so planning of shards is fast
+    lengths = dict()
+    sample_rates = dict()
+    for path in tqdm(track_paths):
+        lengths[path] = int(get_track_set_length((path, args.instruments, file_types))[1])
+        sample_rates.update(get_track_sample_rates(path, args.instruments, file_types))
+
+    # Shards store raw samples with single sample rate in index, so all stems must have the same rate
+    sample_rate = next(iter(sample_rates.values()), None)
+    mismatch = [(f, sr) for f, sr in sample_rates.items() if sr != sample_rate]
+    if len(mismatch) > 0:
+        print('Sample rate of {} files differs from {} Hz ({}). Resample them before packing:'.format(
+            len(mismatch), sample_rate, list(sample_rates.keys())[0]))
+        for f, sr in mismatch[:10]:
+            print('  {}: {} Hz'.format(f, sr))
+        exit()
+
+    # Quantized pitch/tempo variants of every track are rendered once here, training samples among them
+    # instead of running pitch shift and time stretch on every chunk (see packed_variants in docs/augmentations.md)
+    variants = [
+        (pitch, tempo) for pitch, tempo in itertools.product([0.0] + args.pitch_variants, [1.0] + args.tempo_variants)
+        if pitch != 0.0 or tempo != 1.0
+    ]
+    if len(variants) > 0:
+        print('Variants (pitch, tempo) for every track: {}'.format(variants))
+
+    # Every track is stored as continuous block (stems, 2, length), so any chunk of stem is two slices.
+    # Blocks of track variants follow block of original track
+    item_size = np.dtype(args.dtype).itemsize
+    max_shard_elements = int(args.shard_size * 1024 ** 3) // item_size
+    tracks = []
+    shard_sizes = [0]
+    params = []
+    for path in track_paths:
+        blocks = [(lengths[path], None, 0.0, 1.0)]
+        blocks += [(get_variant_length(lengths[path], tempo), len(tracks), pitch, tempo) for pitch, tempo in variants]
+        size = len(args.instruments) * 2 * sum(b[0] for b in blocks)
+        if shard_sizes[-1] > 0 and shard_sizes[-1] + size > max_shard_elements:
+            shard_sizes.append(0)
+        for length, variant_of, pitch, tempo in blocks:
+            track = {'path': path, 'shard': len(shard_sizes) - 1, 'offset': shard_sizes[-1], 'length': length}
+            if variant_of is not None:
+                track.update({'variant_of': variant_of, 'pitch': pitch, 'tempo': tempo})
+            tracks.append(track)
+            shard_sizes[-1] += len(args.instruments) * 2 * length
+        params.append((path, args.instruments, file_types, lengths[path], sample_rate, [
+            (pitch, tempo, get_variant_length(lengths[path], tempo)) for pitch, tempo in variants
+        ], args.dtype))
+
+    os.makedirs(args.output_path, exist_ok=True)
+    shard_names = ['shard_{:05d}.npy'.format(i) for i in range(len(shard_sizes))]
+    shards = [
+        np.lib.format.open_memmap(os.path.join(args.output_path, name), mode='w+', dtype=args.dtype, shape=(size,))
+        for name, size in zip(shard_names, shard_sizes)
+    ]
+
+    originals = [t for t in tracks if 'variant_of' not in t]
+    p = multiprocessing.Pool(processes=max(args.read_procs, 1))
+    for track, (path, blocks) in tqdm(zip(originals, p.imap(read_track_stems, params)), total=len(originals)):
+        # Blocks of one track are continuous in shard
+        data = np.concatenate([stems.reshape(-1) for stems in blocks])
+        shards[track['shard']][track['offset']:track['offset'] + data.size] = data
+    p.close()
+    for shard in shards:
+        shard.flush()
+
+    index = {
+        'version': PACK_VERSION,
+        'dtype': args.dtype,
+        'sample_rate': sample_rate,
+        'instruments': args.instruments,
+        'shards': shard_names,
+        'variants': variants,
+        'tracks': tracks,
+    }
+    with open(os.path.join(args.output_path, PACK_INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+    print('Packed {} tracks ({} with variants) into {} shards ({:.2f} GB): {}'.format(
+        len(originals), len(tracks), len(shards), sum(shard_sizes) * item_size / 1024 ** 3, args.output_path
+    ))
+
+
+if __name__ == "__main__":
+    pack_dataset(None)
@@ -0,0 +1,259 @@
+# coding: utf-8
+__author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
+
+import argparse
+import os
+import sys
+import yaml
+import numpy as np
+import torch
+import torch.nn as nn
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+from utils import get_model_from_config
+
+
+# Both roformers have their own (but identical) attention classes, so check by name
+def is_linear_attention(module):
+    return type(module).__name__ == 'LinearAttention'
+
+
+def is_attention(module):
+    return type(module).__name__ in ['Attention', 'LinearAttention']
+
+
+def head_importance(attn):
+    """
+    Importance of each head = norm of its value projection multiplied by norm of its part of output projection.
+    Works for both Attention and LinearAttention.
+    :return: numpy array with shape (heads, )
+    """
+    if is_linear_attention(attn):
+        qkv = attn.to_qkv[0].weight
+        out = attn.to_out[1].weight
+        heads = attn.temperature.shape[0]
+    else:
+        qkv = attn.to_qkv.weight
+        out = attn.to_out[0].weight
+        heads = attn.heads
+    dim_inner = out.shape[1]
+    v = qkv.reshape(3, heads, dim_inner // heads, -1)[2]
+    o = out.reshape(out.shape[0], heads, dim_inner // heads)
+    score = v.pow(2).sum(dim=(1, 2)).sqrt() * o.pow(2).sum(dim=(0, 2)).sqrt()
+    return score.detach().cpu().numpy()
+
+
+def layer_importance(layer):
+    """
+    Importance of depth block = sum of norms of output projections (attention and feed forward) which
+    write to residual stream inside all transformers of the block.
+    """
+    score = 0.
+    for transformer in layer:
+        for attn, ff in transformer.layers:
+            out = attn.to_out[1] if is_linear_attention(attn) else attn.to_out[0]
+            score += out.weight.norm().item()
+            score += ff.net[4].weight.norm().item()
+    return score
+
+
+def mlp_linears(mask_mlp):
+    # mask_mlp = Sequential(MLP, GLU)
+    return [m for m in mask_mlp[0] if isinstance(m, nn.Linear)]
+
+
+def hidden_importance(model):
+    """
+    Importance of each hidden unit in mask estimators. Hidden layers have the same width in all
+    bands and stems, so scores are summed over them to keep config consistent.
+    :return: list of numpy arrays (one per hidden layer)
+    """
+    scores = None
+    for mask_estimator in model.mask_estimators:
+        for mlp in mask_estimator.to_freqs:
+            linears = mlp_linears(mlp)
+            current = []
+            for l_in, l_out in zip(linears[:-1], linears[1:]):
+                s = l_in.weight.norm(dim=1) * l_out.weight.norm(dim=0)
+                current.append(s.detach().cpu().numpy())
+            if scores is None:
+                scores = current
+            else:
+                scores = [a + b for a, b in zip(scores, current)]
+    return scores
+
+
+def top_k(scores, k):
+    return np.sort(np.argsort(-scores, kind='stable')[:k])
+
+
+def prune_attention(old, new, keep_heads):
+    keep_heads = torch.from_numpy(keep_heads)
+    if is_linear_attention(old):
+        old_qkv, new_qkv = old.to_qkv[0], new.to_qkv[0]
+        old_out, new_out = old.to_out[1], new.to_out[1]
+        heads = old.temperature.shape[0]
+        new.temperature.data.copy_(old.temperature.data[keep_heads])
+    else:
+        old_qkv, new_qkv = old.to_qkv, new.to_qkv
+        old_out, new_out = old.to_out[0], new.to_out[0]
+        heads = old.heads
+        new.to_gates.weight.data.copy_(old.to_gates.weight.data[keep_heads])
+        new.to_gates.bias.data.copy_(old.to_gates.bias.data[keep_heads])
+    new.norm.load_state_dict(old.norm.state_dict())
+
+    dim = old_qkv.weight.shape[1]
+    qkv = old_qkv.weight.data.reshape(3, heads, -1, dim)[:, keep_heads]
+    new_qkv.weight.data.copy_(qkv.reshape(-1, dim))
+    out = old_out.weight.data.reshape(dim, heads, -1)[:, keep_heads]
+    new_out.weight.data.copy_(out.reshape(dim, -1))
+
+
+def prune_mask_mlp(old, new, keep_hidden):
+    old_linears = mlp_linears(old)
+    new_linears = mlp_linears(new)
+    prev = None
+    for i, (l_old, l_new) in enumerate(zip(old_linears, new_linears)):
+        weight = l_old.weight.data
+        bias = l_old.bias.data
+        if prev is not None:
+            weight = weight[:, prev]
+        if i < len(keep_hidden):
+            cur = torch.from_numpy(keep_hidden[i])
+            weight = weight[cur]
+            bias = bias[cur]
+            prev = cur
+        l_new.weight.data.copy_(weight)
+        l_new.bias.data.copy_(bias)
+
+
+def prune_model(model, new_model, keep_layers, keep_heads, keep_hidden):
+    # Everything except transformers and mask estimators has the same shape
+    new_state = new_model.state_dict()
+    for name, value in model.state_dict().items():
+        if name.startswith('layers.') or name.startswith('mask_estimators.'):
+            continue
+        new_state[name] = value
+    new_model.load_state_dict(new_state)
+
+    for new_index, old_index in enumerate(keep_layers):
+        old_layer = model.layers[old_index]
+        new_layer = new_model.layers[new_index]
+        for old_transformer, new_transformer in zip(old_layer, new_layer):
+            new_transformer.norm.load_state_dict(old_transformer.norm.state_dict())
+            for (old_attn, old_ff), (new_attn, new_ff) in zip(old_transformer.layers, new_transformer.layers):
+                prune_attention(old_attn, new_attn, keep_heads[id(old_attn)])
+                new_ff.load_state_dict(old_ff.state_dict())
+
+    for old_estimator, new_estimator in zip(model.mask_estimators, new_model.mask_estimators):
+        for old_mlp, new_mlp in zip(old_estimator.to_freqs, new_estimator.to_freqs):
+            prune_mask_mlp(old_mlp, new_mlp, keep_hidden)
+    return new_model
+
+
+def prune_roformer(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", type=str, default='mel_band_roformer', help="One of mel_band_roformer, bs_roformer")
+    parser.add_argument("--config_path", type=str, help="path to config file")
+    parser.add_argument("--start_check_point", type=str, help="trained checkpoint to prune")
+    parser.add_argument("--output_config_path", type=str, help="where to store config for pruned model")
+    parser.add_argument("--output_check_point", type=str, help="where to store weights of pruned model")
+    parser.add_argument("--depth", type=int, default=None, help="new number of depth blocks (default: keep)")
+    parser.add_argument("--heads", type=int, default=None, help="new number of attention heads (default: keep)")
+    parser.add_argument("--mlp_expansion_factor", type=int, default=None, help="new hidden width factor of mask estimators (default: keep)")
+    parser.add_argument("--distill", action='store_true', help="run short distillation fine-tune with train.py after pruning (original model is teacher)")
+    parser.add_argument("--distill_epochs", type=int, default=10, help="number of epochs for distillation")
+    parser.add_argument("--distill_weight", type=float, default=1.0, help="weight of teacher output in training target (1.0 - pure distillation)")
+    parser.add_argument("--results_path", type=str, help="path to folder where distillation results will be stored")
+    parser.add_argument("--data_path", nargs="+", type=str, help="dataset data paths for distillation")
+    parser.add_argument("--dataset_type", type=int, default=1, help="dataset type for distillation")
+    parser.add_argument("--valid_path", nargs="+", type=str, help="validation data paths for distillation")
+    parser.add_argument("--num_workers", type=int, default=0, help="dataloader num_workers")
+    parser.add_argument("--device_ids", nargs='+', type=int, default=[0], help='list of gpu ids')
+    if args is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(args)
+
+    if args.model_type not in ['mel_band_roformer', 'bs_roformer']:
+        print('Pruning is only supported for mel_band_roformer and bs_roformer. Got: {}'.format(args.model_type))
+        exit()
+
+    model, config = get_model_from_config(args.model_type, args.config_path)
+    state_dict = torch.load(args.start_check_point, map_location='cpu', weights_only=True)
+    model.load_state_dict(state_dict)
+    model.eval()
+
+    with open(args.config_path) as f:
+        raw_config = yaml.load(f, Loader=yaml.FullLoader)
+    model_params = raw_config['model']
+    old_depth = model_params['depth']
+    old_heads = model_params.get('heads', 8)
+    old_mlp_expansion_factor = model_params.get('mlp_expansion_factor', 4)
+    new_depth = args.depth if args.depth is not None else old_depth
+    new_heads = args.heads if args.heads is not None else old_heads
+    new_mlp_expansion_factor = args.mlp_expansion_factor if args.mlp_expansion_factor is not None else old_mlp_expansion_factor
+    if new_depth > old_depth or new_heads > old_heads or new_mlp_expansion_factor > old_mlp_expansion_factor:
+        print('Pruned model must not be bigger than original one')
+        exit()
+
+    # Importance scores
+    layer_scores = np.array([layer_importance(layer) for layer in model.layers])
+    keep_layers = top_k(layer_scores, new_depth)
+    print('Depth block importance: {}'.format(np.round(layer_scores, 3).tolist()))
+    print('Keep depth blocks: {}'.format(keep_layers.tolist()))
+
+    keep_heads = dict()
+    for module in model.modules():
+        if is_attention(module):
+            keep_heads[id(module)] = top_k(head_importance(module), new_heads)
+
+    hidden_scores = hidden_importance(model)
+    new_hidden = model_params['dim'] * new_mlp_expansion_factor
+    keep_hidden = [top_k(s, new_hidden) for s in hidden_scores]
+
+    model_params['depth'] = new_depth
+    model_params['heads'] = new_heads
+    model_params['mlp_expansion_factor'] = new_mlp_expansion_factor
+    if args.distill:
+        raw_config['training']['num_epochs'] = args.distill_epochs
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_config_path)), exist_ok=True)
+    with open(args.output_config_path, 'w') as f:
+        yaml.dump(raw_config, f, default_flow_style=False, sort_keys=False)
+
+    new_model, _ = get_model_from_config(args.model_type, args.output_config_path)
+    new_model = prune_model(model, new_model, keep_layers, keep_heads, keep_hidden)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_check_point)), exist_ok=True)
+    torch.save(new_model.state_dict(), args.output_check_point)
+
+    params_old = sum(p.numel() for p in model.parameters())
+    params_new = sum(p.numel() for p in new_model.parameters())
+    print('Depth: {} -> {} Heads: {} -> {} MLP expansion factor: {} -> {}'.format(
+        old_depth, new_depth, old_heads, new_heads, old_mlp_expansion_factor, new_mlp_expansion_factor
+    ))
+    print('Parameters: {} -> {} ({:.1f}%)'.format(params_old, params_new, 100 * params_new / params_old))
+    print('Pruned config: {}'.format(args.output_config_path))
+    print('Pruned weights: {}'.format(args.output_check_point))
+
+    if args.distill:
+        from train import train_model
+        train_args = [
+            '--model_type', args.model_type,
+            '--config_path', args.output_config_path,
+            '--start_check_point', args.output_check_point,
+            '--results_path', args.results_path,
+            '--dataset_type', str(args.dataset_type),
+            '--num_workers', str(args.num_workers),
+            '--teacher_config_path', args.config_path,
+            '--teacher_check_point', args.start_check_point,
+            '--distill_weight', str(args.distill_weight),
+            '--data_path', *args.data_path,
+            '--valid_path', *args.valid_path,
+            '--device_ids', *[str(d) for d in args.device_ids],
+        ]
+        train_model(train_args)
+
+
+if __name__ == "__main__":
+    prune_roformer(None)
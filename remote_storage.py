@@ -0,0 +1,263 @@
+# coding: utf-8
+__author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
+
+import io
+import os
+import hashlib
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Without disk cache downloaded blocks are kept in memory until they are read. Finished downloads above this
+# number are dropped (oldest first), so blocks which were prefetched but never read don't pile up
+MAX_PENDING_BLOCKS = 256
+
+
+def is_remote_path(path):
+    return isinstance(path, str) and path.startswith('s3://')
+
+
+def join_path(path, name):
+    # Keys in object storage are always separated by '/', os.path.join would use '\\' on Windows
+    if is_remote_path(path):
+        return '{}/{}'.format(path.rstrip('/'), name)
+    return os.path.join(path, name)
+
+
+def split_remote_path(path):
+    # s3://bucket/prefix/name -> (bucket, prefix/name)
+    bucket, _, key = path[len('s3://'):].partition('/')
+    return bucket, key
+
+
+class ChunkCache:
+    """
+    Bounded disk cache of blocks of remote files, shared by all dataloader workers. Blocks are written
+    atomically, least recently used blocks are removed when size of cache is above max_size.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+        # Approximate size (other workers write too), it's recomputed from directory on eviction
+        self.size = None
+
+    def get(self, name):
+        path = os.path.join(self.path, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Modification time is used as last access time for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, name, data):
+        tmp_path = os.path.join(self.path, '.{}.{}.{}'.format(name, os.getpid(), threading.get_ident()))
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.path, name))
+        if self.size is None:
+            self.evict()
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        blocks = []
+        for entry in os.scandir(self.path):
+            if entry.name[0] == '.':
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            blocks.append((st.st_mtime, st.st_size, entry.path))
+        self.size = sum(block[1] for block in blocks)
+        # Cache is cleaned to 90% of limit, so eviction isn't needed on every write
+        for _, size, path in sorted(blocks):
+            if self.size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+class RemoteStorage:
+    """
+    Files in S3-compatible object storage (AWS S3, MinIO, Ceph, ...). Files are read with ranged GET requests
+    by blocks of fixed size, blocks are kept in local disk cache. Blocks of one read are downloaded in parallel.
+    Credentials are taken by boto3 from environment variables or ~/.aws.
+    """
+    def __init__(self, endpoint_url=None, cache_path=None, cache_size=20.0, block_size=1.0, threads=8):
+        self.endpoint_url = endpoint_url
+        self.block_size = int(block_size * 1024 ** 2)
+        self.cache = None
+        if cache_path is not None and cache_size > 0:
+            self.cache = ChunkCache(cache_path, int(cache_size * 1024 ** 3))
+        self.threads = threads
+        # Size and ETag of files
+        self.heads = dict()
+        # Client, threads and downloads in progress are created in every process
+        self.client = None
+        self.pool = None
+        self.lock = threading.RLock()
+        self.pending = dict()
+        self.pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['client'] = None
+        state['pool'] = None
+        state['lock'] = None
+        state['pending'] = dict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self.pid = os.getpid()
+
+    def check_process(self):
+        # Forked dataloader workers inherit client and pool of parent, but not its threads: pool would never
+        # run submitted downloads. They are recreated in every new process
+        if self.pid != os.getpid():
+            self.client = None
+            self.pool = None
+            self.lock = threading.RLock()
+            self.pending = dict()
+            self.pid = os.getpid()
+
+    def get_client(self):
+        self.check_process()
+        if self.client is None:
+            try:
+                import boto3
+            except ImportError:
+                print('Package boto3 is needed for datasets in object storage: pip install boto3')
+                exit()
+            self.client = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self.client
+
+    def get_pool(self):
+        self.check_process()
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        return self.pool
+
+    def head(self, path):
+        head = self.heads.get(path)
+        if head is None:
+            bucket, key = split_remote_path(path)
+            response = self.get_client().head_object(Bucket=bucket, Key=key)
+            head = (response['ContentLength'], response['ETag'].strip('"'))
+            self.heads[path] = head
+        return head
+
+    def signature(self, path):
+        # The same role as size and mtime of local files: cached data is dropped when file is replaced
+        return '{}:{}'.format(*self.head(path))
+
+    def read(self, path):
+        # Whole file without cache (small files like index of packed dataset)
+        bucket, key = split_remote_path(path)
+        return self.get_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+
+    def load_block(self, path, block):
+        size, etag = self.head(path)
+        name = '{}_{}'.format(hashlib.sha1('{}:{}'.format(path, etag).encode()).hexdigest()[:24], block)
+        if self.cache is not None:
+            data = self.cache.get(name)
+            if data is not None:
+                return data
+        start = block * self.block_size
+        end = min(start + self.block_size, size) - 1
+        bucket, key = split_remote_path(path)
+        data = self.get_client().get_object(Bucket=bucket, Key=key, Range='bytes={}-{}'.format(start, end))['Body'].read()
+        if self.cache is not None:
+            self.cache.put(name, data)
+        return data
+
+    def drop_pending(self, key, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+    def submit_blocks(self, path, ranges):
+        # Downloads of blocks for byte ranges (start, size). Blocks already in progress aren't requested again
+        self.check_process()
+        futures = dict()
+        with self.lock:
+            for start, size in ranges:
+                for block in range(start // self.block_size, (start + size - 1) // self.block_size + 1):
+                    key = (path, block)
+                    future = self.pending.get(key)
+                    if future is None:
+                        future = self.get_pool().submit(self.load_block, path, block)
+                        self.pending[key] = future
+                        if self.cache is not None:
+                            # Finished block is in disk cache, next read takes it from there. Failed download
+                            # is dropped too, so it's requested again
+                            future.add_done_callback(lambda f, key=key: self.drop_pending(key, f))
+                    futures[block] = future
+            if len(self.pending) > MAX_PENDING_BLOCKS:
+                for key in [key for key, future in self.pending.items() if future.done()]:
+                    if len(self.pending) <= MAX_PENDING_BLOCKS:
+                        break
+                    del self.pending[key]
+        return futures
+
+    def prefetch(self, path, ranges):
+        # Start downloads of byte ranges which will be read soon, without waiting for them
+        self.submit_blocks(path, ranges)
+
+    def read_ranges(self, path, ranges):
+        """
+        Bytes of ranges (start, size) of file. Only blocks covering these ranges are downloaded.
+        """
+        futures = self.submit_blocks(path, ranges)
+        blocks = {block: future.result() for block, future in futures.items()}
+        with self.lock:
+            for block in futures:
+                self.pending.pop((path, block), None)
+        res = []
+        for start, size in ranges:
+            first = start // self.block_size
+            last = (start + size - 1) // self.block_size
+            data = b''.join(blocks[block] for block in range(first, last + 1))
+            offset = start - first * self.block_size
+            res.append(data[offset:offset + size])
+        return res
+
+
+class RemoteShard:
+    """
+    Shard of packed dataset (.npy file) in object storage. Only requested elements are downloaded.
+    """
+    def __init__(self, storage, path):
+        self.storage = storage
+        self.path = path
+        size = storage.head(path)[0]
+        f = io.BytesIO(storage.read_ranges(path, [(0, min(size, 4096))])[0])
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        self.dtype = dtype
+        self.data_offset = f.tell()
+
+    def get_byte_ranges(self, ranges):
+        itemsize = self.dtype.itemsize
+        return [(self.data_offset + start * itemsize, count * itemsize) for start, count in ranges]
+
+    def prefetch(self, ranges):
+        self.storage.prefetch(self.path, self.get_byte_ranges(ranges))
+
+    def read(self, ranges):
+        # Arrays of elements for ranges (first element, number of elements)
+        data = self.storage.read_ranges(self.path, self.get_byte_ranges(ranges))
+        return [np.frombuffer(d, dtype=self.dtype) for d in data]
@@ -0,0 +1,61 @@
+# coding: utf-8
+__author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
+
+import os
+import sys
+import numpy as np
+import pytest
+import soundfile as sf
+from ml_collections import ConfigDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+INSTRUMENTS = ['vocals', 'other']
+SAMPLE_RATE = 44100
+
+
+def make_config(chunk_size=8192, min_mean_abs=0.0, augmentations=None, **training):
+    config = {
+        'audio': {
+            'chunk_size': chunk_size,
+            'min_mean_abs': min_mean_abs,
+            'sample_rate': SAMPLE_RATE,
+        },
+        'training': {
+            'instruments': list(INSTRUMENTS),
+            'target_instrument': None,
+            'batch_size': 2,
+            'num_steps': 4,
+            'read_metadata_procs': 1,
+        },
+    }
+    config['training'].update(training)
+    if augmentations is not None:
+        config['augmentations'] = augmentations
+    return ConfigDict(config)
+
+
+def make_tracks(path, lengths, seed=0, file_type='wav'):
+    """
+    Folders of type 1 dataset with random stereo stems, returns dict track folder -> instr -> audio (2, length).
+    Audio is rounded to int16 grid, so it's read back exactly.
+    """
+    rng = np.random.default_rng(seed)
+    tracks = dict()
+    for i, length in enumerate(lengths):
+        folder = os.path.join(str(path), 'track_{}'.format(i))
+        os.makedirs(folder)
+        tracks[folder] = dict()
+        for instr in INSTRUMENTS:
+            audio = np.round(rng.uniform(-0.5, 0.5, (2, length)) * 32768) / 32768
+            sf.write(os.path.join(folder, '{}.{}'.format(instr, file_type)), audio.T, SAMPLE_RATE, subtype='PCM_16')
+            tracks[folder][instr] = audio.astype(np.float32)
+    return tracks
+
+
+@pytest.fixture
+def type1_dataset(tmp_path):
+    data_path = tmp_path / 'data'
+    data_path.mkdir()
+    tracks = make_tracks(data_path, [30000, 25000, 20000])
+    return str(data_path), tracks
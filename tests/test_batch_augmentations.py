@@ -0,0 +1,182 @@
+# coding: utf-8
+__author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
+
+import math
+import numpy as np
+import pytest
+import torch
+import audiomentations as AU
+from scipy.signal import lfilter
+from conftest import make_config, INSTRUMENTS, SAMPLE_RATE
+from batch_augmentations import BatchAugmentations, EQ_BANDS, biquad_coefficients, polynomial_response, \
+    hz_to_mel, mel_to_hz, get_batch_augmentations
+from test_sampling import make_dataset
+
+
+def batch_config(all_augs, mix_on_device=False, **augmentations):
+    config = {
+        'enable': True,
+        'batch_augmentations': True,
+        'all': all_augs,
+    }
+    config.update(augmentations)
+    return make_config(augmentations=config, mix_on_device=mix_on_device)
+
+
+def all_augmentations(prob=0.5):
+    return {
+        'channel_shuffle': prob,
+        'random_inverse': prob,
+        'random_polarity': prob,
+        'seven_band_parametric_eq': prob,
+        'seven_band_parametric_eq_min_gain_db': -6,
+        'seven_band_parametric_eq_max_gain_db': 6,
+        'tanh_distortion': prob,
+        'tanh_distortion_min': 0.1,
+        'tanh_distortion_max': 0.7,
+        'gaussian_noise': prob,
+        'gaussian_noise_min_amplitude': 0.001,
+        'gaussian_noise_max_amplitude': 0.015,
+    }
+
+
+def random_batch(batch_size=4, length=8192, seed=0):
+    stems = torch.rand((batch_size, len(INSTRUMENTS), 2, length), generator=torch.Generator().manual_seed(seed)) - 0.5
+    return stems, stems.sum(dim=1)
+
+
+def test_shape_and_finite():
+    augm = BatchAugmentations(batch_config(all_augmentations(), loudness=True, loudness_min=0.5, loudness_max=1.5))
+    stems, mix = random_batch()
+    out_stems, out_mix = augm(stems.clone(), mix.clone(), generator=torch.Generator().manual_seed(1))
+    assert out_stems.shape == stems.shape and out_mix.shape == mix.shape
+    assert torch.isfinite(out_stems).all() and torch.isfinite(out_mix).all()
+    assert not torch.equal(out_stems, stems)
+    # Mixture is rebuilt from augmented stems
+    assert torch.allclose(out_mix, out_stems.sum(dim=1), atol=1e-6)
+
+
+def test_same_generator_seed_gives_same_batch():
+    augm = BatchAugmentations(batch_config(all_augmentations()))
+    stems, mix = random_batch()
+    first = augm(stems.clone(), mix.clone(), generator=torch.Generator().manual_seed(7))
+    second = augm(stems.clone(), mix.clone(), generator=torch.Generator().manual_seed(7))
+    other = augm(stems.clone(), mix.clone(), generator=torch.Generator().manual_seed(8))
+    assert torch.equal(first[0], second[0]) and torch.equal(first[1], second[1])
+    assert not torch.equal(first[0], other[0])
+
+
+def test_mixture_only_changes_are_kept():
+    augm = BatchAugmentations(batch_config(all_augmentations(1.0)))
+    stems, mix = random_batch()
+    residual = 0.01 * torch.ones_like(mix)
+    out_stems, out_mix = augm(stems.clone(), mix + residual, generator=torch.Generator().manual_seed(0))
+    assert torch.allclose(out_mix, out_stems.sum(dim=1) + residual, atol=1e-6)
+
+
+def test_mix_on_device(tmp_path, type1_dataset):
+    data_path, _ = type1_dataset
+    augmentations = {
+        'enable': True,
+        'loudness': True,
+        'loudness_min': 1.0,
+        'loudness_max': 1.0,
+        'mixup': True,
+        'mixup_probs': (1.0,),
+    }
+    dataset = make_dataset(tmp_path, data_path, augmentations=augmentations, mix_on_device=True, stems_fp16=True)
+    augm = get_batch_augmentations(dataset.config, 1, dataset)
+    assert augm is not None and augm.on_device
+    # Dataloader returns only stems (default collate), mixture is made by batch augmentations
+    loader = torch.utils.data.DataLoader(dataset, batch_size=2, shuffle=False)
+    data = next(iter(loader))
+    assert isinstance(data, torch.Tensor) and data.dtype == torch.float16
+    assert data.shape == (2, len(INSTRUMENTS), 2, dataset.chunk_size)
+    stems, mix = augm(data.float(), generator=torch.Generator().manual_seed(0))
+    assert torch.allclose(mix, stems.sum(dim=1), atol=1e-6)
+    # Mixup with probability 1 and unit loudness: every stem is average with the same stem of other sample
+    expected = (data[0].float() + data[1].float()) / 2
+    assert torch.allclose(stems[0], expected, atol=1e-6) and torch.allclose(stems[1], expected, atol=1e-6)
+
+
+def test_target_instrument():
+    config = batch_config(all_augmentations())
+    config.training.target_instrument = 'other'
+    augm = BatchAugmentations(config)
+    stems, mix = random_batch()
+    out_stems, out_mix = augm(stems.clone(), mix.clone(), generator=torch.Generator().manual_seed(0))
+    assert out_stems.shape == (stems.shape[0], 2, stems.shape[-1]) and out_mix.shape == mix.shape
+
+
+def test_same_as_per_sample_augmentations(tmp_path, type1_dataset):
+    # Deterministic augmentations (probability 1) give the same result in dataset and for whole batch
+    data_path, _ = type1_dataset
+    augs = {'channel_shuffle': 1.0, 'random_inverse': 1.0, 'random_polarity': 1.0}
+    per_sample = make_dataset(tmp_path, data_path, augmentations={'enable': True, 'all': augs})
+    plain = make_dataset(tmp_path, data_path, augmentations={'enable': False})
+    augm = BatchAugmentations(batch_config(augs))
+    for index in range(3):
+        stems, mix = plain[index]
+        out_stems, out_mix = augm(stems[None].clone(), mix[None].clone())
+        expected_stems, expected_mix = per_sample[index]
+        assert torch.equal(out_stems[0], expected_stems)
+        assert torch.allclose(out_mix[0], expected_mix, atol=1e-6)
+
+
+def test_tanh_distortion_same_as_audiomentations():
+    amount = 0.5
+    augm = BatchAugmentations(batch_config({'tanh_distortion': 1.0, 'tanh_distortion_min': amount, 'tanh_distortion_max': amount}))
+    stems, mix = random_batch(batch_size=2)
+    out_stems, _ = augm(stems.clone(), mix.clone())
+    reference = AU.TanhDistortion(min_distortion=amount, max_distortion=amount, p=1.0)
+    for b in range(stems.shape[0]):
+        for i in range(stems.shape[1]):
+            expected = reference(samples=stems[b, i].numpy(), sample_rate=SAMPLE_RATE)
+            # Percentile is taken without interpolation here, so threshold differs slightly
+            assert np.allclose(out_stems[b, i].numpy(), expected, atol=1e-4)
+
+
+def test_gaussian_noise_amplitude():
+    augm = BatchAugmentations(batch_config({'gaussian_noise': 1.0, 'gaussian_noise_min_amplitude': 0.01,
+                                            'gaussian_noise_max_amplitude': 0.01}))
+    stems, mix = random_batch()
+    out_stems, _ = augm(stems.clone(), mix.clone(), generator=torch.Generator().manual_seed(0))
+    assert abs((out_stems - stems).std().item() - 0.01) < 0.0005
+
+
+@pytest.mark.parametrize('kind', ['peaking', 'low_shelf', 'high_shelf'])
+def test_biquad_gain(kind):
+    gain_db = torch.tensor([-6.0, 3.0, 9.0])
+    w0 = torch.full((3,), 2 * math.pi * 1000 / SAMPLE_RATE)
+    b, a = biquad_coefficients(kind, w0, gain_db, torch.full((3,), 0.7))
+    # Peaking filter has its gain at band center, shelves far below / above it. Opposite side isn't changed
+    w = {'peaking': w0[0].item(), 'low_shelf': 0.0, 'high_shelf': math.pi}[kind]
+    flat = {'peaking': 0.0, 'low_shelf': math.pi, 'high_shelf': 0.0}[kind]
+    z = torch.polar(torch.ones(2), -torch.tensor([w, flat]))
+    response = (polynomial_response(b, z) / polynomial_response(a, z)).abs()
+    assert torch.allclose(20 * torch.log10(response[:, 0]), gain_db, atol=1e-3)
+    assert torch.allclose(response[:, 1], torch.ones(3), atol=1e-2)
+
+
+def test_equalizer_same_as_biquad_filters():
+    # Frequency domain cascade must be the same as time domain filtering with the same random parameters
+    augm = BatchAugmentations(batch_config({'seven_band_parametric_eq': 1.0, 'seven_band_parametric_eq_min_gain_db': -6,
+                                            'seven_band_parametric_eq_max_gain_db': 6}))
+    x = torch.rand((3, 2, 16384), generator=torch.Generator().manual_seed(0)) - 0.5
+    rows = (torch.zeros(3, dtype=torch.long), torch.zeros(3, dtype=torch.long))
+    generator = torch.Generator().manual_seed(5)
+    state = generator.get_state()
+    augm.generator = generator
+    out = augm.equalizer(x, rows).numpy()
+
+    generator.set_state(state)
+    expected = x.double().numpy()
+    for kind, min_freq, max_freq, min_q, max_q in EQ_BANDS:
+        mel = hz_to_mel(min_freq) + (hz_to_mel(max_freq) - hz_to_mel(min_freq)) * torch.rand(3, generator=generator)
+        w = 2 * math.pi * mel_to_hz(mel) / SAMPLE_RATE
+        gain_db = -6 + 12 * torch.rand(3, generator=generator)
+        q = min_q + (max_q - min_q) * torch.rand(3, generator=generator)
+        b, a = biquad_coefficients(kind, w.double(), gain_db.double(), q.double())
+        for i in range(3):
+            expected[i] = lfilter(b[i].numpy(), a[i].numpy(), expected[i], axis=-1)
+    assert np.abs(out - expected).max() < 5e-4 * np.abs(expected).max()
@@ -0,0 +1,177 @@
+# coding: utf-8
+__author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
+
+import json
+import os
+import numpy as np
+import pytest
+import soundfile as sf
+from conftest import make_config, INSTRUMENTS
+from dataset import MSSDataset, MetadataIndex, read_packed_metadata, read_packed_stem, get_active_ranges, \
+    sample_offset, PACK_INDEX_NAME
+from pack_dataset import pack_dataset
+from test_sampling import find_chunk
+
+
+def pack(data_path, output_path, *extra):
+    pack_dataset(['--data_path', data_path, '--output_path', str(output_path), '--instruments'] + INSTRUMENTS +
+                 ['--dtype', 'int16', '--read_procs', '1'] + list(extra))
+    return str(output_path)
+
+
+def make_dataset(tmp_path, data_path, dataset_type, **training):
+    config = make_config(**training)
+    return MSSDataset(config, data_path, metadata_path=str(tmp_path / 'metadata.db'), dataset_type=dataset_type,
+                      verbose=False, seed=123)
+
+
+def test_packed_stems_match_source(tmp_path, type1_dataset):
+    data_path, tracks = type1_dataset
+    packed_path = pack(data_path, tmp_path / 'packed')
+    metadata, variants = read_packed_metadata(packed_path, INSTRUMENTS, 44100)
+    assert len(metadata) == len(tracks) and len(variants) == 0
+    with open(os.path.join(packed_path, PACK_INDEX_NAME)) as f:
+        paths = [t['path'] for t in json.load(f)['tracks']]
+    for path, track in zip(paths, metadata):
+        shard = np.load(track[0], mmap_mode='r')
+        for instr in INSTRUMENTS:
+            stem, scale = read_packed_stem(shard, track, instr)
+            assert np.array_equal(stem.astype(np.float32) * scale, tracks[path][instr])
+
+
+@pytest.mark.parametrize('dataset_type', [5, 6])
+def test_packed_dataset_chunks_match_source(tmp_path, type1_dataset, dataset_type):
+    data_path, tracks = type1_dataset
+    packed_path = pack(data_path, tmp_path / 'packed')
+    dataset = make_dataset(tmp_path, packed_path, dataset_type)
+    for index in range(6):
+        stems, mix = dataset[index]
+        found = [find_chunk(tracks, instr, stems[i].numpy()) for i, instr in enumerate(INSTRUMENTS)]
+        assert all(f is not None for f in found)
+        if dataset_type == 6:
+            # All stems are from the same track
+            assert len(set(f[0] for f in found)) == 1
+        assert np.allclose(mix.numpy(), stems.sum(0).numpy())
+
+
+def test_packed_variants(tmp_path, type1_dataset):
+    data_path, tracks = type1_dataset
+    packed_path = pack(data_path, tmp_path / 'packed', '--pitch_variants', '2', '--tempo_variants', '0.8')
+    metadata, variants = read_packed_metadata(packed_path, INSTRUMENTS)
+    assert len(metadata) == len(tracks)
+    for track in metadata:
+        # (pitch 0, tempo 0.8), (pitch 2, tempo 1), (pitch 2, tempo 0.8)
+        lengths = [v[2] for v in variants[(track[0], track[1])]]
+        stretched = int(np.ceil(track[2] / 0.8))
+        assert lengths == [stretched, track[2], stretched]
+
+
+def test_pack_rejects_different_sample_rates(tmp_path, type1_dataset):
+    data_path, tracks = type1_dataset
+    path = os.path.join(sorted(tracks)[1], 'other.wav')
+    sf.write(path, tracks[sorted(tracks)[1]]['other'].T, 22050, subtype='PCM_16')
+    with pytest.raises(SystemExit):
+        pack(data_path, tmp_path / 'packed')
+    assert not os.path.isfile(str(tmp_path / 'packed' / PACK_INDEX_NAME))
+
+
+@pytest.mark.parametrize('change', ['version', 'instruments', 'sample_rate'])
+def test_read_packed_metadata_checks(tmp_path, type1_dataset, change):
+    data_path, _ = type1_dataset
+    packed_path = pack(data_path, tmp_path / 'packed')
+    index_path = os.path.join(packed_path, PACK_INDEX_NAME)
+    with open(index_path) as f:
+        index = json.load(f)
+    if change == 'version':
+        index['version'] += 1
+    elif change == 'instruments':
+        index['instruments'] = ['vocals', 'bass']
+    else:
+        index['sample_rate'] = 48000
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    with pytest.raises(SystemExit):
+        read_packed_metadata(packed_path, INSTRUMENTS, 44100)
+
+
+def test_active_ranges():
+    block = 256
+    chunk_size = 4 * block
+    rng = np.random.default_rng(0)
+    audio = rng.uniform(-0.5, 0.5, (2, 64 * block)).astype(np.float32)
+    audio[:, 10 * block:30 * block] *= 0.001
+    audio[:, 50 * block:] = 0
+    ranges = get_active_ranges(audio, chunk_size, 0.1, block=block)
+    # Every grid offset is valid if its chunk is loud enough, valid offset gives range of block offsets
+    for start in range(0, audio.shape[1] - chunk_size + 1, block):
+        loud = np.abs(audio[:, start:start + chunk_size]).mean() >= 0.1
+        inside = np.any((ranges[:, 0] <= start) & (start < ranges[:, 1]))
+        assert loud == inside
+    assert ranges[-1, 1] <= audio.shape[1] - chunk_size + 1
+    # Track shorter than chunk: single offset 0 or nothing
+    assert get_active_ranges(audio[:, :block], chunk_size, 0.01, block=block).tolist() == [[0, 1]]
+    assert get_active_ranges(audio[:, :block], chunk_size, 0.2, block=block).shape == (0, 2)
+
+
+def test_sample_offset():
+    ranges = np.array([[10, 20], [100, 105]], dtype=np.int64)
+    rng = np.random.default_rng(0)
+    offsets = np.array([sample_offset(ranges, rng) for _ in range(3000)])
+    assert set(offsets.tolist()) == set(range(10, 20)) | set(range(100, 105))
+    # Uniform on union of ranges: 10 of 15 offsets are in the first range
+    assert abs((offsets < 20).mean() - 2 / 3) < 0.05
+
+
+def test_metadata_index_is_invalidated(tmp_path, type1_dataset):
+    data_path, tracks = type1_dataset
+    folders = sorted(tracks)
+    dataset = make_dataset(tmp_path, data_path, 1)
+    assert sorted(dataset.metadata) == [(f, tracks[f]['vocals'].shape[1]) for f in folders]
+    index = MetadataIndex(str(tmp_path / 'metadata.db'), verbose=False)
+    assert sorted(index.load(1)) == folders
+    index.close()
+
+    # Replaced stem changes length of track, deleted track is dropped from index
+    audio = tracks[folders[0]]['vocals'][:, :15000]
+    sf.write(os.path.join(folders[0], 'vocals.wav'), audio.T, 44100, subtype='PCM_16')
+    for instr in INSTRUMENTS:
+        os.remove(os.path.join(folders[2], '{}.wav'.format(instr)))
+    os.rmdir(folders[2])
+    dataset = make_dataset(tmp_path, data_path, 1)
+    assert sorted(dataset.metadata) == [(folders[0], 15000), (folders[1], tracks[folders[1]]['vocals'].shape[1])]
+    index = MetadataIndex(str(tmp_path / 'metadata.db'), verbose=False)
+    assert sorted(index.load(1)) == folders[:2]
+    index.close()
+
+
+def test_activity_index_is_invalidated(tmp_path, type1_dataset):
+    data_path, tracks = type1_dataset
+    folders = sorted(tracks)
+    dataset = make_dataset(tmp_path, data_path, 1, min_mean_abs=0.1, activity_index=True)
+    path = os.path.join(folders[0], 'vocals.wav')
+    assert len(dataset.activity['vocals'][folders[0]]) > 0
+
+    # Stem became silent: its cached ranges must not be used
+    sf.write(path, np.zeros_like(tracks[folders[0]]['vocals']).T, 44100, subtype='PCM_16')
+    dataset = make_dataset(tmp_path, data_path, 1, min_mean_abs=0.1, activity_index=True)
+    assert len(dataset.activity['vocals'][folders[0]]) == 0
+    assert folders[0] not in [t[0] for t in dataset.active_tracks['vocals']]
+    index = MetadataIndex(str(tmp_path / 'metadata.db'), verbose=False)
+    assert len(index.load_activity(dataset.chunk_size, 0.1)[path][1]) == 0
+    index.close()
+
+
+def test_metadata_cache_messages_follow_verbose(tmp_path, type1_dataset, capsys):
+    data_path, tracks = type1_dataset
+    make_dataset(tmp_path, data_path, 1)
+    # Changed track is re-read
+    path = sorted(tracks)[0]
+    sf.write(os.path.join(path, 'vocals.wav'), np.zeros_like(tracks[path]['vocals']).T, 44100, subtype='PCM_16')
+    capsys.readouterr()
+    make_dataset(tmp_path, data_path, 1)
+    assert capsys.readouterr().out == ''
+    config = make_config()
+    MSSDataset(config, data_path, metadata_path=str(tmp_path / 'metadata.db'), dataset_type=1, verbose=True)
+    out = capsys.readouterr().out
+    for message in ['Found metadata cache file', 'Old metadata was used for 3 tracks']:
+        assert message in out
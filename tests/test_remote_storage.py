@@ -0,0 +1,157 @@
+# coding: utf-8
+__author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
+
+import io
+import os
+import sys
+import types
+import numpy as np
+import pytest
+from conftest import make_config, INSTRUMENTS
+import remote_storage
+from remote_storage import ChunkCache, RemoteStorage, RemoteShard, split_remote_path
+from dataset import MSSDataset
+from test_packed_dataset import pack
+from test_sampling import find_chunk
+
+
+class FakeS3Client:
+    """
+    Objects in memory with the same calls as boto3 S3 client. Counts GET requests.
+    """
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.gets = 0
+
+    def head_object(self, Bucket, Key):
+        data = self.objects[(Bucket, Key)]
+        return {'ContentLength': len(data), 'ETag': '"{}"'.format(hash(data) & 0xffffffff)}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.gets += 1
+        data = self.objects[(Bucket, Key)]
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1]
+        return {'Body': io.BytesIO(data)}
+
+
+def make_storage(client, cache_path=None, block_size=1024):
+    storage = RemoteStorage(cache_path=cache_path, cache_size=1.0 if cache_path is not None else 0, threads=4)
+    storage.block_size = block_size
+    storage.client = client
+    return storage
+
+
+def wait_downloads(storage):
+    # Done callbacks run in pool threads, after shutdown all of them have finished
+    storage.pool.shutdown(wait=True)
+    storage.pool = None
+
+
+def test_chunk_cache_evicts_least_recently_used(tmp_path):
+    cache = ChunkCache(str(tmp_path / 'cache'), max_size=1000)
+    for i in range(4):
+        cache.put('block_{}'.format(i), bytes([i]) * 200)
+        # Modification time is last access time
+        os.utime(os.path.join(cache.path, 'block_{}'.format(i)), (i, i))
+    assert cache.get('block_0') == bytes([0]) * 200
+    cache.put('block_4', bytes([4]) * 300)
+    # 1100 bytes > 1000: oldest blocks are removed until 90% of limit, block_0 was used recently
+    assert cache.get('block_1') is None
+    for i in [0, 2, 3, 4]:
+        assert cache.get('block_{}'.format(i)) is not None
+    assert cache.size <= 900
+    assert not any(name.startswith('.') for name in os.listdir(cache.path))
+
+
+@pytest.mark.parametrize('cached', [True, False])
+def test_read_ranges(tmp_path, cached):
+    data = os.urandom(10000)
+    client = FakeS3Client({('bucket', 'dir/file'): data})
+    storage = make_storage(client, str(tmp_path / 'cache') if cached else None)
+    ranges = [(0, 10), (1000, 100), (3000, 2500), (9990, 10)]
+    res = storage.read_ranges('s3://bucket/dir/file', ranges)
+    assert res == [data[start:start + size] for start, size in ranges]
+    # Blocks 0-5 and 9 of 1024 bytes
+    assert client.gets == 7
+    assert len(storage.pending) == 0
+    storage.read_ranges('s3://bucket/dir/file', [(2048, 100)])
+    assert client.gets == (7 if cached else 8)
+    if cached:
+        # Other process (dataloader worker) uses the same disk cache
+        other = make_storage(client, str(tmp_path / 'cache'))
+        assert other.read_ranges('s3://bucket/dir/file', ranges) == res
+        assert client.gets == 7
+
+
+def test_changed_file_is_downloaded_again(tmp_path):
+    client = FakeS3Client({('bucket', 'file'): b'a' * 3000})
+    storage = make_storage(client, str(tmp_path / 'cache'))
+    signature = storage.signature('s3://bucket/file')
+    assert storage.read_ranges('s3://bucket/file', [(0, 3000)])[0] == b'a' * 3000
+    client.objects[('bucket', 'file')] = b'b' * 3000
+    # New process reads new head, blocks of old ETag aren't used
+    storage = make_storage(client, str(tmp_path / 'cache'))
+    assert storage.signature('s3://bucket/file') != signature
+    assert storage.read_ranges('s3://bucket/file', [(0, 3000)])[0] == b'b' * 3000
+
+
+def test_prefetched_blocks_are_not_kept(tmp_path):
+    data = os.urandom(100000)
+    client = FakeS3Client({('bucket', 'file'): data})
+    storage = make_storage(client, str(tmp_path / 'cache'))
+    # Prefetched blocks which are never read must not stay in pending downloads
+    storage.prefetch('s3://bucket/file', [(0, 50000)])
+    wait_downloads(storage)
+    assert len(storage.pending) == 0 and client.gets == 49
+    assert storage.read_ranges('s3://bucket/file', [(1000, 20000)])[0] == data[1000:21000]
+    assert client.gets == 49
+
+
+def test_pending_is_limited_without_cache(monkeypatch):
+    monkeypatch.setattr(remote_storage, 'MAX_PENDING_BLOCKS', 10)
+    data = os.urandom(100000)
+    client = FakeS3Client({('bucket', 'file'): data})
+    storage = make_storage(client)
+    for start in range(0, 50000, 5000):
+        storage.prefetch('s3://bucket/file', [(start, 5000)])
+        wait_downloads(storage)
+    assert len(storage.pending) <= 10
+    # Blocks which are kept are used without new downloads, dropped ones are downloaded again
+    gets = client.gets
+    assert storage.read_ranges('s3://bucket/file', [(45000, 5000)])[0] == data[45000:50000]
+    assert client.gets == gets
+    assert storage.read_ranges('s3://bucket/file', [(0, 5000)])[0] == data[:5000]
+    assert client.gets > gets
+
+
+def test_remote_shard(tmp_path):
+    array = np.arange(20000, dtype=np.int16)
+    f = io.BytesIO()
+    np.save(f, array)
+    client = FakeS3Client({('bucket', 'packed/shard_00000.npy'): f.getvalue()})
+    storage = make_storage(client, str(tmp_path / 'cache'))
+    shard = RemoteShard(storage, 's3://bucket/packed/shard_00000.npy')
+    assert shard.dtype == np.int16
+    ranges = [(0, 5), (1000, 3000), (19990, 10)]
+    for (start, count), res in zip(ranges, shard.read(ranges)):
+        assert np.array_equal(res, array[start:start + count])
+
+
+def test_packed_dataset_in_object_storage(tmp_path, type1_dataset, monkeypatch):
+    data_path, tracks = type1_dataset
+    packed_path = pack(data_path, tmp_path / 'packed')
+    client = FakeS3Client()
+    for name in os.listdir(packed_path):
+        with open(os.path.join(packed_path, name), 'rb') as f:
+            client.objects[split_remote_path('s3://bucket/packed/' + name)] = f.read()
+    monkeypatch.setitem(sys.modules, 'boto3', types.SimpleNamespace(client=lambda *args, **kwargs: client))
+    config = make_config(remote_cache_path=str(tmp_path / 'cache'), remote_block_size=0.01)
+    dataset = MSSDataset(config, 's3://bucket/packed', metadata_path=str(tmp_path / 'metadata.db'), dataset_type=6,
+                         verbose=False, seed=123)
+    for index in range(4):
+        stems, mix = dataset[index]
+        found = [find_chunk(tracks, instr, stems[i].numpy()) for i, instr in enumerate(INSTRUMENTS)]
+        assert all(f is not None for f in found) and len(set(f[0] for f in found)) == 1
+    assert len(dataset.remote.pending) == 0
@@ -0,0 +1,128 @@
+# coding: utf-8
+__author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
+
+import random
+import numpy as np
+import torch
+from conftest import make_config, INSTRUMENTS
+from dataset import MSSDataset, SeekableSampler, get_sample_seed
+from batch_augmentations import get_batch_augmentations
+
+
+def find_chunk(tracks, instr, chunk):
+    # (track folder, offset) of chunk in source audio or None
+    for folder, stems in tracks.items():
+        audio = stems[instr]
+        for offset in np.nonzero(audio[0, :audio.shape[1] - chunk.shape[1] + 1] == chunk[0, 0])[0]:
+            if np.array_equal(audio[:, offset:offset + chunk.shape[1]], chunk):
+                return folder, offset
+    return None
+
+
+def make_dataset(tmp_path, data_path, seed=123, augmentations=None, dataset_type=1, **training):
+    config = make_config(augmentations=augmentations, **training)
+    return MSSDataset(config, data_path, metadata_path=str(tmp_path / 'metadata.db'), dataset_type=dataset_type,
+                      verbose=False, seed=seed)
+
+
+def stem_overrides():
+    # Override of the last stem must not change augmentations of stems loaded before it in next samples
+    return {
+        'enable': True,
+        'loudness': True,
+        'loudness_min': 0.5,
+        'loudness_max': 1.5,
+        'mixup': True,
+        'mixup_probs': (0.5,),
+        'mixup_loudness_min': 0.5,
+        'mixup_loudness_max': 1.5,
+        'all': {
+            'channel_shuffle': 0.5,
+            'random_polarity': 0.5,
+        },
+        'other': {
+            'gaussian_noise': 1.0,
+            'gaussian_noise_min_amplitude': 0.001,
+            'gaussian_noise_max_amplitude': 0.015,
+        },
+    }
+
+
+def test_same_seed_gives_same_sample(tmp_path, type1_dataset):
+    data_path, _ = type1_dataset
+    dataset = make_dataset(tmp_path, data_path, augmentations=stem_overrides())
+    first = dataset[0]
+    for index in [1, 2, 0]:
+        sample = dataset[index]
+    assert torch.equal(first[0], sample[0]) and torch.equal(first[1], sample[1])
+    # New dataset (as in other process or worker) gives the same sample
+    other = make_dataset(tmp_path, data_path, augmentations=stem_overrides())
+    assert torch.equal(other[0][0], first[0])
+    assert not torch.equal(dataset[1][0], first[0])
+    dataset.set_epoch(1)
+    assert not torch.equal(dataset[0][0], first[0])
+
+
+def test_stem_overrides_stay_in_stem(tmp_path, type1_dataset):
+    data_path, _ = type1_dataset
+    dataset = make_dataset(tmp_path, data_path, augmentations=stem_overrides())
+    for index in range(4):
+        dataset[index]
+    assert 'gaussian_noise' not in dataset.config.augmentations.all
+
+
+def test_global_random_states_not_changed(tmp_path, type1_dataset):
+    data_path, _ = type1_dataset
+    dataset = make_dataset(tmp_path, data_path, augmentations=stem_overrides())
+    states = random.getstate(), np.random.get_state()[1].copy(), torch.get_rng_state()
+    dataset[0]
+    assert random.getstate() == states[0]
+    assert np.array_equal(np.random.get_state()[1], states[1])
+    assert torch.equal(torch.get_rng_state(), states[2])
+
+
+def test_read_ahead_gives_same_samples(tmp_path, type1_dataset):
+    data_path, tracks = type1_dataset
+    for dataset_type in [1, 4]:
+        dataset = make_dataset(tmp_path, data_path, dataset_type=dataset_type)
+        batch = dataset.__getitems__([0, 1, 2, 3])
+        for index, (stems, mix) in enumerate(batch):
+            single = dataset[index]
+            assert torch.equal(stems, single[0])
+            assert torch.allclose(mix, stems.sum(0))
+            # Without augmentations chunks are exact slices of source audio
+            positions = [find_chunk(tracks, instr, stems[i].numpy()) for i, instr in enumerate(INSTRUMENTS)]
+            assert None not in positions
+            if dataset_type == 4:
+                # The same track for all stems
+                assert len(set(folder for folder, _ in positions)) == 1
+
+
+def test_planned_chunks_are_read_ahead(tmp_path, type1_dataset):
+    data_path, _ = type1_dataset
+    dataset = make_dataset(tmp_path, data_path)
+    samples = [dataset.plan_sample(index) for index in range(4)]
+    dataset.prefetch_chunks(samples)
+    planned = {(track[0], instr, offset) for sample in samples for instr, (track, offset) in sample.planned.items()}
+    assert set(dataset.prefetched) == planned
+    dataset.prefetched.clear()
+
+
+def test_collate_is_reproducible(tmp_path, type1_dataset):
+    data_path, _ = type1_dataset
+    augmentations = stem_overrides()
+    augmentations['batch_augmentations'] = True
+    results = []
+    for _ in range(2):
+        dataset = make_dataset(tmp_path, data_path, augmentations=augmentations)
+        batch_augm = get_batch_augmentations(dataset.config, 1, dataset)
+        results.append(batch_augm.collate(dataset.__getitems__([0, 1])))
+    assert torch.equal(results[0][0], results[1][0])
+    assert torch.equal(results[0][1], results[1][1])
+
+
+def test_seekable_sampler(tmp_path, type1_dataset):
+    data_path, _ = type1_dataset
+    dataset = make_dataset(tmp_path, data_path)
+    assert list(SeekableSampler(dataset, start=3)) == list(range(3, len(dataset)))
+    assert get_sample_seed(1, 2, 3) == get_sample_seed(1, 2, 3) != get_sample_seed(1, 2, 4)
@@ -22,7 +22,8 @@ from torch.cuda.amp.grad_scaler import GradScaler
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 import torch.nn.functional as F
 
-from dataset import MSSDataset
+from dataset import MSSDataset, SeekableSampler, get_batch_seed
+from batch_augmentations import get_batch_augmentations
 from utils import demix, sdr, get_model_from_config
 from valid import valid_multi_gpu, valid
 
@@ -110,11 +111,13 @@ def train_model(args):
     parser.add_argument("--start_check_point", type=str, default='', help="Initial checkpoint to start training")
     parser.add_argument("--results_path", type=str, help="path to folder where results will be stored (weights, metadata)")
     parser.add_argument("--data_path", nargs="+", type=str, help="Dataset data paths. You can provide several folders.")
-    parser.add_argument("--dataset_type", type=int, default=1, help="Dataset type. Must be one of: 1, 2, 3 or 4. Details here: https://github.com/ZFTurbo/Music-Source-Separation-Training/blob/main/docs/dataset_types.md")
+    parser.add_argument("--dataset_type", type=int, default=1, help="Dataset type. Must be one of: 1, 2, 3, 4, 5 or 6. Details here: https://github.com/ZFTurbo/Music-Source-Separation-Training/blob/main/docs/dataset_types.md")
     parser.add_argument("--valid_path", nargs="+", type=str, help="validation data paths. You can provide several folders.")
     parser.add_argument("--num_workers", type=int, default=0, help="dataloader num_workers")
     parser.add_argument("--pin_memory", type=bool, default=False, help="dataloader pin_memory")
     parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--start_epoch", type=int, default=0, help="Epoch to start training from (to continue stopped training)")
+    parser.add_argument("--start_step", type=int, default=0, help="Step inside start epoch to continue training from. Needs training.deterministic_sampling in config")
     parser.add_argument("--device_ids", nargs='+', type=int, default=[0], help='list of gpu ids')
     parser.add_argument("--use_multistft_loss", action='store_true', help="Use MultiSTFT Loss (from auraloss package)")
     parser.add_argument("--use_mse_loss", action='store_true', help="Use default MSE loss")
@@ -122,6 +125,9 @@ def train_model(args):
     parser.add_argument("--wandb_key", type=str, default='', help='wandb API Key')
     parser.add_argument("--pre_valid", action='store_true', help='Run validation before training')
     parser.add_argument("--metrics", nargs='+', type=str, default=["sdr"], choices=['sdr', 'l1_freq', 'si_sdr', 'log_wmse', 'aura_stft', 'aura_mrstft', 'bleedless', 'fullness'], help='List of metrics to use.')
+    parser.add_argument("--teacher_config_path", type=str, default='', help="Config of teacher model for distillation (same model_type). Distillation is disabled if empty")
+    parser.add_argument("--teacher_check_point", type=str, default='', help="Weights of teacher model for distillation")
+    parser.add_argument("--distill_weight", type=float, default=1.0, help="Weight of teacher output in training target (1.0 - use only teacher output)")
     parser.add_argument("--metric_for_scheduler", default="sdr", choices=['sdr', 'l1_freq', 'si_sdr', 'log_wmse', 'aura_stft', 'aura_mrstft', 'bleedless', 'fullness'], help='Metric which will be used for scheduler.')
     if args is None:
         args = parser.parse_args()
@@ -134,6 +140,8 @@ def train_model(args):
     torch.multiprocessing.set_start_method('spawn')
     
     model, config = get_model_from_config(args.model_type, args.config_path)
+    # With deterministic sampling training data depends only on seed, epoch and step
+    deterministic_sampling = config.training.get('deterministic_sampling', False)
     print("Instruments: {}".format(config.training.instruments))
 
     if args.metric_for_scheduler not in args.metrics:
@@ -162,16 +170,27 @@ def train_model(args):
         config,
         args.data_path,
         batch_size=batch_size,
-        metadata_path=os.path.join(args.results_path, 'metadata_{}.pkl'.format(args.dataset_type)),
+        metadata_path=os.path.join(args.results_path, 'metadata_{}.db'.format(args.dataset_type)),
         dataset_type=args.dataset_type,
+        seed=args.seed if deterministic_sampling else None,
     )
 
+    # Cheap augmentations for whole batch: in dataloader workers (collate_fn) or on training device
+    batch_augm = get_batch_augmentations(config, args.dataset_type, trainset)
+    # Deterministic sampling: indices go in order, stopped training continues from --start_step
+    sampler = None
+    if deterministic_sampling:
+        sampler = SeekableSampler(trainset, start=args.start_step * batch_size)
+    elif args.start_step > 0:
+        print('Warning: --start_step is ignored without training.deterministic_sampling in config')
     train_loader = DataLoader(
         trainset,
         batch_size=batch_size,
-        shuffle=True,
+        shuffle=sampler is None,
+        sampler=sampler,
         num_workers=args.num_workers,
-        pin_memory=args.pin_memory
+        pin_memory=args.pin_memory,
+        collate_fn=batch_augm.collate if batch_augm is not None and not batch_augm.on_device else None,
     )
 
     if args.start_check_point != '':
@@ -197,6 +216,17 @@ def train_model(args):
         print('CUDA is not avilable. Run training on CPU. It will be very slow...')
         model = model.to(device)
 
+    teacher = None
+    if args.teacher_config_path != '':
+        print('Use distillation from teacher: {} Distill weight: {}'.format(args.teacher_check_point, args.distill_weight))
+        teacher, _ = get_model_from_config(args.model_type, args.teacher_config_path)
+        teacher.load_state_dict(
+            torch.load(args.teacher_check_point, map_location='cpu', weights_only=True)
+        )
+        teacher = teacher.eval().to(device)
+        for p in teacher.parameters():
+            p.requires_grad = False
+
     if args.pre_valid:
         valid_multi_gpu(model, args, config, args.device_ids, verbose=True)
 
@@ -258,7 +288,8 @@ def train_model(args):
     scaler = GradScaler()
     print('Train for: {}'.format(config.training.num_epochs))
     best_metric = -10000
-    for epoch in range(config.training.num_epochs):
+    for epoch in range(args.start_epoch, config.training.num_epochs):
+        trainset.set_epoch(epoch)
         model.train().to(device)
         print('Train epoch: {} Learning rate: {}'.format(epoch, optimizer.param_groups[0]['lr']))
         loss_val = 0.
@@ -266,9 +297,22 @@ def train_model(args):
 
         # total_loss = None
         pbar = tqdm(train_loader)
-        for i, (batch, mixes) in enumerate(pbar):
-            y = batch.to(device)
-            x = mixes.to(device)  # mixture
+        for i, data in enumerate(pbar):
+            generator = None
+            if deterministic_sampling and batch_augm is not None and batch_augm.on_device:
+                # Augmentations on device are reproducible too: random generator is seeded for every step
+                step = i + (args.start_step if epoch == args.start_epoch else 0)
+                generator = torch.Generator(device=device)
+                generator.manual_seed(get_batch_seed(args.seed, epoch, step))
+            if batch_augm is not None and batch_augm.mix_on_device:
+                # Dataloader returns only stems, mixture is made on device
+                y, x = batch_augm(data.to(device).float(), generator=generator)
+            else:
+                batch, mixes = data
+                y = batch.to(device)
+                x = mixes.to(device)  # mixture
+                if batch_augm is not None and batch_augm.on_device:
+                    y, x = batch_augm(y, x, generator=generator)
 
             if 'normalize' in config.training:
                 if config.training.normalize:
@@ -279,6 +323,12 @@ def train_model(args):
                         y = (y - mean) / std
 
             with torch.cuda.amp.autocast(enabled=use_amp):
+                if teacher is not None:
+                    # Use teacher output as (soft) target
+                    with torch.no_grad():
+                        y_teacher = teacher(x)
+                    y = args.distill_weight * y_teacher + (1 - args.distill_weight) * y
+
                 if args.model_type in ['mel_band_roformer', 'bs_roformer', 'mel_band_llama']:
                     # loss is computed in forward pass
                     loss = model(x, y)
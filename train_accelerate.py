@@ -22,7 +22,8 @@ from torch.optim.lr_scheduler import ReduceLROnPlateau
 import torch.nn.functional as F
 from accelerate import Accelerator
 
-from dataset import MSSDataset
+from dataset import MSSDataset, get_batch_seed
+from batch_augmentations import get_batch_augmentations
 from utils import get_model_from_config, demix, sdr, prefer_target_instrument
 from train import masked_loss, manual_seed, load_not_compatible_weights
 import warnings
@@ -95,17 +96,22 @@ def train_model(args):
     parser.add_argument("--start_check_point", type=str, default='', help="Initial checkpoint to start training")
     parser.add_argument("--results_path", type=str, help="path to folder where results will be stored (weights, metadata)")
     parser.add_argument("--data_path", nargs="+", type=str, help="Dataset data paths. You can provide several folders.")
-    parser.add_argument("--dataset_type", type=int, default=1, help="Dataset type. Must be one of: 1, 2, 3 or 4. Details here: https://github.com/ZFTurbo/Music-Source-Separation-Training/blob/main/docs/dataset_types.md")
+    parser.add_argument("--dataset_type", type=int, default=1, help="Dataset type. Must be one of: 1, 2, 3, 4, 5 or 6. Details here: https://github.com/ZFTurbo/Music-Source-Separation-Training/blob/main/docs/dataset_types.md")
     parser.add_argument("--valid_path", nargs="+", type=str, help="validation data paths. You can provide several folders.")
     parser.add_argument("--num_workers", type=int, default=0, help="dataloader num_workers")
     parser.add_argument("--pin_memory", type=bool, default=False, help="dataloader pin_memory")
     parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--start_epoch", type=int, default=0, help="Epoch to start training from (to continue stopped training)")
+    parser.add_argument("--start_step", type=int, default=0, help="Step inside start epoch to continue training from. Needs training.deterministic_sampling in config")
     parser.add_argument("--device_ids", nargs='+', type=int, default=[0], help='list of gpu ids')
     parser.add_argument("--use_multistft_loss", action='store_true', help="Use MultiSTFT Loss (from auraloss package)")
     parser.add_argument("--use_mse_loss", action='store_true', help="Use default MSE loss")
     parser.add_argument("--use_l1_loss", action='store_true', help="Use L1 loss")
     parser.add_argument("--wandb_key", type=str, default='', help='wandb API Key')
     parser.add_argument("--pre_valid", action='store_true', help='Run validation before training')
+    parser.add_argument("--teacher_config_path", type=str, default='', help="Config of teacher model for distillation (same model_type). Distillation is disabled if empty")
+    parser.add_argument("--teacher_check_point", type=str, default='', help="Weights of teacher model for distillation")
+    parser.add_argument("--distill_weight", type=float, default=1.0, help="Weight of teacher output in training target (1.0 - use only teacher output)")
     if args is None:
         args = parser.parse_args()
     else:
@@ -117,6 +123,8 @@ def train_model(args):
     torch.multiprocessing.set_start_method('spawn')
 
     model, config = get_model_from_config(args.model_type, args.config_path)
+    # With deterministic sampling training data depends only on seed, epoch and step
+    deterministic_sampling = config.training.get('deterministic_sampling', False)
     accelerator.print("Instruments: {}".format(config.training.instruments))
 
     os.makedirs(args.results_path, exist_ok=True)
@@ -138,17 +146,24 @@ def train_model(args):
         config,
         args.data_path,
         batch_size=batch_size,
-        metadata_path=os.path.join(args.results_path, 'metadata_{}.pkl'.format(args.dataset_type)),
+        metadata_path=os.path.join(args.results_path, 'metadata_{}.db'.format(args.dataset_type)),
         dataset_type=args.dataset_type,
+        seed=args.seed if deterministic_sampling else None,
         verbose=accelerator.is_main_process,
     )
 
+    # Cheap augmentations for whole batch: in dataloader workers (collate_fn) or on training device
+    batch_augm = get_batch_augmentations(config, args.dataset_type, trainset)
+    if args.start_step > 0 and not deterministic_sampling:
+        accelerator.print('Warning: --start_step without training.deterministic_sampling in config continues with other data')
     train_loader = DataLoader(
         trainset,
         batch_size=batch_size,
-        shuffle=True,
+        # Order of samples doesn't matter with deterministic sampling (sample is defined by its index)
+        shuffle=not deterministic_sampling,
         num_workers=args.num_workers,
-        pin_memory=args.pin_memory
+        pin_memory=args.pin_memory,
+        collate_fn=batch_augm.collate if batch_augm is not None and not batch_augm.on_device else None,
     )
 
     validset = MSSValidationDataset(args)
@@ -228,6 +243,18 @@ def train_model(args):
 
     model, optimizer, train_loader, scheduler = accelerator.prepare(model, optimizer, train_loader, scheduler)
 
+    teacher = None
+    if args.teacher_config_path != '':
+        accelerator.print('Use distillation from teacher: {} Distill weight: {}'.format(args.teacher_check_point, args.distill_weight))
+        teacher, _ = get_model_from_config(args.model_type, args.teacher_config_path)
+        teacher.load_state_dict(
+            torch.load(args.teacher_check_point, map_location='cpu', weights_only=True)
+        )
+        # Teacher isn't trained, so it isn't prepared by accelerator: every process has its own copy
+        teacher = teacher.eval().to(device)
+        for p in teacher.parameters():
+            p.requires_grad = False
+
     if args.pre_valid:
         sdr_list = valid(model, valid_loader, args, config, device, verbose=accelerator.is_main_process)
         sdr_list = accelerator.gather(sdr_list)
@@ -254,16 +281,38 @@ def train_model(args):
 
     accelerator.print('Train for: {}'.format(config.training.num_epochs))
     best_sdr = -100
-    for epoch in range(config.training.num_epochs):
+    for epoch in range(args.start_epoch, config.training.num_epochs):
+        trainset.set_epoch(epoch)
         model.train().to(device)
         accelerator.print('Train epoch: {} Learning rate: {}'.format(epoch, optimizer.param_groups[0]['lr']))
         loss_val = 0.
         total = 0
 
-        pbar = tqdm(train_loader, disable=not accelerator.is_main_process)
-        for i, (batch, mixes) in enumerate(pbar):
-            y = batch
-            x = mixes
+        epoch_loader = train_loader
+        if epoch == args.start_epoch and args.start_step > 0:
+            # Batches before start step are skipped by sampler, they aren't loaded
+            epoch_loader = accelerator.skip_first_batches(train_loader, args.start_step)
+        pbar = tqdm(epoch_loader, disable=not accelerator.is_main_process)
+        for i, data in enumerate(pbar):
+            generator = None
+            if deterministic_sampling and batch_augm is not None and batch_augm.on_device:
+                # Augmentations on device are reproducible too: random generator is seeded for every step
+                step = i + (args.start_step if epoch == args.start_epoch else 0)
+                generator = torch.Generator(device=device)
+                generator.manual_seed(get_batch_seed(args.seed, epoch, step, accelerator.process_index))
+            if batch_augm is not None and batch_augm.mix_on_device:
+                # Dataloader returns only stems, mixture is made on device
+                y, x = batch_augm(data.float(), generator=generator)
+            else:
+                y, x = data
+                if batch_augm is not None and batch_augm.on_device:
+                    y, x = batch_augm(y, x, generator=generator)
+
+            if teacher is not None:
+                # Use teacher output as (soft) target
+                with torch.no_grad():
+                    y_teacher = teacher(x)
+                y = args.distill_weight * y_teacher + (1 - args.distill_weight) * y
 
             if args.model_type in ['mel_band_roformer', 'bs_roformer']:
                 # loss is computed in forward pass
@@ -1,7 +1,9 @@
 # coding: utf-8
 __author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
 
+import os
 import time
+import hashlib
 import numpy as np
 import torch
 import torch.nn as nn
@@ -89,6 +91,135 @@ def get_model_from_config(model_type, config_path):
 
     return model, config
 
+def get_int8_cache_path(check_point_path, config_path=''):
+    # Quantized weights are stored next to original checkpoint. Model config and torch version are part of
+    # the name: quantized layers depend on both, so cache made for other config or torch isn't loaded
+    key = torch.__version__
+    if config_path != '':
+        key += '|' + hashlib.sha1(open(config_path, 'rb').read()).hexdigest()
+    key = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return '{}_int8_{}.ckpt'.format(os.path.splitext(check_point_path)[0], key)
+
+
+def int8_cache_is_valid(check_point_path, config_path=''):
+    if check_point_path == '':
+        return False
+    cache_path = get_int8_cache_path(check_point_path, config_path)
+    if not os.path.isfile(cache_path):
+        return False
+    # Checkpoint was changed after cache creation
+    return os.path.getmtime(cache_path) >= os.path.getmtime(check_point_path)
+
+
+def quantize_model(model, check_point_path='', config_path=''):
+    """
+    Apply post-training dynamic int8 quantization to Linear and RNN layers (LSTM, GRU).
+    It only works on CPU. Convolutions are not changed.
+    If cache file for checkpoint exists, quantized weights are loaded from it (model float weights are not
+    required in this case), otherwise quantized state dict is stored next to checkpoint for fast next starts.
+    Cache is keyed on checkpoint, model config (config_path) and torch version.
+    """
+    from torch.ao.quantization import quantize_dynamic
+
+    model = model.cpu().eval()
+    quantized_model = quantize_dynamic(model, {nn.Linear, nn.LSTM, nn.GRU}, dtype=torch.qint8)
+    if int8_cache_is_valid(check_point_path, config_path):
+        cache_path = get_int8_cache_path(check_point_path, config_path)
+        print('Load int8 weights from cache: {}'.format(cache_path))
+        quantized_model.load_state_dict(torch.load(cache_path, map_location='cpu', weights_only=False))
+    elif check_point_path != '':
+        cache_path = get_int8_cache_path(check_point_path, config_path)
+        print('Store int8 weights in cache: {}'.format(cache_path))
+        torch.save(quantized_model.state_dict(), cache_path)
+    return quantized_model
+
+
+class FixedBatchModel(nn.Module):
+    """
+    Wrapper for compiled/traced model which always gets input with the same batch size.
+    Last batch of track is usually smaller, so it's padded with zeros and result is cut back.
+    """
+    def __init__(self, model, batch_size):
+        super().__init__()
+        self.model = model
+        self.batch_size = batch_size
+
+    def forward(self, x):
+        batch_size = x.shape[0]
+        if batch_size < self.batch_size:
+            pad = torch.zeros((self.batch_size - batch_size,) + tuple(x.shape[1:]), dtype=x.dtype, device=x.device)
+            x = torch.cat([x, pad], dim=0)
+        return self.model(x)[:batch_size]
+
+
+def get_compile_cache_key(model_type, config_path, input_shape, device, check_point_path=''):
+    """
+    Key of compiled model in disk cache. Weights are part of traced graph, so checkpoint is also used in key.
+    """
+    config_hash = hashlib.sha1(open(config_path, 'rb').read()).hexdigest()
+    check_point_id = ''
+    if check_point_path != '':
+        check_point_id = '{}_{}'.format(os.path.abspath(check_point_path), os.path.getmtime(check_point_path))
+    key = '|'.join([
+        model_type,
+        config_hash,
+        'x'.join([str(d) for d in input_shape]),
+        torch.__version__,
+        str(device),
+        check_point_id,
+    ])
+    return '{}_{}'.format(model_type, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+
+def compile_model(model, model_type, config_path, input_shape, device, mode='compile', cache_dir='compile_cache', check_point_path='', use_amp=False):
+    """
+    Opt-in compiled inference.
+    mode 'trace' - model is traced with torch.jit.trace and stored in cache_dir. Next starts load it with torch.jit.load.
+    mode 'compile' - model is compiled with torch.compile. Inductor cache is placed in separate folder inside cache_dir
+    for every key, so next starts reuse already compiled kernels.
+    If model can't be compiled, eager model is returned.
+    :param input_shape: (batch_size, channels, length) - shape of input chunks
+    """
+    key = get_compile_cache_key(model_type, config_path, input_shape, device, check_point_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    model = model.eval()
+    example = torch.randn(input_shape, device=device)
+
+    if mode == 'trace':
+        trace_path = os.path.join(cache_dir, key + '.pt')
+        if os.path.isfile(trace_path):
+            print('Load traced model from cache: {}'.format(trace_path))
+            traced = torch.jit.load(trace_path, map_location=device)
+        else:
+            print('Trace model. Store to cache: {}'.format(trace_path))
+            try:
+                with torch.cuda.amp.autocast(enabled=use_amp):
+                    with torch.no_grad():
+                        traced = torch.jit.trace(model, example, check_trace=False)
+            except Exception as e:
+                print('Model can\'t be traced. Use eager mode. Error: {}'.format(e))
+                return model
+            torch.jit.save(traced, trace_path)
+        return FixedBatchModel(traced, input_shape[0])
+    elif mode == 'compile':
+        inductor_dir = os.path.join(cache_dir, key)
+        print('Compile model. Inductor cache: {}'.format(inductor_dir))
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(inductor_dir)
+        compiled = torch.compile(model, dynamic=False)
+        try:
+            # First call does actual compilation (or loads it from cache)
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                with torch.inference_mode():
+                    compiled(example)
+        except Exception as e:
+            print('Model can\'t be compiled. Use eager mode. Error: {}'.format(e))
+            return model
+        return FixedBatchModel(compiled, input_shape[0])
+    else:
+        print('Unknown compile mode: {}'.format(mode))
+        return model
+
+
 def _getWindowingArray(window_size, fade_size):
     fadein = torch.linspace(0, 1, fade_size)
     fadeout = torch.linspace(1, 0, fade_size)
@@ -173,6 +304,42 @@ def demix_track(config, model, mix, device, pbar=False):
 
     return {k: v for k, v in zip(prefer_target_instrument(config), estimated_sources)}
 
+def demix_track_streaming(config, model, mix, device, pbar=False):
+    """
+    Streaming mode for models with forward_stream (SCNet with causal_time_rnn). Audio is processed by
+    consecutive chunks without overlap, state of causal time-path LSTMs is carried from chunk to chunk.
+    Chunk size is inference.streaming_chunk_size (default: audio.chunk_size).
+    """
+    if not hasattr(model, 'forward_stream'):
+        if isinstance(model, (nn.DataParallel, FixedBatchModel)):
+            raise ValueError('Streaming mode (inference.streaming) needs forward_stream of SCNet, it is not available '
+                             'for model wrapped by DataParallel or --compile. Use one device and --compile none.')
+        raise ValueError('Model {} does not support streaming mode (inference.streaming), only SCNet has forward_stream.'.format(type(model).__name__))
+    if not getattr(model, 'causal_time_rnn', False):
+        print('Warning: model has no causal time-path LSTM, state is not carried between chunks.')
+
+    C = config.inference.get('streaming_chunk_size', config.audio.chunk_size)
+    state = None
+    result = []
+    with torch.cuda.amp.autocast(enabled=config.training.use_amp):
+        with torch.inference_mode():
+            progress_bar = tqdm(total=mix.shape[1], desc="Processing audio chunks", leave=False) if pbar else None
+            for i in range(0, mix.shape[1], C):
+                part = mix[None, :, i:i + C].to(device)
+                length = part.shape[-1]
+                if length < C:
+                    part = nn.functional.pad(part, (0, C - length))
+                x, state = model.forward_stream(part, state, length)
+                result.append(x[0, ..., :length].cpu())
+                if progress_bar:
+                    progress_bar.update(length)
+            if progress_bar:
+                progress_bar.close()
+
+    estimated_sources = torch.cat(result, dim=-1).numpy()
+    return {k: v for k, v in zip(prefer_target_instrument(config), estimated_sources)}
+
+
 def demix_track_demucs(config, model, mix, device, pbar=False):
     S = len(config.training.instruments)
     C = config.training.samplerate * config.training.segment
@@ -414,6 +581,8 @@ def demix(config, model, mix: NDArray, device, pbar=False, model_type: str = Non
     mix = torch.tensor(mix, dtype=torch.float32)
     if model_type == 'htdemucs':
         return demix_track_demucs(config, model, mix, device, pbar=pbar)
+    elif config.inference.get('streaming', False):
+        return demix_track_streaming(config, model, mix, device, pbar=pbar)
     else:
         return demix_track(config, model, mix, device, pbar=pbar)
 
@@ -17,7 +17,7 @@ import multiprocessing
 import warnings
 warnings.filterwarnings("ignore")
 
-from utils import demix, get_metrics, get_model_from_config, prefer_target_instrument
+from utils import demix, get_metrics, get_model_from_config, prefer_target_instrument, quantize_model
 
 def proc_list_of_files(
     mixture_paths,
@@ -356,6 +356,7 @@ def check_validation(args):
     parser.add_argument("--extension", type=str, default='wav', help="Choose extension for validation")
     parser.add_argument("--use_tta", action='store_true', help="Flag adds test time augmentation during inference (polarity and channel inverse). While this triples the runtime, it reduces noise and slightly improves prediction quality.")
     parser.add_argument("--metrics", nargs='+', type=str, default=["sdr"], choices=['sdr', 'l1_freq', 'si_sdr', 'log_wmse', 'aura_stft', 'aura_mrstft', 'bleedless', 'fullness'], help='List of metrics to use.')
+    parser.add_argument("--int8", action='store_true', help="Additionally validate model with dynamic int8 quantization (on CPU) and report difference in metrics")
     if args is None:
         args = parser.parse_args()
     else:
@@ -387,9 +388,25 @@ def check_validation(args):
         print('CUDA is not available. Run validation on CPU. It will be very slow...')
 
     if torch.cuda.is_available() and len(device_ids) > 1:
-        valid_multi_gpu(model, args, config, device_ids, verbose=False)
+        metrics_float = valid_multi_gpu(model, args, config, device_ids, verbose=False)
     else:
-        valid(model, args, config, device, verbose=True)
+        metrics_float = valid(model, args, config, device, verbose=True)
+
+    if args.int8:
+        print('Validate model with dynamic int8 quantization on CPU...')
+        model_int8 = quantize_model(copy.deepcopy(model).cpu(), args.start_check_point, args.config_path)
+        # Results of int8 model are stored separately, so they don't overwrite results of float model
+        args_int8 = copy.copy(args)
+        if args.store_dir != '':
+            args_int8.store_dir = os.path.join(args.store_dir, 'int8')
+        metrics_int8 = valid(model_int8, args_int8, config, 'cpu', verbose=True)
+        for metric_name in metrics_float:
+            print('Metric {:11s} float: {:.4f} int8: {:.4f} delta: {:.4f}'.format(
+                metric_name,
+                metrics_float[metric_name],
+                metrics_int8[metric_name],
+                metrics_int8[metric_name] - metrics_float[metric_name],
+            ))
 
 
 if __name__ == "__main__":